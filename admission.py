@@ -0,0 +1,243 @@
+"""按内存做准入控制：估算任务峰值内存，对照设备和主机的实时空闲内存决定放行、排队、降级或拒绝"""
+import glob
+import json
+import os
+import time
+
+import torch
+
+from metrics import metrics
+from scheduler import Deferred
+from stages import place_text_encoders
+
+# FLUX transformer 每个 token 的激活内存（字节），隐藏维度 3072、bf16，
+# 按一个双流块内 attention + MLP 同时存在的中间结果粗略估算
+TRANSFORMER_BYTES_PER_TOKEN = 3072 * 2 * 32
+# VAE 解码在全分辨率上最宽的一层有 128 通道、前后几个中间张量同时存在
+VAE_BYTES_PER_PIXEL = 128 * 2 * 6
+# 开启 VAE tiling 后按 512x512 的块解码
+VAE_TILE_PIXELS = 512 * 512
+# 估算值留出的余量
+SAFETY_MARGIN = 1.2
+
+
+class AdmissionRejected(Exception):
+    """即使降级也放不下，status_code 为返回的 HTTP 状态码"""
+    status_code = 503
+
+
+def is_oom(error):
+    """判断异常是否为显存/内存不足（CUDA、MPS、CPU 的报错形式不同）"""
+    oom_types = tuple(t for t in (getattr(torch, 'OutOfMemoryError', None),
+                                  getattr(torch.cuda, 'OutOfMemoryError', None)) if t is not None)
+    if oom_types and isinstance(error, oom_types):
+        return True
+    message = str(error).lower()
+    return 'out of memory' in message or 'failed to allocate' in message
+
+
+def host_available_bytes():
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def device_available_bytes(device):
+    """设备当前可用内存，CPU 设备返回主机可用内存"""
+    if device.startswith('cuda'):
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    if device.startswith('mps'):
+        return max(torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory(), 0)
+    return host_available_bytes()
+
+
+def snapshot_bytes(model_id, exclude=()):
+    """
+    模型未加载时，用本地快照中 safetensors 文件的大小估算权重内存。
+    只统计 model_index.json 中列出的组件目录：FLUX 仓库在根目录还放了一份单文件权重，全部统计会翻倍。
+    exclude 为加载时直接复用、不占新内存的组件（例如同族模型共用的文本编码器和 VAE）。
+    """
+    from loader import resolve_snapshot
+    try:
+        path = resolve_snapshot(model_id)
+        with open(os.path.join(path, 'model_index.json')) as f:
+            index = json.load(f)
+    except Exception:
+        return 0
+    components = [name for name, value in index.items()
+                  if not name.startswith('_') and isinstance(value, list) and value[0] is not None
+                  and name not in exclude]
+    return sum(os.path.getsize(p) for name in components
+               for p in glob.glob(os.path.join(path, name, '**', '*.safetensors'), recursive=True))
+
+
+def estimate_peak_memory(mode, width, height, batch_size=1, text_tokens=512, weights=0,
+                         vae_tiling=False, max_area=None):
+    """
+    估算一次推理的峰值内存（字节），返回各部分明细。
+    图像 token 为 (h/16)*(w/16)，图片编辑时参考图也作为 token 参与 attention；
+    VAE 解码在全分辨率上进行，往往是峰值所在，开启 tiling 后只与块大小有关。
+    """
+    if max_area and width * height > max_area:
+        scale = (max_area / (width * height)) ** 0.5
+        width, height = int(width * scale), int(height * scale)
+    image_tokens = (height // 16) * (width // 16)
+    tokens = image_tokens * (2 if mode == 'image-edit' else 1) + text_tokens
+    transformer = tokens * TRANSFORMER_BYTES_PER_TOKEN * batch_size
+    pixels = min(width * height, VAE_TILE_PIXELS) if vae_tiling else width * height
+    vae = pixels * VAE_BYTES_PER_PIXEL * (1 if vae_tiling else batch_size)
+    activations = max(transformer, vae)
+    return {
+        'weights': int(weights),
+        'activations': int(activations * SAFETY_MARGIN),
+        'total': int(weights + activations * SAFETY_MARGIN),
+        'width': width,
+        'height': height,
+        'batch_size': batch_size,
+    }
+
+
+class AdmissionController:
+    """
+    任务执行前检查内存。
+    放不下时先等待其它任务释放内存（最多 max_wait 秒），仍然不够则依次尝试：
+    开启 VAE tiling、降低编辑分辨率、开启模型 CPU offload，全部无效时拒绝。
+    """
+
+    def __init__(self, enabled=True, max_wait=30, retry_delay=1.0, min_edit_area=512 * 512, reserve_bytes=0):
+        self.enabled = enabled
+        self.max_wait = max_wait
+        self.retry_delay = retry_delay
+        self.min_edit_area = min_edit_area
+        self.reserve_bytes = reserve_bytes
+
+    def _estimate(self, job, plan):
+        return estimate_peak_memory(
+            job.mode, plan['width'], plan['height'], text_tokens=plan['text_tokens'],
+            weights=plan['weights'], vae_tiling=plan['vae_tiling'], max_area=plan['max_area'],
+        )
+
+    def decide(self, job, worker, width, height, model_id=None, text_tokens=512, inflight=0, shared=()):
+        """
+        返回执行计划 {'action', 'vae_tiling', 'max_area', 'cpu_offload', ...}，
+        需要排队时抛出 Deferred，无法放下时抛出 AdmissionRejected。
+        text_tokens 为 T5 序列长度（所选的桶），inflight 为同一设备上其它还占着内存的任务数
+        （正在去噪、解码或精修），大于 0 时内存不够先排队等它们释放。
+        shared 为模型加载时复用、不计入权重估算的组件名。
+        """
+        pipe = worker.pipes.get(job.params.get('model', job.mode))
+        plan = {
+            'action': 'admit',
+            'width': width,
+            'height': height,
+            # Kontext 默认把参考图缩放到 1024x1024 左右的面积
+            'max_area': job.params.get('max_area') or (1024 * 1024 if job.mode == 'image-edit' else None),
+            'text_tokens': text_tokens,
+            'vae_tiling': False,
+            'cpu_offload': False,
+            'weights': 0 if pipe is not None else snapshot_bytes(model_id, shared) if model_id else 0,
+            'degradations': [],
+        }
+        if not self.enabled:
+            job.metadata['admission'] = {'action': 'disabled'}
+            return plan
+
+        available = device_available_bytes(worker.device) - self.reserve_bytes
+        estimate = self._estimate(job, plan)
+        if estimate['total'] > available:
+            # 先让缓存分配器归还空闲块再看一次
+            from workers import release_device_memory
+            release_device_memory(worker.device)
+            available = device_available_bytes(worker.device) - self.reserve_bytes
+
+        if estimate['total'] > available:
+            waited = time.time() - job.submitted_at
+            if inflight and waited < self.max_wait:
+                job.metadata['admission_deferrals'] = job.metadata.get('admission_deferrals', 0) + 1
+                metrics.inc('admission_decisions_total', action='queue')
+                raise Deferred(self.retry_delay, '内存不足，等待其它任务释放内存')
+            estimate = self._degrade(job, worker, plan, available)
+
+        if estimate['total'] > available:
+            metrics.inc('admission_decisions_total', action='reject')
+            job.metadata['admission'] = self._report('reject', estimate, available, plan)
+            raise AdmissionRejected(
+                f"内存不足：预计需要 {estimate['total'] / 2**30:.1f}GB，当前可用 {max(available, 0) / 2**30:.1f}GB"
+            )
+
+        plan['action'] = 'degrade' if plan['degradations'] else 'admit'
+        metrics.inc('admission_decisions_total', action=plan['action'])
+        for kind in plan['degradations']:
+            metrics.inc('admission_degradations_total', kind=kind)
+        metrics.observe('admission_estimated_bytes', estimate['total'], mode=job.mode)
+        job.metadata['admission'] = self._report(plan['action'], estimate, available, plan)
+        return plan
+
+    def _degrade(self, job, worker, plan, available):
+        estimate = self._estimate(job, plan)
+        if estimate['total'] > available:
+            plan['vae_tiling'] = True
+            plan['degradations'].append('vae_tiling')
+            estimate = self._estimate(job, plan)
+        while estimate['total'] > available and self._shrink_area(job, plan):
+            plan['degradations'].append('max_area')
+            estimate = self._estimate(job, plan)
+        if estimate['total'] > available and worker.device.startswith('cuda'):
+            # offload 后同一时间只有一个模型在显存里，权重不再计入设备内存
+            plan['cpu_offload'] = True
+            plan['degradations'].append('cpu_offload')
+            estimate = dict(estimate, total=estimate['activations'])
+        return estimate
+
+    def _shrink_area(self, job, plan):
+        """图片编辑时把 Kontext 的 max_area 每次缩小一半，不低于 min_edit_area"""
+        if job.mode != 'image-edit':
+            return False
+        current = plan['max_area'] or min(plan['width'] * plan['height'], 1024 * 1024)
+        if current <= self.min_edit_area:
+            return False
+        plan['max_area'] = max(current // 2, self.min_edit_area)
+        return True
+
+    @staticmethod
+    def _report(action, estimate, available, plan):
+        return {
+            'action': action,
+            'estimated_bytes': estimate['total'],
+            'estimate': estimate,
+            'available_bytes': int(available),
+            'degradations': list(plan['degradations']),
+        }
+
+
+def apply_plan(pipe, plan, device, text_encoder_device=None):
+    """
+    按执行计划临时调整流水线，返回恢复函数；text_encoder_device 为文本编码器平时所在的设备。
+    vae_tiling 不在这里切换：VAE 可能被解码线程和其它模型同时使用，由解码时显式传入 tiled。
+    """
+    undo = []
+    if plan['cpu_offload']:
+        pipe.enable_model_cpu_offload(device=device)
+
+        def restore():
+            pipe.remove_all_hooks()
+            pipe.to(device)
+            if text_encoder_device:
+                place_text_encoders(pipe, text_encoder_device)
+        undo.append(restore)
+
+    def revert():
+        for fn in reversed(undo):
+            fn()
+    return revert
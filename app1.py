@@ -1,13 +1,35 @@
-from flask import Flask, request, render_template_string, send_file, jsonify, redirect, url_for
+from flask import Flask, Response, g, request, send_file, jsonify, redirect, url_for
 import torch
-from diffusers import FluxKontextPipeline, FluxPipeline
+from diffusers import __version__ as diffusers_version
 from diffusers.utils import load_image
 from PIL import Image
+import contextlib
 import io
+import json
 import os
 import uuid
 from werkzeug.utils import secure_filename
-import random
+import threading
+import time
+from urllib.parse import quote
+from werkzeug.serving import WSGIRequestHandler
+from scheduler import Deferred, FairScheduler, Job, SchedulerError, PRIORITY_CLASSES
+from workers import Continuation, JobRouter, PipelineWorker, StagedWorker, job_model, parse_devices
+from models import build_registry
+from loader import StartupReport, load_pipeline as load_component_pipeline
+from lora import LoraRegistry, UnknownAdapter
+from admission import AdmissionController, AdmissionRejected, apply_plan, is_oom
+from metrics import metrics
+from stub_pipeline import StubPipeline
+from singleflight import SingleFlight, fingerprint, hash_bytes
+from sessions import SessionNotFound, SessionStore, decode_latents, edit_step, kontext_size
+from tracing import Tracer, span, step_callback
+from jobindex import JobIndex
+from stages import SEQUENCE_BUCKETS, denoise, encode_prompt, place_text_encoders, sequence_bucket, supports_stages
+from upscale import UpscaleWorker, img2img_for, refine_tiles, upscale_image
+from assets import PageCache, StaticAssets
+from seeds import (MAX_SEED, GeneratorPool, enable_determinism, image_digest, metadata_save_kwargs, new_seed,
+                   parse_seed, save_image)
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
@@ -18,23 +40,170 @@ app.config['OUTPUT_FOLDER'] = 'outputs'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
-# 初始化模型
-print("正在加载FLUX模型...")
+# 模型注册表：图片编辑用 Kontext，文生图按质量档位在 dev 和 schnell 之间选择
+model_registry = build_registry()
+MODEL_DTYPE = getattr(torch, os.environ.get('FLUX_DTYPE', 'bfloat16'))
+# T5 序列长度桶，FLUX_SEQ_BUCKETS 为空时固定使用模型的 max_sequence_length
+SEQ_BUCKETS = tuple(int(b) for b in os.environ.get('FLUX_SEQ_BUCKETS', ','.join(map(str, SEQUENCE_BUCKETS))).split(',')
+                    if b.strip())
+# 文本编码器（CLIP / T5）单独放的设备，例如 cpu，留空时与 transformer 在同一设备
+TEXT_ENCODER_DEVICE = os.environ.get('FLUX_TEXT_ENCODER_DEVICE') or None
+# 确定性模式：同一设备和 dtype 上相同的生成元数据得到逐像素相同的结果，需要在加载模型之前开启
+DETERMINISTIC = os.environ.get('FLUX_DETERMINISTIC', '0') == '1'
+if DETERMINISTIC:
+    enable_determinism()
+# 初始噪声用的 CPU 生成器，按种子重设后复用
+generators = GeneratorPool(size=int(os.environ.get('FLUX_GENERATOR_POOL', 8)))
 
-# 图像编辑模型
-print("加载图像编辑模型...")
-edit_pipe = FluxKontextPipeline.from_pretrained("black-forest-labs/FLUX.1-Kontext-dev", torch_dtype=torch.bfloat16)
-edit_pipe.to("mps")
+# 启动报告：各组件加载和迁移到设备的耗时
+startup_report = StartupReport()
 
-# 文生图模型
-print("加载文生图模型...")
-text_to_image_pipe = FluxPipeline.from_pretrained("black-forest-labs/FLUX.1-dev", torch_dtype=torch.bfloat16)
-text_to_image_pipe.to("mps")  
+# 同族模型（dev / schnell）的 CLIP、T5、分词器和 VAE 相同，同一 worker 上只加载一份，FLUX_SHARE_COMPONENTS=0 关闭
+SHARE_COMPONENTS = os.environ.get('FLUX_SHARE_COMPONENTS', '1') == '1'
+SHARED_COMPONENTS = ('text_encoder', 'text_encoder_2', 'tokenizer', 'tokenizer_2', 'vae')
+# 配置了 LoRA 时不共用文本编码器：load_lora_weights 可能给它们打补丁，而适配器状态是按流水线记录的
+SHARED_COMPONENTS_WITH_LORA = ('tokenizer', 'tokenizer_2', 'vae')
 
-print("所有模型加载完成")
+def shared_components(spec, resident):
+    """resident 中与 spec 同族的流水线的共享组件，没有时返回 None"""
+    if not SHARE_COMPONENTS or spec.family is None:
+        return None
+    names = SHARED_COMPONENTS_WITH_LORA if lora_registry.adapters else SHARED_COMPONENTS
+    for name, pipe in resident.items():
+        if name != spec.name and name in model_registry and model_registry[name].family == spec.family:
+            return {component: getattr(pipe, component) for component in names
+                    if getattr(pipe, component, None) is not None}
+    return None
+
+def pin_group(model):
+    """同族模型共用组件，借用（pin）和修改（exclusive、offload）按族互斥"""
+    spec = model_registry[model] if model in model_registry else None
+    if SHARE_COMPONENTS and spec is not None and spec.family is not None:
+        return spec.family
+    return model
+
+def load_pipeline(model, device, resident=None):
+    """
+    从本地快照按组件并行加载注册表中名为 model 的流水线并移动到 device。
+    resident 为同一 worker 上已驻留的流水线，同族模型的文本编码器和 VAE 直接复用。
+    """
+    spec = model_registry[model]
+    if os.environ.get('FLUX_STUB_PIPELINES') == '1':
+        # 压测用的替身流水线，不加载任何权重
+        return StubPipeline(spec.mode, default_steps=spec.default_steps)
+    shared = shared_components(spec, resident or {})
+    if shared:
+        print(f"{model}@{device} 复用已加载的组件: {', '.join(shared)}")
+    key = f"{model}@{device}"
+    try:
+        pipe = load_component_pipeline(
+            spec.pipeline_cls, spec.model_id, device, MODEL_DTYPE,
+            report=startup_report, key=key,
+            allow_download=os.environ.get('FLUX_ALLOW_DOWNLOAD', '0') == '1',
+            max_workers=int(os.environ.get('FLUX_LOAD_THREADS', 4)),
+            shared=shared,
+        )
+    except Exception as e:
+        # 预加载和第一次使用时的加载失败都记进启动报告（/ready、/admin/startup）
+        startup_report.fail(key, e)
+        raise
+    if TEXT_ENCODER_DEVICE:
+        place_text_encoders(pipe, TEXT_ENCODER_DEVICE)
+    return pipe
+
+def text_sequence_length(pipe, job):
+    """按提示词的 T5 token 数选最小的桶，不超过模型的 max_sequence_length；重放时沿用原任务的长度"""
+    length = job.params.get('max_sequence_length') or sequence_bucket(
+        pipe, job.params['prompt'], model_registry[job_model(job)].max_sequence_length, SEQ_BUCKETS)
+    job.metadata['max_sequence_length'] = length
+    return length
+
+def encode_job(job, worker):
+    """
+    分阶段 worker 的文本编码阶段，在编码线程里提前编码提示词。
+    编码线程不持有 worker.lock，通过 worker.pinned 借用流水线，期间它不会被释放、切换 LoRA 或 offload。
+    模型还没驻留或正被修改、流水线不支持分阶段、需要先切换 LoRA（适配器可能带文本编码器的权重）
+    或是会话任务时返回 None，由去噪阶段自己处理。
+    """
+    if job.params.get('session_op'):
+        return None
+    with worker.pinned(job_model(job)) as pipe:
+        if pipe is None or not supports_stages(pipe) or lora_registry.active(pipe) != job.params.get('lora'):
+            return None
+        start = time.perf_counter()
+        with span(job.trace, 'text_encode', stage='encode') as attrs:
+            attrs['max_sequence_length'] = text_sequence_length(pipe, job)
+            encoded = encode_prompt(pipe, job.params['prompt'], attrs['max_sequence_length'])
+    job.metadata.setdefault('stages', {})['encode'] = round(time.perf_counter() - start, 3)
+    return encoded
+
+def activate_lora(worker, model, pipe, lora):
+    """切换 worker 上 model 流水线的适配器；需要切换时等编码线程还回借用的流水线"""
+    if lora_registry.active(pipe) == lora:
+        return
+    with worker.exclusive(model):
+        lora_registry.activate(pipe, lora)
+
+# LoRA 适配器注册表，请求通过 lora 字段按名称选择
+lora_registry = LoraRegistry.from_file(
+    os.environ.get('FLUX_LORA_CONFIG', 'loras.json'),
+    fused_cache_size=int(os.environ.get('FLUX_LORA_FUSED_CACHE', 2)),
+    fuse_after=int(os.environ.get('FLUX_LORA_FUSE_AFTER', 3)),
+    cache_device=os.environ.get('FLUX_LORA_CACHE_DEVICE') or None,
+)
+
+# 启动时预加载的模型；schnell 默认在第一次 fast 档请求时再加载
+PRELOAD_MODELS = [name.strip() for name in os.environ.get('FLUX_PRELOAD_MODELS', 'flux-kontext,flux-dev').split(',')
+                  if name.strip()]
+unknown_models = [name for name in PRELOAD_MODELS if name not in model_registry]
+if unknown_models:
+    raise ValueError(f"FLUX_PRELOAD_MODELS 中有未知模型: {', '.join(unknown_models)}")
+
+# 初始化 worker，每个设备一个，FLUX_DEVICES 例如 "cuda:0,cuda:1" 或 "cpu@0-7,cpu@8-15"
+def create_worker(name, device, cpu_set):
+    """FLUX_STAGED=1 时文本编码、去噪、解码分三个线程流水执行"""
+    # 默认所有可路由的模型都能同时驻留，fast 档请求不会把预加载的模型挤出去
+    max_resident = int(os.environ.get('FLUX_MAX_RESIDENT', max(len(model_registry), 1)))
+    if os.environ.get('FLUX_STAGED', '0') == '1':
+        return StagedWorker(name, device, load_pipeline, encode_job, cpu_set=cpu_set, max_resident=max_resident,
+                            queue_size=int(os.environ.get('FLUX_STAGE_QUEUE', 1)), pin_group=pin_group)
+    return PipelineWorker(name, device, load_pipeline, cpu_set=cpu_set, max_resident=max_resident,
+                          pin_group=pin_group)
+
+workers = [
+    create_worker(f"w{i}", device, cpu_set)
+    for i, (device, cpu_set) in enumerate(parse_devices(os.environ.get('FLUX_DEVICES', 'mps')))
+]
+
+def warm_up():
+    """后台加载所有 worker 的模型，HTTP 服务不用等待加载完成就能启动"""
+    print("正在加载FLUX模型...")
+    threads = [
+        threading.Thread(target=worker.preload, args=(PRELOAD_MODELS,),
+                         kwargs={'max_parallel': max(len(PRELOAD_MODELS), 1)}, name=f'preload-{worker.name}')
+        for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    startup_report.finish()
+    startup_report.print_summary()
+    print("所有模型加载完成")
+
+# 初始化模型，FLUX_PRELOAD=0 时改为第一次使用时加载
+if os.environ.get('FLUX_PRELOAD', '1') == '1':
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+else:
+    for worker in workers:
+        worker.ready.set()
+    startup_report.finish()
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
+# Kontext 默认 28 步，编辑任务的调度成本按此估算
+EDIT_JOB_COST = 28
+
 # HTML模板作为字符串
 INDEX_TEMPLATE = '''
 <!DOCTYPE html>
@@ -43,233 +212,7 @@ INDEX_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>FLUX AI 图片工具</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            max-width: 900px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: #f5f5f5;
-        }
-        .container {
-            background-color: white;
-            padding: 30px;
-            border-radius: 10px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }
-        h1 {
-            text-align: center;
-            color: #333;
-            margin-bottom: 30px;
-        }
-        .mode-selector {
-            display: flex;
-            justify-content: center;
-            margin-bottom: 30px;
-            background-color: #f8f9fa;
-            border-radius: 8px;
-            padding: 8px;
-        }
-        .mode-btn {
-            flex: 1;
-            padding: 12px 24px;
-            background-color: transparent;
-            border: none;
-            border-radius: 6px;
-            cursor: pointer;
-            font-size: 16px;
-            transition: all 0.3s;
-            max-width: 200px;
-        }
-        .mode-btn.active {
-            background-color: #007bff;
-            color: white;
-        }
-        .mode-btn:hover:not(.active) {
-            background-color: #e9ecef;
-        }
-        .mode-content {
-            display: none;
-        }
-        .mode-content.active {
-            display: block;
-        }
-        .form-group {
-            margin-bottom: 20px;
-        }
-        label {
-            display: block;
-            margin-bottom: 5px;
-            font-weight: bold;
-            color: #555;
-        }
-        input[type="file"], input[type="text"], input[type="number"], textarea {
-            width: 100%;
-            padding: 10px;
-            border: 2px solid #ddd;
-            border-radius: 5px;
-            font-size: 16px;
-            box-sizing: border-box;
-        }
-        textarea {
-            resize: vertical;
-            min-height: 80px;
-        }
-        .input-row {
-            display: grid;
-            grid-template-columns: 1fr 1fr;
-            gap: 15px;
-        }
-        button {
-            width: 100%;
-            padding: 12px;
-            background-color: #007bff;
-            color: white;
-            border: none;
-            border-radius: 5px;
-            font-size: 18px;
-            cursor: pointer;
-            transition: background-color 0.3s;
-        }
-        button:hover:not(:disabled) {
-            background-color: #0056b3;
-        }
-        button:disabled {
-            background-color: #ccc;
-            cursor: not-allowed;
-        }
-        .preview {
-            margin-top: 20px;
-            text-align: center;
-        }
-        .preview img {
-            max-width: 100%;
-            max-height: 300px;
-            border-radius: 5px;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.2);
-        }
-        .loading {
-            margin-top: 20px;
-            padding: 20px;
-            background-color: #f8f9fa;
-            border-radius: 8px;
-            border: 1px solid #dee2e6;
-        }
-        .progress-container {
-            margin: 20px 0;
-        }
-        .progress-bar {
-            width: 100%;
-            height: 25px;
-            background-color: #e9ecef;
-            border-radius: 12px;
-            overflow: hidden;
-            box-shadow: inset 0 1px 3px rgba(0,0,0,0.2);
-        }
-        .progress-fill {
-            height: 100%;
-            background: linear-gradient(90deg, #007bff, #0056b3);
-            width: 0%;
-            transition: width 0.3s ease;
-            border-radius: 12px;
-            position: relative;
-            animation: pulse 2s infinite;
-        }
-        @keyframes pulse {
-            0%, 100% { opacity: 1; }
-            50% { opacity: 0.8; }
-        }
-        .progress-text {
-            text-align: center;
-            margin-top: 10px;
-            font-weight: bold;
-            color: #495057;
-        }
-        .loading-title {
-            text-align: center;
-            font-size: 18px;
-            color: #007bff;
-            margin-bottom: 15px;
-            font-weight: bold;
-        }
-        .loading-subtitle {
-            text-align: center;
-            font-size: 14px;
-            color: #6c757d;
-            margin-bottom: 20px;
-        }
-        .processing-steps {
-            margin-top: 15px;
-            font-size: 14px;
-            color: #6c757d;
-        }
-        .step {
-            margin: 5px 0;
-            padding-left: 20px;
-            position: relative;
-        }
-        .step.active {
-            color: #007bff;
-            font-weight: bold;
-        }
-        .step.completed {
-            color: #28a745;
-        }
-        .step::before {
-            content: '○';
-            position: absolute;
-            left: 0;
-            top: 0;
-        }
-        .step.active::before {
-            content: '●';
-            color: #007bff;
-        }
-        .step.completed::before {
-            content: '✓';
-            color: #28a745;
-        }
-        .error {
-            color: #dc3545;
-            text-align: center;
-            margin-top: 10px;
-        }
-        .small-text {
-            font-size: 12px;
-            color: #666;
-            margin-top: 5px;
-        }
-        .edit-mode {
-            background-color: #fff3cd;
-            border: 1px solid #ffeaa7;
-            border-radius: 8px;
-            padding: 15px;
-            margin-bottom: 20px;
-        }
-        .edit-mode h3 {
-            margin-top: 0;
-            color: #856404;
-        }
-        .feature-description {
-            background-color: #e7f3ff;
-            border: 1px solid #bee5eb;
-            border-radius: 8px;
-            padding: 15px;
-            margin-bottom: 20px;
-        }
-        .feature-description h4 {
-            margin-top: 0;
-            color: #0c5460;
-        }
-        @media (max-width: 768px) {
-            .input-row {
-                grid-template-columns: 1fr;
-            }
-            .mode-selector {
-                flex-direction: column;
-            }
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('index.css') }}">
 </head>
 <body>
     <div class="container">
@@ -304,9 +247,34 @@ INDEX_TEMPLATE = '''
                     </div>
                     
                     <div class="form-group">
-                        <label for="num_inference_steps">推理步数 (20-100)：</label>
-                        <input type="number" id="num_inference_steps" name="num_inference_steps" value="50" min="20" max="100" step="1">
-                        <div class="small-text">步数越多质量越高，但耗时更长</div>
+                        <label for="num_inference_steps">推理步数 (1-100)：</label>
+                        <input type="number" id="num_inference_steps" name="num_inference_steps" value="50" min="1" max="100" step="1">
+                        <div class="small-text">步数越多质量越高，但耗时更长；{{ fast_steps_threshold }} 步以内自动使用快速模型</div>
+                    </div>
+                </div>
+
+                <div class="form-group">
+                    <label for="tier">质量档位：</label>
+                    <select id="tier" name="tier">
+                        <option value="">自动</option>
+                        <option value="quality">高质量 (FLUX.1-dev)</option>
+                        <option value="fast">快速 (FLUX.1-schnell, 4 步)</option>
+                    </select>
+                </div>
+
+                <div class="input-row">
+                    <div class="form-group">
+                        <label for="text_upscale">输出放大：</label>
+                        <select id="text_upscale" name="upscale">
+                            <option value="1">不放大</option>
+                            <option value="2">2 倍</option>
+                            <option value="4">4 倍</option>
+                        </select>
+                    </div>
+
+                    <div class="form-group">
+                        <label><input type="checkbox" name="refine" value="1"> 放大后精修细节</label>
+                        <div class="small-text">按分块低强度重绘，细节更好但更慢</div>
                     </div>
                 </div>
                 
@@ -359,6 +327,22 @@ INDEX_TEMPLATE = '''
                     <input type="number" id="edit_guidance_scale" name="guidance_scale" value="2.5" min="1.0" max="5.0" step="0.1">
                     <div class="small-text">数值越高，AI越严格按照提示词处理图片</div>
                 </div>
+
+                <div class="input-row">
+                    <div class="form-group">
+                        <label for="edit_upscale">输出放大：</label>
+                        <select id="edit_upscale" name="upscale">
+                            <option value="1">不放大</option>
+                            <option value="2">2 倍</option>
+                            <option value="4">4 倍</option>
+                        </select>
+                    </div>
+
+                    <div class="form-group">
+                        <label><input type="checkbox" name="refine" value="1"> 放大后精修细节</label>
+                        <div class="small-text">按分块低强度重绘，细节更好但更慢</div>
+                    </div>
+                </div>
                 
                 <button type="submit" id="imageEditBtn">🚀 {{ '重新处理' if edit_mode else '开始处理' }}</button>
             </form>
@@ -394,207 +378,438 @@ INDEX_TEMPLATE = '''
         <div id="error" class="error" style="display:none;"></div>
     </div>
 
-    <script>
-        // 模式切换
-        const modeBtns = document.querySelectorAll('.mode-btn');
-        const modeContents = document.querySelectorAll('.mode-content');
-        
-        modeBtns.forEach(btn => {
-            btn.addEventListener('click', () => {
-                const mode = btn.dataset.mode;
-                
-                // 更新按钮状态
-                modeBtns.forEach(b => b.classList.remove('active'));
-                btn.classList.add('active');
-                
-                // 更新内容显示
-                modeContents.forEach(content => {
-                    content.classList.remove('active');
-                });
-                document.getElementById(mode).classList.add('active');
-            });
+    <script src="{{ asset_url('index.js') }}"></script>
+</body>
+</html>
+'''
+
+# 首页的样式和脚本，启动时按内容指纹注册为静态资源
+INDEX_CSS = '''
+body {
+    font-family: Arial, sans-serif;
+    max-width: 900px;
+    margin: 0 auto;
+    padding: 20px;
+    background-color: #f5f5f5;
+}
+.container {
+    background-color: white;
+    padding: 30px;
+    border-radius: 10px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+}
+h1 {
+    text-align: center;
+    color: #333;
+    margin-bottom: 30px;
+}
+.mode-selector {
+    display: flex;
+    justify-content: center;
+    margin-bottom: 30px;
+    background-color: #f8f9fa;
+    border-radius: 8px;
+    padding: 8px;
+}
+.mode-btn {
+    flex: 1;
+    padding: 12px 24px;
+    background-color: transparent;
+    border: none;
+    border-radius: 6px;
+    cursor: pointer;
+    font-size: 16px;
+    transition: all 0.3s;
+    max-width: 200px;
+}
+.mode-btn.active {
+    background-color: #007bff;
+    color: white;
+}
+.mode-btn:hover:not(.active) {
+    background-color: #e9ecef;
+}
+.mode-content {
+    display: none;
+}
+.mode-content.active {
+    display: block;
+}
+.form-group {
+    margin-bottom: 20px;
+}
+label {
+    display: block;
+    margin-bottom: 5px;
+    font-weight: bold;
+    color: #555;
+}
+input[type="file"], input[type="text"], input[type="number"], textarea {
+    width: 100%;
+    padding: 10px;
+    border: 2px solid #ddd;
+    border-radius: 5px;
+    font-size: 16px;
+    box-sizing: border-box;
+}
+textarea {
+    resize: vertical;
+    min-height: 80px;
+}
+.input-row {
+    display: grid;
+    grid-template-columns: 1fr 1fr;
+    gap: 15px;
+}
+button {
+    width: 100%;
+    padding: 12px;
+    background-color: #007bff;
+    color: white;
+    border: none;
+    border-radius: 5px;
+    font-size: 18px;
+    cursor: pointer;
+    transition: background-color 0.3s;
+}
+button:hover:not(:disabled) {
+    background-color: #0056b3;
+}
+button:disabled {
+    background-color: #ccc;
+    cursor: not-allowed;
+}
+.preview {
+    margin-top: 20px;
+    text-align: center;
+}
+.preview img {
+    max-width: 100%;
+    max-height: 300px;
+    border-radius: 5px;
+    box-shadow: 0 2px 5px rgba(0,0,0,0.2);
+}
+.loading {
+    margin-top: 20px;
+    padding: 20px;
+    background-color: #f8f9fa;
+    border-radius: 8px;
+    border: 1px solid #dee2e6;
+}
+.progress-container {
+    margin: 20px 0;
+}
+.progress-bar {
+    width: 100%;
+    height: 25px;
+    background-color: #e9ecef;
+    border-radius: 12px;
+    overflow: hidden;
+    box-shadow: inset 0 1px 3px rgba(0,0,0,0.2);
+}
+.progress-fill {
+    height: 100%;
+    background: linear-gradient(90deg, #007bff, #0056b3);
+    width: 0%;
+    transition: width 0.3s ease;
+    border-radius: 12px;
+    position: relative;
+    animation: pulse 2s infinite;
+}
+@keyframes pulse {
+    0%, 100% { opacity: 1; }
+    50% { opacity: 0.8; }
+}
+.progress-text {
+    text-align: center;
+    margin-top: 10px;
+    font-weight: bold;
+    color: #495057;
+}
+.loading-title {
+    text-align: center;
+    font-size: 18px;
+    color: #007bff;
+    margin-bottom: 15px;
+    font-weight: bold;
+}
+.loading-subtitle {
+    text-align: center;
+    font-size: 14px;
+    color: #6c757d;
+    margin-bottom: 20px;
+}
+.processing-steps {
+    margin-top: 15px;
+    font-size: 14px;
+    color: #6c757d;
+}
+.step {
+    margin: 5px 0;
+    padding-left: 20px;
+    position: relative;
+}
+.step.active {
+    color: #007bff;
+    font-weight: bold;
+}
+.step.completed {
+    color: #28a745;
+}
+.step::before {
+    content: '○';
+    position: absolute;
+    left: 0;
+    top: 0;
+}
+.step.active::before {
+    content: '●';
+    color: #007bff;
+}
+.step.completed::before {
+    content: '✓';
+    color: #28a745;
+}
+.error {
+    color: #dc3545;
+    text-align: center;
+    margin-top: 10px;
+}
+.small-text {
+    font-size: 12px;
+    color: #666;
+    margin-top: 5px;
+}
+.edit-mode {
+    background-color: #fff3cd;
+    border: 1px solid #ffeaa7;
+    border-radius: 8px;
+    padding: 15px;
+    margin-bottom: 20px;
+}
+.edit-mode h3 {
+    margin-top: 0;
+    color: #856404;
+}
+.feature-description {
+    background-color: #e7f3ff;
+    border: 1px solid #bee5eb;
+    border-radius: 8px;
+    padding: 15px;
+    margin-bottom: 20px;
+}
+.feature-description h4 {
+    margin-top: 0;
+    color: #0c5460;
+}
+@media (max-width: 768px) {
+    .input-row {
+        grid-template-columns: 1fr;
+    }
+    .mode-selector {
+        flex-direction: column;
+    }
+}
+'''
+
+INDEX_JS = '''
+// 模式切换
+const modeBtns = document.querySelectorAll('.mode-btn');
+const modeContents = document.querySelectorAll('.mode-content');
+
+modeBtns.forEach(btn => {
+    btn.addEventListener('click', () => {
+        const mode = btn.dataset.mode;
+
+        // 更新按钮状态
+        modeBtns.forEach(b => b.classList.remove('active'));
+        btn.classList.add('active');
+
+        // 更新内容显示
+        modeContents.forEach(content => {
+            content.classList.remove('active');
         });
+        document.getElementById(mode).classList.add('active');
+    });
+});
 
-        // 通用元素
-        const loading = document.getElementById('loading');
-        const error = document.getElementById('error');
-        const progressFill = document.getElementById('progressFill');
-        const progressText = document.getElementById('progressText');
-
-        // 图片编辑相关元素
-        const fileInput = document.getElementById('file');
-        const preview = document.getElementById('preview');
-        const previewImg = document.getElementById('previewImg');
-
-        let progressInterval;
-        const steps = ['step1', 'step2', 'step3', 'step4', 'step5'];
-
-        // 文件选择预览（仅在图片编辑模式且非编辑模式下）
-        if (fileInput) {
-            fileInput.addEventListener('change', function(e) {
-                const file = e.target.files[0];
-                if (file) {
-                    const reader = new FileReader();
-                    reader.onload = function(e) {
-                        previewImg.src = e.target.result;
-                        preview.style.display = 'block';
-                    };
-                    reader.readAsDataURL(file);
-                } else {
-                    preview.style.display = 'none';
-                }
-            });
+// 通用元素
+const loading = document.getElementById('loading');
+const error = document.getElementById('error');
+const progressFill = document.getElementById('progressFill');
+const progressText = document.getElementById('progressText');
+
+// 图片编辑相关元素
+const fileInput = document.getElementById('file');
+const preview = document.getElementById('preview');
+const previewImg = document.getElementById('previewImg');
+
+let progressInterval;
+const steps = ['step1', 'step2', 'step3', 'step4', 'step5'];
+
+// 文件选择预览（仅在图片编辑模式且非编辑模式下）
+if (fileInput) {
+    fileInput.addEventListener('change', function(e) {
+        const file = e.target.files[0];
+        if (file) {
+            const reader = new FileReader();
+            reader.onload = function(e) {
+                previewImg.src = e.target.result;
+                preview.style.display = 'block';
+            };
+            reader.readAsDataURL(file);
+        } else {
+            preview.style.display = 'none';
         }
+    });
+}
 
-        // 更新进度条
-        function updateProgress(percent, stepIndex) {
-            progressFill.style.width = percent + '%';
-            progressText.textContent = Math.round(percent) + '%';
-            
-            // 更新步骤状态
-            steps.forEach((stepId, index) => {
-                const stepElement = document.getElementById(stepId);
-                if (stepElement) {
-                    if (index < stepIndex) {
-                        stepElement.className = 'step completed';
-                    } else if (index === stepIndex) {
-                        stepElement.className = 'step active';
-                    } else {
-                        stepElement.className = 'step';
-                    }
-                }
-            });
+// 更新进度条
+function updateProgress(percent, stepIndex) {
+    progressFill.style.width = percent + '%';
+    progressText.textContent = Math.round(percent) + '%';
+
+    // 更新步骤状态
+    steps.forEach((stepId, index) => {
+        const stepElement = document.getElementById(stepId);
+        if (stepElement) {
+            if (index < stepIndex) {
+                stepElement.className = 'step completed';
+            } else if (index === stepIndex) {
+                stepElement.className = 'step active';
+            } else {
+                stepElement.className = 'step';
+            }
         }
+    });
+}
 
-        // 模拟进度更新
-        function simulateProgress() {
-            let progress = 0;
-            let stepIndex = 0;
-            
-            progressInterval = setInterval(() => {
-                if (stepIndex === 0 && progress < 10) {
-                    progress += 1;
-                } else if (stepIndex === 1 && progress < 25) {
-                    progress += 0.5;
-                } else if (stepIndex === 2 && progress < 80) {
-                    progress += 0.3;
-                } else if (stepIndex === 3 && progress < 95) {
-                    progress += 1;
-                } else if (stepIndex === 4 && progress < 100) {
-                    progress += 2;
-                } else if (stepIndex < steps.length - 1) {
-                    stepIndex++;
-                }
-                
-                updateProgress(progress, stepIndex);
-                
-                if (progress >= 100) {
-                    clearInterval(progressInterval);
-                    updateProgress(100, steps.length);
-                }
-            }, 100);
+// 模拟进度更新
+function simulateProgress() {
+    let progress = 0;
+    let stepIndex = 0;
+
+    progressInterval = setInterval(() => {
+        if (stepIndex === 0 && progress < 10) {
+            progress += 1;
+        } else if (stepIndex === 1 && progress < 25) {
+            progress += 0.5;
+        } else if (stepIndex === 2 && progress < 80) {
+            progress += 0.3;
+        } else if (stepIndex === 3 && progress < 95) {
+            progress += 1;
+        } else if (stepIndex === 4 && progress < 100) {
+            progress += 2;
+        } else if (stepIndex < steps.length - 1) {
+            stepIndex++;
         }
 
-        // 重置进度
-        function resetProgress() {
-            if (progressInterval) {
-                clearInterval(progressInterval);
+        updateProgress(progress, stepIndex);
+
+        if (progress >= 100) {
+            clearInterval(progressInterval);
+            updateProgress(100, steps.length);
+        }
+    }, 100);
+}
+
+// 重置进度
+function resetProgress() {
+    if (progressInterval) {
+        clearInterval(progressInterval);
+    }
+    updateProgress(0, -1);
+}
+
+// 处理表单提交
+function handleFormSubmit(form, submitBtn, originalBtnText) {
+    form.addEventListener('submit', function(e) {
+        e.preventDefault();
+
+        const formData = new FormData(form);
+        const mode = formData.get('mode');
+
+        // 验证
+        if (mode === 'image-edit') {
+            const file = fileInput ? fileInput.files[0] : null;
+            const originalImage = document.querySelector('input[name="original_image"]');
+
+            if (!file && !originalImage) {
+                showError('请选择一张图片');
+                return;
+            }
+        } else if (mode === 'text-to-image') {
+            const prompt = formData.get('prompt');
+            if (!prompt || prompt.trim() === '') {
+                showError('请输入图片描述');
+                return;
             }
-            updateProgress(0, -1);
         }
 
-        // 处理表单提交
-        function handleFormSubmit(form, submitBtn, originalBtnText) {
-            form.addEventListener('submit', function(e) {
-                e.preventDefault();
-                
-                const formData = new FormData(form);
-                const mode = formData.get('mode');
-                
-                // 验证
-                if (mode === 'image-edit') {
-                    const file = fileInput ? fileInput.files[0] : null;
-                    const originalImage = document.querySelector('input[name="original_image"]');
-                    
-                    if (!file && !originalImage) {
-                        showError('请选择一张图片');
-                        return;
-                    }
-                } else if (mode === 'text-to-image') {
-                    const prompt = formData.get('prompt');
-                    if (!prompt || prompt.trim() === '') {
-                        showError('请输入图片描述');
-                        return;
+        // 显示加载状态
+        loading.style.display = 'block';
+        error.style.display = 'none';
+        submitBtn.disabled = true;
+        submitBtn.textContent = '处理中...';
+
+        // 开始模拟进度
+        resetProgress();
+        simulateProgress();
+
+        fetch('/process', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => response.json())
+        .then(data => {
+            // 确保进度条到达100%
+            clearInterval(progressInterval);
+            updateProgress(100, steps.length);
+
+            setTimeout(() => {
+                loading.style.display = 'none';
+                submitBtn.disabled = false;
+                submitBtn.textContent = originalBtnText;
+
+                if (data.success) {
+                    // 构建URL参数
+                    let url = `/result/${data.output_image}?mode=${data.mode}&prompt=${encodeURIComponent(data.prompt)}`;
+                    if (data.original_image) {
+                        url += `&original=${data.original_image}`;
                     }
-                }
-                
-                // 显示加载状态
-                loading.style.display = 'block';
-                error.style.display = 'none';
-                submitBtn.disabled = true;
-                submitBtn.textContent = '处理中...';
-                
-                // 开始模拟进度
-                resetProgress();
-                simulateProgress();
-                
-                fetch('/process', {
-                    method: 'POST',
-                    body: formData
-                })
-                .then(response => response.json())
-                .then(data => {
-                    // 确保进度条到达100%
-                    clearInterval(progressInterval);
-                    updateProgress(100, steps.length);
-                    
-                    setTimeout(() => {
-                        loading.style.display = 'none';
-                        submitBtn.disabled = false;
-                        submitBtn.textContent = originalBtnText;
-                        
-                        if (data.success) {
-                            // 构建URL参数
-                            let url = `/result/${data.output_image}?mode=${data.mode}&prompt=${encodeURIComponent(data.prompt)}`;
-                            if (data.original_image) {
-                                url += `&original=${data.original_image}`;
-                            }
-                            window.location.href = url;
-                        } else {
-                            showError(data.error || '处理失败');
-                            resetProgress();
-                        }
-                    }, 500);
-                })
-                .catch(err => {
-                    clearInterval(progressInterval);
-                    loading.style.display = 'none';
-                    submitBtn.disabled = false;
-                    submitBtn.textContent = originalBtnText;
-                    showError('网络错误：' + err.message);
+                    window.location.href = url;
+                } else {
+                    showError(data.error || '处理失败');
                     resetProgress();
-                });
-            });
-        }
+                }
+            }, 500);
+        })
+        .catch(err => {
+            clearInterval(progressInterval);
+            loading.style.display = 'none';
+            submitBtn.disabled = false;
+            submitBtn.textContent = originalBtnText;
+            showError('网络错误：' + err.message);
+            resetProgress();
+        });
+    });
+}
 
-        // 绑定表单事件
-        const textToImageForm = document.getElementById('textToImageForm');
-        const textToImageBtn = document.getElementById('textToImageBtn');
-        handleFormSubmit(textToImageForm, textToImageBtn, '🚀 生成图片');
+// 绑定表单事件
+const textToImageForm = document.getElementById('textToImageForm');
+const textToImageBtn = document.getElementById('textToImageBtn');
+handleFormSubmit(textToImageForm, textToImageBtn, '🚀 生成图片');
 
-        const imageEditForm = document.getElementById('imageEditForm');
-        const imageEditBtn = document.getElementById('imageEditBtn');
-        const originalImageInput = document.querySelector('input[name="original_image"]');
-        const originalBtnText = originalImageInput ? '🚀 重新处理' : '🚀 开始处理';
-        handleFormSubmit(imageEditForm, imageEditBtn, originalBtnText);
+const imageEditForm = document.getElementById('imageEditForm');
+const imageEditBtn = document.getElementById('imageEditBtn');
+const originalImageInput = document.querySelector('input[name="original_image"]');
+const originalBtnText = originalImageInput ? '🚀 重新处理' : '🚀 开始处理';
+handleFormSubmit(imageEditForm, imageEditBtn, originalBtnText);
 
-        function showError(message) {
-            error.textContent = message;
-            error.style.display = 'block';
-        }
-    </script>
-</body>
-</html>
+function showError(message) {
+    error.textContent = message;
+    error.style.display = 'block';
+}
 '''
 
 RESULT_TEMPLATE = '''
@@ -604,184 +819,7 @@ RESULT_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>处理结果 - FLUX AI 图片工具</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: #f5f5f5;
-        }
-        .container {
-            background-color: white;
-            padding: 30px;
-            border-radius: 10px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }
-        h1 {
-            text-align: center;
-            color: #333;
-            margin-bottom: 30px;
-        }
-        .result-content {
-            margin: 30px 0;
-        }
-        .text-to-image-result {
-            text-align: center;
-        }
-        .comparison-container {
-            display: grid;
-            grid-template-columns: 1fr 1fr;
-            gap: 30px;
-        }
-        .image-section {
-            text-align: center;
-        }
-        .image-section h3 {
-            margin-bottom: 15px;
-            color: #555;
-            font-size: 18px;
-        }
-        .image-section img, .text-to-image-result img {
-            max-width: 100%;
-            max-height: 500px;
-            border-radius: 10px;
-            box-shadow: 0 4px 15px rgba(0,0,0,0.2);
-            transition: transform 0.3s ease;
-        }
-        .image-section img:hover, .text-to-image-result img:hover {
-            transform: scale(1.02);
-        }
-        .prompt-info {
-            background-color: #f8f9fa;
-            padding: 15px;
-            border-radius: 8px;
-            margin: 20px 0;
-            border-left: 4px solid #007bff;
-        }
-        .prompt-info h4 {
-            margin: 0 0 10px 0;
-            color: #007bff;
-        }
-        .prompt-text {
-            font-style: italic;
-            color: #555;
-        }
-        .mode-badge {
-            display: inline-block;
-            padding: 6px 12px;
-            border-radius: 20px;
-            font-size: 14px;
-            font-weight: bold;
-            margin-bottom: 20px;
-        }
-        .mode-badge.text-to-image {
-            background-color: #d4edda;
-            color: #155724;
-        }
-        .mode-badge.image-edit {
-            background-color: #cce5ff;
-            color: #004085;
-        }
-        .actions {
-            text-align: center;
-            margin-top: 30px;
-            display: flex;
-            flex-wrap: wrap;
-            justify-content: center;
-            gap: 15px;
-        }
-        .btn {
-            display: inline-block;
-            padding: 12px 24px;
-            text-decoration: none;
-            border-radius: 5px;
-            font-size: 16px;
-            cursor: pointer;
-            transition: all 0.3s;
-            border: none;
-        }
-        .btn-primary {
-            background-color: #007bff;
-            color: white;
-        }
-        .btn-primary:hover {
-            background-color: #0056b3;
-        }
-        .btn-success {
-            background-color: #28a745;
-            color: white;
-        }
-        .btn-success:hover {
-            background-color: #1e7e34;
-        }
-        .btn-warning {
-            background-color: #ffc107;
-            color: #212529;
-        }
-        .btn-warning:hover {
-            background-color: #e0a800;
-        }
-        .btn-secondary {
-            background-color: #6c757d;
-            color: white;
-        }
-        .btn-secondary:hover {
-            background-color: #545b62;
-        }
-        .btn-info {
-            background-color: #17a2b8;
-            color: white;
-        }
-        .btn-info:hover {
-            background-color: #138496;
-        }
-        .success-message {
-            text-align: center;
-            color: #28a745;
-            font-size: 18px;
-            margin-bottom: 20px;
-        }
-        .completion-animation {
-            text-align: center;
-            margin-bottom: 20px;
-        }
-        .checkmark {
-            width: 60px;
-            height: 60px;
-            border-radius: 50%;
-            background-color: #28a745;
-            margin: 0 auto 15px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            animation: checkmark-scale 0.6s ease-in-out;
-        }
-        .checkmark::before {
-            content: '✓';
-            color: white;
-            font-size: 30px;
-            font-weight: bold;
-        }
-        @keyframes checkmark-scale {
-            0% { transform: scale(0); }
-            50% { transform: scale(1.2); }
-            100% { transform: scale(1); }
-        }
-        @media (max-width: 768px) {
-            .comparison-container {
-                grid-template-columns: 1fr;
-                gap: 20px;
-            }
-            .actions {
-                flex-direction: column;
-                align-items: center;
-            }
-            .btn {
-                width: 200px;
-            }
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('result.css') }}">
 </head>
 <body>
     <div class="container">
@@ -844,208 +882,1404 @@ RESULT_TEMPLATE = '''
         </div>
     </div>
 
-    <script>
-        // 确保图片加载完成后显示
-        const resultImg = document.getElementById('resultImg');
-        const originalImg = document.getElementById('originalImg');
-        
-        resultImg.onload = function() {
-            console.log('结果图片加载成功');
-        };
-        resultImg.onerror = function() {
-            console.error('结果图片加载失败');
-            alert('图片加载失败，请刷新页面重试');
-        };
-        
-        if (originalImg) {
-            originalImg.onload = function() {
-                console.log('原图加载成功');
-            };
-            originalImg.onerror = function() {
-                console.error('原图加载失败');
-            };
-        }
-    </script>
+    <script src="{{ asset_url('result.js') }}"></script>
 </body>
 </html>
 '''
 
+RESULT_CSS = '''
+body {
+    font-family: Arial, sans-serif;
+    max-width: 1200px;
+    margin: 0 auto;
+    padding: 20px;
+    background-color: #f5f5f5;
+}
+.container {
+    background-color: white;
+    padding: 30px;
+    border-radius: 10px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+}
+h1 {
+    text-align: center;
+    color: #333;
+    margin-bottom: 30px;
+}
+.result-content {
+    margin: 30px 0;
+}
+.text-to-image-result {
+    text-align: center;
+}
+.comparison-container {
+    display: grid;
+    grid-template-columns: 1fr 1fr;
+    gap: 30px;
+}
+.image-section {
+    text-align: center;
+}
+.image-section h3 {
+    margin-bottom: 15px;
+    color: #555;
+    font-size: 18px;
+}
+.image-section img, .text-to-image-result img {
+    max-width: 100%;
+    max-height: 500px;
+    border-radius: 10px;
+    box-shadow: 0 4px 15px rgba(0,0,0,0.2);
+    transition: transform 0.3s ease;
+}
+.image-section img:hover, .text-to-image-result img:hover {
+    transform: scale(1.02);
+}
+.prompt-info {
+    background-color: #f8f9fa;
+    padding: 15px;
+    border-radius: 8px;
+    margin: 20px 0;
+    border-left: 4px solid #007bff;
+}
+.prompt-info h4 {
+    margin: 0 0 10px 0;
+    color: #007bff;
+}
+.prompt-text {
+    font-style: italic;
+    color: #555;
+}
+.mode-badge {
+    display: inline-block;
+    padding: 6px 12px;
+    border-radius: 20px;
+    font-size: 14px;
+    font-weight: bold;
+    margin-bottom: 20px;
+}
+.mode-badge.text-to-image {
+    background-color: #d4edda;
+    color: #155724;
+}
+.mode-badge.image-edit {
+    background-color: #cce5ff;
+    color: #004085;
+}
+.actions {
+    text-align: center;
+    margin-top: 30px;
+    display: flex;
+    flex-wrap: wrap;
+    justify-content: center;
+    gap: 15px;
+}
+.btn {
+    display: inline-block;
+    padding: 12px 24px;
+    text-decoration: none;
+    border-radius: 5px;
+    font-size: 16px;
+    cursor: pointer;
+    transition: all 0.3s;
+    border: none;
+}
+.btn-primary {
+    background-color: #007bff;
+    color: white;
+}
+.btn-primary:hover {
+    background-color: #0056b3;
+}
+.btn-success {
+    background-color: #28a745;
+    color: white;
+}
+.btn-success:hover {
+    background-color: #1e7e34;
+}
+.btn-warning {
+    background-color: #ffc107;
+    color: #212529;
+}
+.btn-warning:hover {
+    background-color: #e0a800;
+}
+.btn-secondary {
+    background-color: #6c757d;
+    color: white;
+}
+.btn-secondary:hover {
+    background-color: #545b62;
+}
+.btn-info {
+    background-color: #17a2b8;
+    color: white;
+}
+.btn-info:hover {
+    background-color: #138496;
+}
+.success-message {
+    text-align: center;
+    color: #28a745;
+    font-size: 18px;
+    margin-bottom: 20px;
+}
+.completion-animation {
+    text-align: center;
+    margin-bottom: 20px;
+}
+.checkmark {
+    width: 60px;
+    height: 60px;
+    border-radius: 50%;
+    background-color: #28a745;
+    margin: 0 auto 15px;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    animation: checkmark-scale 0.6s ease-in-out;
+}
+.checkmark::before {
+    content: '✓';
+    color: white;
+    font-size: 30px;
+    font-weight: bold;
+}
+@keyframes checkmark-scale {
+    0% { transform: scale(0); }
+    50% { transform: scale(1.2); }
+    100% { transform: scale(1); }
+}
+@media (max-width: 768px) {
+    .comparison-container {
+        grid-template-columns: 1fr;
+        gap: 20px;
+    }
+    .actions {
+        flex-direction: column;
+        align-items: center;
+    }
+    .btn {
+        width: 200px;
+    }
+}
+'''
+
+RESULT_JS = '''
+// 确保图片加载完成后显示
+const resultImg = document.getElementById('resultImg');
+const originalImg = document.getElementById('originalImg');
+
+resultImg.onload = function() {
+    console.log('结果图片加载成功');
+};
+resultImg.onerror = function() {
+    console.error('结果图片加载失败');
+    alert('图片加载失败，请刷新页面重试');
+};
+
+if (originalImg) {
+    originalImg.onload = function() {
+        console.log('原图加载成功');
+    };
+    originalImg.onerror = function() {
+        console.error('原图加载失败');
+    };
+}
+'''
+
+# 样式和脚本按内容指纹注册成静态资源，模板只在启动时编译一次
+static_assets = StaticAssets(prefix='/assets/')
+for name, content, mimetype in (
+        ('index.css', INDEX_CSS, 'text/css; charset=utf-8'),
+        ('index.js', INDEX_JS, 'application/javascript; charset=utf-8'),
+        ('result.css', RESULT_CSS, 'text/css; charset=utf-8'),
+        ('result.js', RESULT_JS, 'application/javascript; charset=utf-8')):
+    static_assets.add(name, content, mimetype)
+app.jinja_env.globals['asset_url'] = static_assets.url
+app.jinja_env.globals['fast_steps_threshold'] = model_registry.fast_steps_threshold
+index_template = app.jinja_env.from_string(INDEX_TEMPLATE)
+result_template = app.jinja_env.from_string(RESULT_TEMPLATE)
+# 相同参数的页面只渲染、压缩一次，FLUX_PAGE_CACHE=0 时不缓存
+page_cache = PageCache(capacity=int(os.environ.get('FLUX_PAGE_CACHE', 256)))
+# 带指纹的资源内容不会变，可以缓存一年
+ASSET_MAX_AGE = 365 * 24 * 3600
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_image_edit(input_image_path, prompt="Add a hat to the cat", guidance_scale=2.5):
-    """图片编辑处理函数"""
+class JobFailed(Exception):
+    """推理没有产出图片，消息直接返回给客户端"""
+    status_code = 500
+
+class OutOfMemory(JobFailed):
+    """推理过程中显存/内存不足"""
+    status_code = 503
+
+def process_image_edit(edit_pipe, input_image, prompt="Add a hat to the cat", guidance_scale=2.5, seed=None,
+                       max_area=1024 * 1024, max_sequence_length=512, callback_on_step_end=None):
+    """图片编辑处理函数，input_image 可以是文件路径或 PIL 图片"""
     try:
-        input_image = load_image(input_image_path)
-        processed_image = edit_pipe(
-            image=input_image,
-            prompt=prompt,
-            guidance_scale=guidance_scale
-        ).images[0]
+        input_image = load_image(input_image)
+        with generators.seeded(seed if seed is not None else new_seed()) as generator:
+            processed_image = edit_pipe(
+                image=input_image,
+                prompt=prompt,
+                guidance_scale=guidance_scale,
+                max_area=max_area,
+                max_sequence_length=max_sequence_length,
+                callback_on_step_end=callback_on_step_end,
+                generator=generator
+            ).images[0]
         return processed_image
     except Exception as e:
         print(f"图片编辑出错: {e}")
+        if is_oom(e):
+            raise OutOfMemory('显存不足，图片处理失败，请缩小图片或稍后重试')
         return None
 
-def generate_text_to_image(prompt, guidance_scale=3.5, num_inference_steps=50):
+def generate_text_to_image(text_to_image_pipe, prompt, guidance_scale=3.5, num_inference_steps=50, seed=None,
+                           max_sequence_length=512, callback_on_step_end=None):
     """文生图处理函数"""
     try:
-        image = text_to_image_pipe(
-            prompt,
-            height=512,
-            width=512,
-            guidance_scale=guidance_scale,
-            num_inference_steps=num_inference_steps,
-            max_sequence_length=512,
-            generator=torch.Generator("cpu").manual_seed(random.randint(1, 10000))
-        ).images[0]
+        with generators.seeded(seed if seed is not None else new_seed()) as generator:
+            image = text_to_image_pipe(
+                prompt,
+                height=512,
+                width=512,
+                guidance_scale=guidance_scale,
+                num_inference_steps=num_inference_steps,
+                max_sequence_length=max_sequence_length,
+                callback_on_step_end=callback_on_step_end,
+                generator=generator
+            ).images[0]
         return image
     except Exception as e:
         print(f"文生图出错: {e}")
+        if is_oom(e):
+            raise OutOfMemory('显存不足，图片生成失败，请减少推理步数或稍后重试')
         return None
 
+def output_filename_for(job):
+    """生成结果的文件名，继续编辑时文件名前面加 uuid 避免覆盖"""
+    if job.mode == 'text-to-image':
+        return f"generated_{uuid.uuid4()}.png"
+    original_image = job.params.get('original_image')
+    if not original_image:
+        return f"processed_{uuid.uuid4()}.png"
+    if job.params.get('continue_edit'):
+        base_name, ext = os.path.splitext(original_image)
+        return f"processed_{uuid.uuid4()}_{base_name}{ext}"
+    return f"processed_{original_image}"
+
+def execute_job(job, worker, encoded=None):
+    """
+    在 worker 线程中执行一个推理任务，结果中的 image 为 PIL 图片，output_image 为保存的文件名（不保存时为 None）。
+    encoded 为分阶段 worker 提前编码好的提示词。
+    """
+    params = job.params
+    if job.trace is not None and job.started_at:
+        # 被准入控制推迟过的任务从放回队列时算起
+        job.trace.add('queue_wait', job.metadata.pop('requeued_at', job.submitted_at), job.started_at,
+                      worker=worker.name)
+    if params.get('session_op') == 'decode':
+        return decode_session(job, worker)
+    # 准入控制：先估算内存再加载/使用模型，必要时排队或降级
+    width, height = job_input_size(job)
+    # 同一设备上除本任务外还占着内存的任务：其它 worker 的任务、等待解码的任务、放大精修
+    inflight = sum(w.inflight() for w in workers if w.device == worker.device) - 1 + upscaler.inflight(worker.device)
+    model = job_model(job)
+    with span(job.trace, 'admission') as attrs:
+        try:
+            plan = admission.decide(job, worker, width, height, model_id=model_registry[model].model_id,
+                                    text_tokens=admission_text_tokens(job, worker), inflight=inflight,
+                                    shared=tuple(shared_components(model_registry[model], dict(worker.pipes)) or ()))
+        except Deferred:
+            attrs['action'] = 'queue'
+            job.metadata['requeued_at'] = time.time()
+            raise
+        attrs['action'] = plan['action']
+    # 被推迟回队列的任务在索引里仍是排队中，通过准入后才记为开始
+    job_index.record_started(job)
+    if params.get('vae_tiling'):
+        # 重放：原任务分块解码过，分块和整体解码的结果不完全相同
+        plan['vae_tiling'] = True
+    with span(job.trace, 'model_load', model=model, warm=worker.is_warm(model)):
+        pipe = worker.get_pipe(model)
+    # offload 会在设备之间搬动文本编码器，期间编码线程不能借用这条流水线
+    with worker.exclusive(model) if plan['cpu_offload'] else contextlib.nullcontext():
+        revert = apply_plan(pipe, plan, worker.device, text_encoder_device=TEXT_ENCODER_DEVICE)
+        try:
+            if params.get('session_op') == 'edit':
+                return run_session_edit(job, worker, pipe)
+            result = run_pipeline(job, worker, pipe, plan, encoded)
+            if plan['cpu_offload'] and isinstance(result, Continuation):
+                # offload 的钩子在恢复前还要用来解码
+                result = result.fn()
+            return result
+        except OutOfMemory:
+            metrics.inc('oom_total', mode=job.mode)
+            raise
+        finally:
+            revert()
+
+def admission_text_tokens(job, worker):
+    """准入估算用的 T5 序列长度：已经选好的桶；模型已驻留时按提示词选；否则取模型的上限"""
+    length = job.metadata.get('max_sequence_length') or job.params.get('max_sequence_length')
+    if length:
+        return length
+    pipe = worker.pipes.get(job_model(job))
+    if pipe is not None:
+        return text_sequence_length(pipe, job)
+    return model_registry[job_model(job)].max_sequence_length
+
+def job_input_size(job):
+    """任务的输入分辨率，图片编辑时只读取图片头"""
+    if job.mode == 'text-to-image':
+        return 512, 512
+    if job.params.get('session_id'):
+        session = edit_sessions.get(job.params['session_id'])
+        return session.width, session.height
+    input_image = job.params.get('input_image')
+    if input_image is None:
+        with Image.open(os.path.join(app.config['UPLOAD_FOLDER'], job.params['original_image'])) as f:
+            return f.size
+    return input_image.size
+
+def run_pipeline(job, worker, pipe, plan, encoded=None):
+    """
+    按准入计划执行推理并按需保存结果。
+    支持分阶段的流水线在这里只做去噪，VAE 解码和保存放在返回的 Continuation 里，
+    分阶段 worker 会在解码线程里完成，普通 worker 直接接着执行。
+    """
+    params = job.params
+    device = worker.device
+    with span(job.trace, 'lora_activate', lora=params.get('lora')):
+        activate_lora(worker, job_model(job), pipe, params.get('lora'))
+    prompt = params['prompt']
+    seed = params.get('seed')
+    if seed is None:
+        seed = new_seed()
+    job.metadata['seed'] = seed
+    if not supports_stages(pipe):
+        return run_whole_pipeline(job, pipe, plan, seed)
+
+    stage_seconds = job.metadata.setdefault('stages', {})
+    if encoded is None:
+        start = time.perf_counter()
+        with span(job.trace, 'text_encode', stage='denoise') as attrs:
+            attrs['max_sequence_length'] = text_sequence_length(pipe, job)
+            encoded = encode_prompt(pipe, prompt, attrs['max_sequence_length'])
+        stage_seconds['encode'] = round(time.perf_counter() - start, 3)
+    if job.mode == 'text-to-image':
+        print(f"正在生成图片，提示词: {prompt}")
+        kwargs = dict(height=512, width=512, num_inference_steps=params['num_inference_steps'])
+        failure = '图片生成失败'
+    else:
+        input_image = params.get('input_image')
+        if input_image is None:
+            input_image = os.path.join(app.config['UPLOAD_FOLDER'], params['original_image'])
+            print(f"正在处理图片: {input_image}")
+        print(f"提示词: {prompt}")
+        with span(job.trace, 'input_load'):
+            kwargs = dict(image=load_image(input_image), max_area=plan['max_area'])
+        failure = '图片处理失败'
+    start = time.perf_counter()
+    try:
+        with span(job.trace, 'denoise'), generators.seeded(seed) as generator:
+            latents = denoise(pipe, encoded, device, guidance_scale=params['guidance_scale'], generator=generator,
+                              callback_on_step_end=step_callback(job.trace), **kwargs)
+    except Exception as e:
+        print(f"去噪出错: {e}")
+        if is_oom(e):
+            raise OutOfMemory(f'显存不足，{failure}，请稍后重试')
+        raise JobFailed(failure)
+    stage_seconds['denoise'] = round(time.perf_counter() - start, 3)
+    # 解码可能在解码线程里、不持有 worker.lock 时执行，pin 住流水线，期间不会被释放、offload 或切换 LoRA；
+    # offload 时本线程持有 exclusive，pin 不到，解码在这里直接完成
+    model = job_model(job)
+    pinned = worker.pin(model) is not None
+
+    def finish():
+        start = time.perf_counter()
+        try:
+            with span(job.trace, 'vae_decode', tiled=plan['vae_tiling']):
+                image = decode_latents(pipe, latents, tiled=plan['vae_tiling'])
+        except Exception as e:
+            print(f"VAE 解码出错: {e}")
+            if is_oom(e):
+                metrics.inc('oom_total', mode=job.mode)
+                raise OutOfMemory(f'显存不足，{failure}，请稍后重试')
+            raise JobFailed(failure)
+        finally:
+            if pinned:
+                worker.unpin(model)
+        stage_seconds['decode'] = round(time.perf_counter() - start, 3)
+        return build_result(job, image, seed, stage_seconds['denoise'] + stage_seconds['decode'], plan)
+    return Continuation(finish)
+
+def run_whole_pipeline(job, pipe, plan, seed):
+    """不支持分阶段的流水线（如替身流水线）整体调用一次"""
+    params = job.params
+    # 整体调用不能指定分块解码，如实记录，重放时才能得到相同的结果
+    plan['vae_tiling'] = False
+    prompt = params['prompt']
+    start = time.perf_counter()
+    if job.mode == 'text-to-image':
+        print(f"正在生成图片，提示词: {prompt}")
+        with span(job.trace, 'pipeline'):
+            image = generate_text_to_image(pipe, prompt, params['guidance_scale'], params['num_inference_steps'], seed,
+                                           max_sequence_length=text_sequence_length(pipe, job),
+                                           callback_on_step_end=step_callback(job.trace))
+        if image is None:
+            raise JobFailed('图片生成失败')
+    else:
+        input_image = params.get('input_image')
+        if input_image is None:
+            input_image = os.path.join(app.config['UPLOAD_FOLDER'], params['original_image'])
+            print(f"正在处理图片: {input_image}")
+        print(f"提示词: {prompt}")
+        with span(job.trace, 'pipeline'):
+            image = process_image_edit(pipe, input_image, prompt, params['guidance_scale'], seed,
+                                       max_area=plan['max_area'], max_sequence_length=text_sequence_length(pipe, job),
+                                       callback_on_step_end=step_callback(job.trace))
+        if image is None:
+            raise JobFailed('图片处理失败')
+    return build_result(job, image, seed, time.perf_counter() - start, plan)
+
+def generation_metadata(job, seed, plan=None):
+    """
+    重新生成同一张图需要的全部信息，写进任务记录和图片文件。
+    同一设备、同一 dtype 下按这些参数重放，确定性模式时结果逐像素一致。
+    """
+    params = job.params
+    spec = model_registry[job_model(job)]
+    generation = {
+        'seed': seed,
+        'mode': job.mode,
+        'prompt': params['prompt'],
+        'model': spec.name,
+        'model_id': spec.model_id,
+        'guidance_scale': params['guidance_scale'],
+        'num_inference_steps': params.get('num_inference_steps'),
+        'max_sequence_length': job.metadata.get('max_sequence_length'),
+        'lora': params.get('lora'),
+        'input_hash': params.get('input_hash'),
+        'session_id': params.get('session_id'),
+        'device': job.metadata.get('device'),
+        'dtype': str(MODEL_DTYPE).replace('torch.', ''),
+        'generator': generators.device,
+        'deterministic': DETERMINISTIC,
+        'torch': torch.__version__,
+        'diffusers': diffusers_version,
+    }
+    if plan is not None:
+        generation.update(max_area=plan['max_area'], vae_tiling=plan['vae_tiling'])
+    return generation
+
+def build_result(job, image, seed, inference_seconds, plan=None):
+    """组装返回结果并按需保存图片，生成元数据同时写进图片文件"""
+    params = job.params
+    if job.mode == 'text-to-image':
+        result = {'success': True, 'mode': 'text-to-image', 'prompt': params['prompt'], 'message': '图片生成完成',
+                  'steps': params['num_inference_steps']}
+    else:
+        result = {'success': True, 'mode': 'image-edit', 'prompt': params['prompt'], 'message': '图片处理完成'}
+        if params.get('original_image'):
+            result['original_image'] = params['original_image']
+
+    job.metadata['inference_seconds'] = round(inference_seconds, 3)
+    metrics.observe('inference_seconds', inference_seconds, mode=job.mode)
+    generation = job.metadata['generation'] = generation_metadata(job, seed, plan)
+    job.metadata['pixel_sha256'] = image_digest(image)
+    result.update(seed=seed, image=image, output_image=None, admission=job.metadata.get('admission'),
+                  model=params['model'], generation=generation)
+    if params.get('save', True):
+        # 保存生成的图片
+        output_filename = output_filename_for(job)
+        with span(job.trace, 'file_write', filename=output_filename):
+            save_image(image, os.path.join(app.config['OUTPUT_FOLDER'], output_filename), generation)
+        result['output_image'] = output_filename
+    return result
+
+def run_session_edit(job, worker, pipe):
+    """在会话的最新结果上编辑一步，结果只保留 latent，需要时再解码"""
+    params = job.params
+    session = edit_sessions.get(params['session_id'])
+    activate_lora(worker, job_model(job), pipe, params.get('lora'))
+    seed = params.get('seed')
+    if seed is None:
+        seed = new_seed()
+    job.metadata['seed'] = seed
+    start = time.perf_counter()
+    with session.lock:
+        print(f"会话 {session.id} 第 {session.step + 1} 步，提示词: {params['prompt']}")
+        try:
+            # 文本编码器可能在单独的设备上，先编码再把结果移到 transformer 所在设备
+            with span(job.trace, 'text_encode') as attrs:
+                attrs['max_sequence_length'] = text_sequence_length(pipe, job)
+                embeds = encode_prompt(pipe, params['prompt'], attrs['max_sequence_length'])
+            with span(job.trace, 'denoise', session_step=session.step + 1), generators.seeded(seed) as generator:
+                latents = edit_step(pipe, session, None, params['guidance_scale'], generator, worker.device,
+                                    callback_on_step_end=step_callback(job.trace),
+                                    **{key: value.to(worker.device) for key, value in embeds.items()})
+        except Exception as e:
+            print(f"会话编辑出错: {e}")
+            if is_oom(e):
+                raise OutOfMemory('显存不足，图片处理失败，请稍后重试')
+            raise JobFailed('图片处理失败')
+        session.push(latents, worker.device, params['prompt'], seed)
+        # 会话的结果依赖之前每一步的 latent，元数据只做记录，不能单独重放
+        generation = job.metadata['generation'] = dict(generation_metadata(job, seed), session_step=session.step)
+        result = dict(session.to_dict(), success=True, mode='image-edit', prompt=params['prompt'], seed=seed,
+                      message='图片处理完成', output_image=None, generation=generation)
+        if params.get('save'):
+            with span(job.trace, 'vae_decode'):
+                session.image = decode_latents(pipe, session.latents)
+            output_filename = f"session_{session.id}_{session.step}.png"
+            with span(job.trace, 'file_write', filename=output_filename):
+                save_image(session.image, os.path.join(app.config['OUTPUT_FOLDER'], output_filename), generation)
+            result['output_image'] = output_filename
+    job.metadata['inference_seconds'] = round(time.perf_counter() - start, 3)
+    metrics.observe('inference_seconds', time.perf_counter() - start, mode='session-edit')
+    edit_sessions.evict(keep=session.id)
+    return result
+
+def decode_session(job, worker):
+    """解码会话当前的 latent，结果缓存到下一次编辑"""
+    session = edit_sessions.get(job.params['session_id'])
+    with session.lock:
+        if session.image is None:
+            with span(job.trace, 'vae_decode'):
+                session.image = decode_latents(worker.get_pipe(job_model(job)), session.latents)
+        return {'image': session.image, 'step': session.step}
+
+# 连续编辑会话，保存在内存中，按 TTL 和总内存上限淘汰
+edit_sessions = SessionStore(
+    max_bytes=int(float(os.environ.get('FLUX_SESSION_MAX_MB', 2048)) * 2**20),
+    ttl=float(os.environ.get('FLUX_SESSION_TTL', 1800)),
+    max_history=int(os.environ.get('FLUX_SESSION_HISTORY', 10)),
+)
+
+# 相同请求（模式、提示词、种子、参数、输入图片哈希都相同）合并执行
+inflight_requests = SingleFlight()
+
+# 调度器：按客户端公平排队，interactive 优先于 batch
+scheduler = FairScheduler(
+    max_concurrent_per_client=int(os.environ.get('FLUX_MAX_CONCURRENT_PER_CLIENT', 1)),
+    max_queued_per_client=int(os.environ.get('FLUX_MAX_QUEUED_PER_CLIENT', 20)),
+    rate_per_minute=float(os.environ.get('FLUX_RATE_PER_MINUTE', 30)),
+    burst=int(os.environ.get('FLUX_RATE_BURST', 10)),
+    cheap_first=os.environ.get('FLUX_CHEAP_FIRST', '0') == '1',
+    cheap_cost=float(os.environ.get('FLUX_CHEAP_COST', 30)),
+    batch_max_wait=float(os.environ.get('FLUX_BATCH_MAX_WAIT', 300)),
+    max_skips=int(os.environ.get('FLUX_AFFINITY_MAX_SKIPS', 2)),
+)
+# 准入控制，FLUX_ADMISSION=0 时关闭
+admission = AdmissionController(
+    enabled=os.environ.get('FLUX_ADMISSION', '1') == '1',
+    max_wait=float(os.environ.get('FLUX_ADMISSION_MAX_WAIT', 30)),
+    reserve_bytes=int(float(os.environ.get('FLUX_MEMORY_RESERVE_GB', 0)) * 2**30),
+)
+
+# 任务和文件索引（SQLite），由后台线程异步写入
+job_index = JobIndex(
+    os.environ.get('FLUX_JOB_DB', 'jobs.db'),
+    output_folder=app.config['OUTPUT_FOLDER'],
+    upload_folder=app.config['UPLOAD_FOLDER'],
+)
+
+def index_finished(job):
+    """会话解码只是读取结果，不算新任务"""
+    if job.params.get('session_op') != 'decode':
+        job_index.record_finished(job)
+
+def job_affinity(job, worker):
+    """模型已驻留加 1 分，当前激活的 LoRA 相同再加 1 分，减少适配器来回切换；会话所在设备再加 2 分"""
+    pipe = worker.pipes.get(job_model(job))
+    if pipe is None:
+        return 0
+    score = 1 + int(lora_registry.active(pipe) == job.params.get('lora'))
+    # 会话的 latent 在哪个设备上就优先在哪个设备上继续
+    session_id = job.params.get('session_id')
+    if session_id:
+        try:
+            score += 2 * int(edit_sessions.get(session_id).device == worker.device)
+        except SessionNotFound:
+            pass
+    # 重放尽量回到原任务所在的设备
+    if job.params.get('device') == worker.device:
+        score += 4
+    return score
+
+# 输出放大：Lanczos 放大后可选用 FLUX img2img 按 tile 精修，在单独的线程里执行，不占用去噪 worker
+UPSCALE_MAX_FACTOR = int(os.environ.get('FLUX_UPSCALE_MAX_FACTOR', 4))
+UPSCALE_TILE = int(os.environ.get('FLUX_UPSCALE_TILE', 1024))
+UPSCALE_OVERLAP = int(os.environ.get('FLUX_UPSCALE_OVERLAP', 128))
+# 精修用的模型、强度和步数（实际去噪步数约为 steps × strength）
+REFINE_MODEL = os.environ.get('FLUX_REFINE_MODEL', 'flux-dev')
+REFINE_STRENGTH = float(os.environ.get('FLUX_REFINE_STRENGTH', 0.3))
+REFINE_STEPS = int(os.environ.get('FLUX_REFINE_STEPS', 20))
+if REFINE_MODEL not in model_registry:
+    raise ValueError(f"FLUX_REFINE_MODEL 为未知模型: {REFINE_MODEL}")
+
+class RefineSkipped(Exception):
+    """精修用的模型没有驻留或中途被释放，只返回放大结果"""
+
+def refine_image(job, pipe, worker, seed, image):
+    """
+    用 REFINE_MODEL 的组件按 tile 精修放大后的图片。
+    放大线程不加载也不释放模型：每次拿到锁后确认 pipe 仍驻留，被释放了就抛出 RefineSkipped。
+    """
+    spec = model_registry[REFINE_MODEL]
+    # 编辑任务的 LoRA 不适用于文生图模型；每个 tile 拿到锁后重新激活，期间别的任务可能切换过适配器
+    lora = job.params.get('lora') if job_model(job) == REFINE_MODEL else None
+
+    def check_resident():
+        if worker.pipes.get(REFINE_MODEL) is not pipe:
+            raise RefineSkipped(f'{REFINE_MODEL} 已被释放')
+
+    @contextlib.contextmanager
+    def hold():
+        with worker.lock:
+            check_resident()
+            activate_lora(worker, REFINE_MODEL, pipe, lora)
+            yield
+
+    with span(job.trace, 'refine', model=REFINE_MODEL, strength=REFINE_STRENGTH) as attrs:
+        def on_tile(i, total, start, end):
+            attrs['tiles'] = total
+            if job.trace is not None:
+                job.trace.add('refine_tile', start, end, tile=i)
+
+        with worker.lock:
+            check_resident()
+            length = sequence_bucket(pipe, job.params['prompt'], spec.max_sequence_length, SEQ_BUCKETS)
+            embeds = encode_prompt(pipe, job.params['prompt'], length)
+        return refine_tiles(img2img_for(pipe), image, embeds, worker.device, strength=REFINE_STRENGTH,
+                            num_inference_steps=REFINE_STEPS, guidance_scale=spec.guidance_scale or 3.5, seed=seed,
+                            tile=UPSCALE_TILE, overlap=UPSCALE_OVERLAP, hold=hold, on_tile=on_tile,
+                            generators=generators)
+
+def upscale_job(job, result, worker):
+    """
+    放大阶段，在放大线程里执行。精修只使用 worker 上已驻留的 REFINE_MODEL，没有驻留时只放大不精修，
+    每个 tile 单独持有 worker 的锁，tile 之间去噪 worker 可以继续执行别的任务。
+    放大失败时保留原始结果，并在 upscale_error 中说明。
+    """
+    params = job.params
+    factor = params['upscale']
+    image = result['image']
+    try:
+        with span(job.trace, 'upscale', factor=factor, width=image.width, height=image.height):
+            image = upscale_image(image, factor)
+        refined = False
+        if params.get('refine'):
+            # 在放大线程里加载模型会和去噪 worker 抢锁、挤掉它驻留的模型
+            with worker.lock:
+                pipe = worker.pipes.get(REFINE_MODEL)
+            try:
+                if pipe is None:
+                    raise RefineSkipped(f'{REFINE_MODEL} 没有驻留在 {worker.name}')
+                if not supports_stages(pipe):
+                    raise RefineSkipped('流水线不支持 img2img 精修')
+                image = refine_image(job, pipe, worker, result['seed'], image)
+                refined = True
+            except RefineSkipped as e:
+                print(f"[{worker.name}] {e}，只做放大")
+                job.metadata['refine_skipped'] = str(e)
+    except Exception as e:
+        print(f"放大出错: {e}")
+        metrics.inc('upscale_failed_total', mode=job.mode)
+        return dict(result, upscale_error='显存不足，已返回未放大的图片' if is_oom(e) else f'放大失败: {e}')
+
+    job.metadata['upscale'] = factor
+    job.metadata['refined'] = refined
+    generation = dict(result['generation'], upscale=factor, refine=refined)
+    if refined:
+        generation.update(refine_model=REFINE_MODEL, refine_strength=REFINE_STRENGTH, refine_steps=REFINE_STEPS,
+                          upscale_tile=UPSCALE_TILE, upscale_overlap=UPSCALE_OVERLAP)
+    job.metadata['generation'] = generation
+    job.metadata['pixel_sha256'] = image_digest(image)
+    result = dict(result, image=image, upscale=factor, refined=refined, base_output_image=result['output_image'],
+                  generation=generation)
+    if result['output_image']:
+        base_name, ext = os.path.splitext(result['output_image'])
+        output_filename = f"{base_name}_x{factor}{ext}"
+        with span(job.trace, 'file_write', filename=output_filename):
+            save_image(image, os.path.join(app.config['OUTPUT_FOLDER'], output_filename), generation)
+        result['output_image'] = output_filename
+    return result
+
+upscaler = UpscaleWorker(upscale_job, threads=int(os.environ.get('FLUX_UPSCALE_THREADS', 1)))
+upscaler.start()
+
+# 路由器在有空闲 worker 时从调度器取任务，优先分给已驻留对应模型、LoRA 相同的 worker
+router = JobRouter(scheduler, workers, execute_job, affinity=job_affinity, on_complete=index_finished,
+                   postprocess=upscaler)
+router.start()
+
+# 请求时间线：最近 FLUX_TRACE_BUFFER 个保存在内存中，超过 FLUX_SLOW_SECONDS 的写入慢请求日志
+tracer = Tracer(
+    capacity=int(os.environ.get('FLUX_TRACE_BUFFER', 500)),
+    slow_seconds=float(os.environ.get('FLUX_SLOW_SECONDS', 60)),
+    slow_log=os.environ.get('FLUX_SLOW_LOG') or None,
+)
+
+def current_trace():
+    """当前请求的时间线，第一次用到时创建；只有提交任务或编码图片的请求才会记录"""
+    if 'trace' not in g:
+        g.trace = tracer.start(request.path, method=request.method, client=client_identity())
+    return g.trace
+
+@app.after_request
+def finish_trace(response):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        tracer.finish(trace, status=response.status_code)
+        response.headers['X-Trace-Id'] = trace.id
+    return response
+
+def client_identity():
+    """优先用 API key 区分客户端，没有时用 IP"""
+    return request.headers.get('X-API-Key') or request.remote_addr or 'anonymous'
+
+class JobRequestError(Exception):
+    """请求参数有误，status_code 为返回的 HTTP 状态码"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def parse_job_request(save_upload=True):
+    """
+    从表单解析出 (mode, params, cost)，/process 和 /api/v1/generate 共用。
+    save_upload 为 False 时新上传的图片只在内存中解码，不写入 uploads/。
+    """
+    mode = request.form.get('mode', 'text-to-image')
+    prompt = request.form.get('prompt', '')
+    try:
+        guidance_scale = float(request.form.get('guidance_scale', 3.5))
+        upscale = int(request.form.get('upscale') or 1)
+    except ValueError:
+        raise JobRequestError('参数格式错误')
+    try:
+        seed = parse_seed(request.form.get('seed'))
+    except ValueError:
+        raise JobRequestError(f'种子必须是 0 到 {MAX_SEED} 之间的整数')
+    if not 1 <= upscale <= UPSCALE_MAX_FACTOR:
+        raise JobRequestError(f'放大倍数必须在 1 到 {UPSCALE_MAX_FACTOR} 之间')
+    params = {'prompt': prompt, 'guidance_scale': guidance_scale, 'seed': seed}
+    if upscale > 1:
+        params.update(upscale=upscale, refine=request.form.get('refine') == '1')
+
+    if mode == 'text-to-image':
+        # 文生图处理
+        try:
+            steps = request.form.get('num_inference_steps')
+            params['num_inference_steps'] = int(steps) if steps not in (None, '') else None
+        except ValueError:
+            raise JobRequestError('参数格式错误')
+        return mode, params, None
+
+    if mode != 'image-edit':
+        raise JobRequestError('无效的处理模式')
+
+    # 图片编辑处理
+    original_image = request.form.get('original_image')
+
+    # 如果是继续编辑模式
+    if original_image:
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], original_image)
+        if not os.path.exists(filepath):
+            raise JobRequestError('原始图片不存在')
+        params.update(original_image=original_image, continue_edit=True)
+        return mode, params, EDIT_JOB_COST
+
+    # 新上传模式
+    if 'file' not in request.files:
+        raise JobRequestError('没有选择文件')
+
+    file = request.files['file']
+
+    if file.filename == '':
+        raise JobRequestError('没有选择文件')
+
+    if not allowed_file(file.filename):
+        raise JobRequestError('不支持的文件格式')
+
+    trace = current_trace()
+    with trace.span('upload_read') as attrs:
+        data = file.read()
+        params['input_hash'] = hash_bytes(data)
+        attrs['bytes'] = len(data)
+    if save_upload:
+        # 保存上传的文件
+        filename = secure_filename(file.filename)
+        unique_filename = f"{uuid.uuid4()}_{filename}"
+        with trace.span('upload_save', filename=unique_filename):
+            with open(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename), 'wb') as f:
+                f.write(data)
+        params['original_image'] = unique_filename
+    else:
+        try:
+            with trace.span('upload_decode'):
+                params['input_image'] = Image.open(io.BytesIO(data)).convert('RGB')
+        except Exception:
+            raise JobRequestError('无法解析上传的图片')
+    return mode, params, EDIT_JOB_COST
+
+def route_model(mode, params, tier=None):
+    """按档位和步数选择模型，写入 params['model']；fast 档使用模型自己的步数和 guidance"""
+    spec, steps = model_registry.route(mode, tier, params.get('num_inference_steps'))
+    params['model'] = spec.name
+    if mode == 'text-to-image':
+        params['num_inference_steps'] = steps
+        if spec.guidance_scale is not None:
+            params['guidance_scale'] = spec.guidance_scale
+    return spec
+
+# 请求等待任务结果的上限（秒），包括排队、推理和放大
+JOB_WAIT_TIMEOUT = float(os.environ.get('FLUX_JOB_TIMEOUT', 1800))
+
+def run_job(mode, params, cost=None, coalesce=False, pinned=False):
+    """
+    提交任务并等待结果，返回 (任务, 结果或错误响应体, 状态码)。
+    coalesce 为 True 时相同指纹的请求合并到正在运行的任务上。
+    pinned 为 True 时沿用 params 中已有的 model 和 lora（重放），不按表单重新选择。
+    """
+    priority = request.form.get('priority', 'interactive')
+    if priority not in PRIORITY_CLASSES:
+        return None, {'error': f'无效的优先级: {priority}'}, 400
+    try:
+        params['lora'] = lora_registry.validate(params.get('lora') if pinned else request.form.get('lora'), mode)
+    except UnknownAdapter as e:
+        return None, {'error': str(e)}, 400
+    if pinned:
+        if params.get('model') not in model_registry:
+            return None, {'error': f"未知模型: {params.get('model')}"}, 409
+    else:
+        try:
+            route_model(mode, params, request.form.get('tier') or None)
+        except ValueError as e:
+            return None, {'error': str(e)}, 400
+    if not router.available:
+        return None, {'error': '模型加载失败，没有可用的 worker', 'startup': startup_report.to_dict()}, 503
+    trace = current_trace()
+    trace.attrs.update(mode=mode, model=params.get('model'), priority=priority)
+    created = []
+    def create():
+        job = Job(client_identity(), mode, params, priority=priority, cost=cost, trace=trace)
+        # 在提交给调度器之前入队，保证索引里先有任务再有开始 / 完成记录
+        if params.get('session_op') != 'decode':
+            job_index.record_submitted(job)
+        created.append(job)
+        return job
+
+    key = fingerprint(mode, params) if coalesce else None
+    try:
+        if key is None:
+            job = scheduler.submit(create())
+        else:
+            job, leader = inflight_requests.submit(key, create, scheduler.submit)
+    except SchedulerError as e:
+        for job in created:
+            job_index.record_discarded(job)
+        return None, {'error': str(e)}, e.status_code
+    trace.attrs['job_id'] = job.id
+    if job.trace is not trace:
+        # 合并到别的请求的任务上，执行过程记录在那个请求的时间线里
+        trace.attrs['coalesced_into'] = job.trace.id if job.trace is not None else None
+    try:
+        with trace.span('job_wait'):
+            result = job.wait(JOB_WAIT_TIMEOUT)
+    except TimeoutError:
+        # 还没开始的任务从队列里撤掉；合并进来的请求不替发起者撤销
+        if (key is None or leader) and scheduler.cancel(job):
+            index_finished(job)
+        metrics.inc('jobs_total', mode=mode, status='timeout')
+        return job, {'error': f'任务在 {JOB_WAIT_TIMEOUT:g} 秒内没有完成'}, 504
+    except SessionNotFound:
+        return job, {'error': '会话不存在或已过期'}, 404
+    except SchedulerError as e:
+        metrics.inc('jobs_total', mode=mode, status='failed')
+        return job, {'error': str(e)}, e.status_code
+    except (JobFailed, AdmissionRejected) as e:
+        metrics.inc('jobs_total', mode=mode, status='failed')
+        return job, {'error': str(e), 'admission': job.metadata.get('admission')}, e.status_code
+    except Exception as e:
+        metrics.inc('jobs_total', mode=mode, status='failed')
+        label = '生成图片' if mode == 'text-to-image' else '处理图片'
+        return job, {'error': f'{label}时出错: {str(e)}'}, 500
+    finally:
+        if key is not None and leader:
+            inflight_requests.forget(key, job)
+    metrics.inc('jobs_total', mode=mode, status='done')
+    return job, result, 200
+
+def compressed_response(content, max_age=None):
+    """
+    按 Accept-Encoding 返回预先压缩好的内容，If-None-Match 命中时返回 304。
+    max_age 为空时浏览器每次用 ETag 重新验证（页面），否则长期缓存（带指纹的资源）。
+    """
+    headers = {
+        'ETag': content.etag,
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': f'public, max-age={max_age}, immutable' if max_age else 'no-cache',
+    }
+    if content.etag.strip('"') in request.if_none_match:
+        return Response(status=304, headers=headers)
+    body, encoding = content.body(request.headers.get('Accept-Encoding'))
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(body, content_type=content.mimetype, headers=headers)
+
+def render_page(template, key, **context):
+    return compressed_response(page_cache.get(key, lambda: template.render(**context)))
+
+@app.route('/assets/<filename>')
+def static_asset(filename):
+    asset = static_assets.get(filename)
+    if asset is None:
+        return jsonify({'error': '资源不存在'}), 404
+    return compressed_response(asset, max_age=ASSET_MAX_AGE)
+
 @app.route('/')
 def index():
     mode = request.args.get('mode', 'text-to-image')
     prompt = request.args.get('prompt', '')
-    return render_template_string(INDEX_TEMPLATE, edit_mode=False, mode=mode, prompt=prompt)
+    return render_page(index_template, ('index', mode, prompt), edit_mode=False, mode=mode, prompt=prompt)
 
 @app.route('/edit/<original_filename>')
 def edit_image(original_filename):
     last_prompt = request.args.get('prompt', 'Add a hat to the cat')
-    return render_template_string(INDEX_TEMPLATE, 
-                                edit_mode=True, 
-                                original_image=original_filename,
-                                original_filename=original_filename.replace('_', ' ').replace('.jpg', '').replace('.png', ''),
-                                last_prompt=last_prompt)
+    return render_page(index_template, ('edit', original_filename, last_prompt),
+                       edit_mode=True,
+                       original_image=original_filename,
+                       original_filename=original_filename.replace('_', ' ').replace('.jpg', '').replace('.png', ''),
+                       last_prompt=last_prompt)
 
 @app.route('/process', methods=['POST'])
 def process_request():
-    mode = request.form.get('mode', 'text-to-image')
-    prompt = request.form.get('prompt', '')
-    guidance_scale = float(request.form.get('guidance_scale', 3.5))
-    
-    if mode == 'text-to-image':
-        # 文生图处理
-        num_inference_steps = int(request.form.get('num_inference_steps', 50))
-        
-        try:
-            print(f"正在生成图片，提示词: {prompt}")
-            generated_image = generate_text_to_image(prompt, guidance_scale, num_inference_steps)
-            
-            if generated_image is None:
-                return jsonify({'error': '图片生成失败'}), 500
-            
-            # 保存生成的图片
-            output_filename = f"generated_{uuid.uuid4()}.png"
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-            generated_image.save(output_path)
-            
-            return jsonify({
-                'success': True,
-                'output_image': output_filename,
-                'mode': 'text-to-image',
-                'prompt': prompt,
-                'message': '图片生成完成'
-            })
-            
-        except Exception as e:
-            return jsonify({'error': f'生成图片时出错: {str(e)}'}), 500
-    
-    elif mode == 'image-edit':
-        # 图片编辑处理
-        original_image = request.form.get('original_image')
-        
-        # 如果是继续编辑模式
-        if original_image:
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], original_image)
-            if not os.path.exists(filepath):
+    try:
+        mode, params, cost = parse_job_request()
+    except JobRequestError as e:
+        return jsonify({'error': str(e)}), e.status_code
+
+    _, body, status = run_job(mode, params, cost, coalesce=True)
+    if mode == 'image-edit' and not params.get('continue_edit'):
+        # 新上传的图片处理失败，或合并到了别的相同请求上（本次保存的文件没有用到）时删除
+        if status != 200 or body.get('original_image') != params['original_image']:
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], params['original_image'])
+            if os.path.exists(filepath):
+                os.remove(filepath)
+                job_index.record_deleted(params['original_image'])
+    if status != 200:
+        return jsonify(body), status
+    return jsonify({k: v for k, v in body.items() if k != 'image'}), status
+
+# 二进制接口支持的输出格式
+IMAGE_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def encode_image(image, fmt, quality=None, metadata=None):
+    """把 PIL 图片编码为 fmt 格式的字节，PNG / WebP 中写入生成元数据"""
+    with current_trace().span('image_encode', format=fmt):
+        return _encode_image(image, fmt, quality, metadata)
+
+def _encode_image(image, fmt, quality=None, metadata=None):
+    pil_format, _ = IMAGE_FORMATS[fmt]
+    buffer = io.BytesIO()
+    kwargs = metadata_save_kwargs(pil_format, metadata)
+    if quality is not None and pil_format != 'PNG':
+        kwargs['quality'] = quality
+    image.save(buffer, format=pil_format, **kwargs)
+    return buffer.getvalue()
+
+def result_headers(job, result):
+    """把生成元数据放进响应头"""
+    headers = {
+        'X-Job-Id': job.id,
+        'X-Mode': result['mode'],
+        'X-Seed': str(result['seed']),
+        'X-Prompt': quote(result['prompt']),
+        'X-Image-Width': str(result['image'].width),
+        'X-Image-Height': str(result['image'].height),
+        'X-Queue-Seconds': f"{job.started_at - job.submitted_at:.3f}",
+    }
+    for key, header in (('worker', 'X-Worker'), ('device', 'X-Device'), ('inference_seconds', 'X-Inference-Seconds'),
+                        ('max_sequence_length', 'X-Sequence-Length'), ('pixel_sha256', 'X-Pixel-Sha256')):
+        if key in job.metadata:
+            headers[header] = str(job.metadata[key])
+    for key, header in (('model', 'X-Model'), ('steps', 'X-Steps'), ('upscale', 'X-Upscale'),
+                        ('base_output_image', 'X-Base-Output-Image')):
+        if result.get(key) is not None:
+            headers[header] = str(result[key])
+    if result.get('output_image'):
+        headers['X-Output-Image'] = result['output_image']
+    if result.get('original_image'):
+        headers['X-Original-Image'] = result['original_image']
+    if result.get('upscale'):
+        headers['X-Refined'] = '1' if result.get('refined') else '0'
+    if result.get('upscale_error'):
+        headers['X-Upscale-Error'] = quote(result['upscale_error'])
+    if result.get('admission'):
+        headers['X-Admission'] = ','.join([result['admission']['action']] + result['admission']['degradations'])
+    return headers
+
+@app.route('/api/v1/generate', methods=['POST'])
+def api_generate():
+    """
+    一次调用直接返回编码后的图片，不需要 /process -> /result -> /output 的往返。
+    表单字段与 /process 相同，另外支持 format（png/webp/jpeg）、quality、
+    save（1 时写入 outputs/ 并在 X-Output-Image 中返回文件名）和 stream（1 时分块传输）。
+    """
+    fmt = request.form.get('format', 'png').lower()
+    if fmt not in IMAGE_FORMATS:
+        return jsonify({'error': f'不支持的输出格式: {fmt}'}), 400
+    save = request.form.get('save', os.environ.get('FLUX_API_SAVE_OUTPUTS', '0')) == '1'
+    try:
+        quality = int(request.form['quality']) if request.form.get('quality') else None
+        mode, params, cost = parse_job_request(save_upload=save)
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    except JobRequestError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    params['save'] = save
+
+    job, result, status = run_job(mode, params, cost, coalesce=True)
+    if status != 200:
+        return jsonify(result), status
+
+    return image_response(job, result, fmt, quality)
+
+def image_response(job, result, fmt, quality=None, **extra_headers):
+    """编码结果图片并返回，stream=1 时分块传输"""
+    # 在请求线程里编码，不占用推理 worker
+    data = encode_image(result['image'], fmt, quality, result.get('generation'))
+    headers = dict(result_headers(job, result), **extra_headers)
+    mimetype = IMAGE_FORMATS[fmt][1]
+    if request.form.get('stream') == '1':
+        def chunks():
+            for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+                yield data[offset:offset + STREAM_CHUNK_SIZE]
+        return Response(chunks(), mimetype=mimetype, headers=headers)
+    return Response(data, mimetype=mimetype, headers=headers)
+
+def session_response(session, status=200, **extra):
+    body = dict(session.to_dict(), image_url=f"/session/{session.id}/image?step={session.step}", **extra)
+    return jsonify(body), status
+
+@app.route('/session', methods=['POST'])
+def create_session():
+    """
+    创建连续编辑会话。上传 file，或用 image 指定 outputs/ 或 uploads/ 中已有的图片
+    （例如 /process 返回的 output_image），之后每次编辑都作用在最新结果上。
+    """
+    filename = request.form.get('image')
+    try:
+        if filename:
+            filename = secure_filename(filename)
+            for folder in (app.config['OUTPUT_FOLDER'], app.config['UPLOAD_FOLDER']):
+                path = os.path.join(folder, filename)
+                if os.path.exists(path):
+                    break
+            else:
                 return jsonify({'error': '原始图片不存在'}), 400
-            
-            try:
-                print(f"正在重新处理图片: {filepath}")
-                print(f"提示词: {prompt}")
-                processed_image = process_image_edit(filepath, prompt, guidance_scale)
-                
-                if processed_image is None:
-                    return jsonify({'error': '图片处理失败'}), 500
-                
-                # 保存处理后的图片
-                base_name = os.path.splitext(original_image)[0]
-                ext = os.path.splitext(original_image)[1]
-                output_filename = f"processed_{uuid.uuid4()}_{base_name}{ext}"
-                output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-                processed_image.save(output_path)
-                
-                return jsonify({
-                    'success': True,
-                    'output_image': output_filename,
-                    'original_image': original_image,
-                    'mode': 'image-edit',
-                    'prompt': prompt,
-                    'message': '图片处理完成'
-                })
-                
-            except Exception as e:
-                return jsonify({'error': f'处理图片时出错: {str(e)}'}), 500
-        
-        # 新上传模式
-        if 'file' not in request.files:
-            return jsonify({'error': '没有选择文件'}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({'error': '没有选择文件'}), 400
-        
-        if file and allowed_file(file.filename):
-            # 保存上传的文件
-            filename = secure_filename(file.filename)
-            unique_filename = f"{uuid.uuid4()}_{filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-            
-            try:
-                print(f"正在处理图片: {filepath}")
-                print(f"提示词: {prompt}")
-                processed_image = process_image_edit(filepath, prompt, guidance_scale)
-                
-                if processed_image is None:
-                    return jsonify({'error': '图片处理失败'}), 500
-                
-                # 保存处理后的图片
-                output_filename = f"processed_{unique_filename}"
-                output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-                processed_image.save(output_path)
-                
-                return jsonify({
-                    'success': True,
-                    'output_image': output_filename,
-                    'original_image': unique_filename,
-                    'mode': 'image-edit',
-                    'prompt': prompt,
-                    'message': '图片处理完成'
-                })
-                
-            except Exception as e:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                return jsonify({'error': f'处理图片时出错: {str(e)}'}), 500
-        
-        return jsonify({'error': '不支持的文件格式'}), 400
-    
-    return jsonify({'error': '无效的处理模式'}), 400
+            source = Image.open(path).convert('RGB')
+        else:
+            file = request.files.get('file')
+            if file is None or file.filename == '':
+                return jsonify({'error': '没有选择文件'}), 400
+            if not allowed_file(file.filename):
+                return jsonify({'error': '不支持的文件格式'}), 400
+            source = Image.open(io.BytesIO(file.read())).convert('RGB')
+    except Exception:
+        return jsonify({'error': '无法解析图片'}), 400
+    width, height = kontext_size(source)
+    session = edit_sessions.create(client_identity(), source.resize((width, height), Image.LANCZOS), width, height)
+    return session_response(session, 201)
+
+@app.route('/session/<session_id>', methods=['GET', 'DELETE'])
+def session_info(session_id):
+    try:
+        session = edit_sessions.get(session_id, client_identity())
+    except SessionNotFound:
+        return jsonify({'error': '会话不存在或已过期'}), 404
+    if request.method == 'DELETE':
+        edit_sessions.delete(session_id)
+        return jsonify({'success': True})
+    return session_response(session)
+
+@app.route('/session/<session_id>/edit', methods=['POST'])
+def session_edit(session_id):
+    """在会话最新结果上编辑一步，save=1 时同时解码并写入 outputs/"""
+    try:
+        edit_sessions.get(session_id, client_identity())
+        guidance_scale = float(request.form.get('guidance_scale', 2.5))
+        seed = parse_seed(request.form.get('seed'))
+    except SessionNotFound:
+        return jsonify({'error': '会话不存在或已过期'}), 404
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    _, body, status = run_job('image-edit', {
+        'session_id': session_id,
+        'session_op': 'edit',
+        'prompt': request.form.get('prompt', ''),
+        'guidance_scale': guidance_scale,
+        'seed': seed,
+        'save': request.form.get('save') == '1',
+    }, cost=EDIT_JOB_COST)
+    if status != 200:
+        return jsonify(body), status
+    body = dict(body, image_url=f"/session/{session_id}/image?step={body['step']}")
+    return jsonify(body), status
+
+@app.route('/session/<session_id>/undo', methods=['POST'])
+def session_undo(session_id):
+    """撤销最近一步编辑"""
+    try:
+        session = edit_sessions.get(session_id, client_identity())
+    except SessionNotFound:
+        return jsonify({'error': '会话不存在或已过期'}), 404
+    with session.lock:
+        if not session.undo():
+            return jsonify({'error': '没有可以撤销的步骤'}), 400
+    return session_response(session)
+
+@app.route('/session/<session_id>/image')
+def session_image(session_id):
+    """返回会话当前结果，没有缓存时在 worker 上解码"""
+    fmt = request.args.get('format', 'png').lower()
+    if fmt not in IMAGE_FORMATS:
+        return jsonify({'error': f'不支持的输出格式: {fmt}'}), 400
+    try:
+        session = edit_sessions.get(session_id, client_identity())
+    except SessionNotFound:
+        return jsonify({'error': '会话不存在或已过期'}), 404
+    image = session.image
+    if image is None:
+        _, body, status = run_job('image-edit', {
+            'session_id': session_id,
+            'session_op': 'decode',
+            'prompt': '',
+        }, cost=1)
+        if status != 200:
+            return jsonify(body), status
+        image = body['image']
+    return Response(encode_image(image, fmt), mimetype=IMAGE_FORMATS[fmt][1],
+                    headers={'X-Session-Step': str(session.step)})
+
+@app.route('/admin/sessions')
+def admin_sessions():
+    """查看编辑会话占用的内存"""
+    return jsonify(edit_sessions.stats())
+
+@app.route('/admin/queue')
+def admin_queue():
+    """查看调度队列状态"""
+    return jsonify(dict(scheduler.snapshot(), singleflight=inflight_requests.stats()))
+
+@app.route('/ready')
+def ready():
+    """就绪检查：至少一个 worker 加载完模型即可接收请求"""
+    ready_workers = [w.name for w in workers if w.ready.is_set()]
+    body = {
+        'ready': bool(ready_workers),
+        'ready_workers': ready_workers,
+        'failed_workers': {w.name: w.failed for w in workers if w.failed},
+        'total_workers': len(workers),
+        'startup': startup_report.to_dict(),
+    }
+    return jsonify(body), 200 if ready_workers else 503
+
+@app.route('/admin/startup')
+def admin_startup():
+    """启动耗时报告"""
+    return jsonify(startup_report.to_dict())
+
+@app.route('/admin/loras')
+def admin_loras():
+    """查看 LoRA 适配器及各流水线上的加载、融合缓存状态"""
+    return jsonify(lora_registry.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 格式的指标"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/workers')
+def admin_workers():
+    """查看各 worker 的驻留模型和利用率"""
+    return jsonify(router.stats())
+
+def history_item(item):
+    if item.get('output_image'):
+        item['output_url'] = url_for('output_file', filename=item['output_image'])
+        item['result_url'] = url_for('show_result', filename=item['output_image'])
+    return item
+
+@app.route('/api/v1/history')
+def job_history():
+    """
+    按提交时间倒序分页的任务历史，读取索引而不是扫描 outputs/ 目录。
+    参数：limit（最多 100）、cursor（上一页返回的 next_cursor）、client、mode、status、q（提示词包含的文字）
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        page = job_index.history(
+            limit=limit,
+            before=request.args.get('cursor') or None,
+            client_id=request.args.get('client') or None,
+            mode=request.args.get('mode') or None,
+            status=request.args.get('status') or None,
+            query=request.args.get('q') or None,
+        )
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    page['items'] = [history_item(item) for item in page['items']]
+    return jsonify(page)
+
+@app.route('/api/v1/jobs/<job_id>')
+def job_record(job_id):
+    """单个任务的记录、文件和由它继续编辑出的子任务，服务重启后仍然可以查询"""
+    record = job_index.get(job_id)
+    if record is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(history_item(record))
+
+def replay_params(record):
+    """从任务记录的生成元数据还原请求参数，返回 (mode, params)；不能重放时抛出 JobRequestError"""
+    generation = (record.get('metadata') or {}).get('generation')
+    if record['status'] != 'done':
+        raise JobRequestError('只能重放已成功完成的任务', 409)
+    if not generation:
+        raise JobRequestError('任务没有记录生成元数据，无法重放', 409)
+    if generation.get('session_id'):
+        raise JobRequestError('会话编辑依赖之前每一步的结果，不能单独重放', 409)
+    params = {key: generation.get(key) for key in ('prompt', 'seed', 'model', 'guidance_scale', 'num_inference_steps',
+                                                   'max_sequence_length', 'lora', 'max_area', 'vae_tiling')}
+    if generation.get('upscale'):
+        params.update(upscale=generation['upscale'], refine=generation.get('refine', False))
+    if record['mode'] == 'image-edit':
+        original_image = record.get('original_image')
+        path = os.path.join(app.config['UPLOAD_FOLDER'], original_image or '')
+        if not original_image or not os.path.exists(path):
+            raise JobRequestError('原任务的输入图片已不存在，无法重放', 409)
+        if generation.get('input_hash'):
+            with open(path, 'rb') as f:
+                if hash_bytes(f.read()) != generation['input_hash']:
+                    raise JobRequestError('原任务的输入图片已被修改，无法重放', 409)
+        params.update(original_image=original_image, continue_edit=True)
+    params.update(replay_of=record['id'], device=generation.get('device'), save=False)
+    return record['mode'], params
+
+@app.route('/api/v1/jobs/<job_id>/replay', methods=['POST'])
+def replay_job(job_id):
+    """
+    按任务记录里的生成元数据重新生成一次，不写入 outputs/。表单支持 format、quality、stream、priority。
+    X-Replay-Match 表示与原结果是否逐像素一致；设备或 dtype 不同时通常不一致，
+    X-Replay-Device / X-Replay-Dtype 给出原任务的设备和 dtype。
+    """
+    record = job_index.get(job_id)
+    if record is None:
+        return jsonify({'error': '任务不存在'}), 404
+    fmt = request.form.get('format', 'png').lower()
+    if fmt not in IMAGE_FORMATS:
+        return jsonify({'error': f'不支持的输出格式: {fmt}'}), 400
+    try:
+        quality = int(request.form['quality']) if request.form.get('quality') else None
+        mode, params = replay_params(record)
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    except JobRequestError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    generation = record['metadata']['generation']
+    job, result, status = run_job(mode, params, EDIT_JOB_COST if mode == 'image-edit' else None, pinned=True)
+    if status != 200:
+        return jsonify(result), status
+
+    expected = record['metadata'].get('pixel_sha256')
+    matched = 'unknown' if not expected else str(int(job.metadata.get('pixel_sha256') == expected))
+    metrics.inc('replays_total', match=matched)
+    return image_response(job, result, fmt, quality, **{
+        'X-Replay-Of': record['id'],
+        'X-Replay-Match': matched,
+        'X-Replay-Device': str(generation.get('device')),
+        'X-Replay-Dtype': str(generation.get('dtype')),
+    })
+
+@app.route('/admin/jobs')
+def admin_jobs():
+    """任务索引的记录数和写入队列"""
+    return jsonify(job_index.stats())
+
+@app.route('/admin/traces')
+def admin_traces():
+    """
+    最近请求的时间线摘要（按 span 名称汇总），最新的在前。
+    limit 为返回条数，min_seconds 只看总耗时超过该秒数的请求。
+    """
+    try:
+        limit = int(request.args.get('limit', 50))
+        min_seconds = float(request.args['min_seconds']) if request.args.get('min_seconds') else None
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    return jsonify(dict(tracer.stats(), traces=[t.summary() for t in tracer.recent(limit, min_seconds)]))
+
+@app.route('/admin/traces/export')
+def export_traces():
+    """导出缓冲区中的全部时间线；format=chrome 时输出 Chrome trace event 格式，可以在 Perfetto 中查看"""
+    traces = tracer.recent(tracer.capacity)
+    if request.args.get('format') == 'chrome':
+        body = {'traceEvents': [event for i, t in enumerate(traces) for event in t.chrome_events(pid=i + 1)]}
+    else:
+        body = [t.to_dict() for t in traces]
+    return Response(json.dumps(body, ensure_ascii=False), mimetype='application/json',
+                    headers={'Content-Disposition': 'attachment; filename=traces.json'})
+
+@app.route('/admin/traces/<trace_id>')
+def show_trace(trace_id):
+    """单个请求的完整时间线，trace_id 也可以是任务 id"""
+    trace = tracer.get(trace_id)
+    if trace is None:
+        return jsonify({'error': '时间线不存在或已被淘汰'}), 404
+    return jsonify(trace.to_dict())
+
+@app.route('/admin/upscale')
+def admin_upscale():
+    """查看放大队列和精修配置"""
+    return jsonify(dict(upscaler.stats(), max_factor=UPSCALE_MAX_FACTOR, tile=UPSCALE_TILE, overlap=UPSCALE_OVERLAP,
+                        refine_model=REFINE_MODEL, refine_strength=REFINE_STRENGTH, refine_steps=REFINE_STEPS))
+
+@app.route('/admin/pages')
+def admin_pages():
+    """查看页面缓存命中率和静态资源压缩后的大小"""
+    return jsonify({'page_cache': page_cache.stats(), 'assets': static_assets.stats()})
+
+@app.route('/admin/models')
+def admin_models():
+    """查看模型注册表、预加载列表和各 worker 上驻留的模型"""
+    return jsonify(dict(model_registry.to_dict(), preload=PRELOAD_MODELS,
+                        resident={worker.name: list(worker.pipes) for worker in workers}))
 
 @app.route('/result/<filename>')
 def show_result(filename):
-    mode = request.args.get('mode', 'image-edit')
-    original_filename = request.args.get('original')
-    prompt = request.args.get('prompt', '')
-    return render_template_string(RESULT_TEMPLATE, 
-                                filename=filename, 
-                                original_filename=original_filename,
-                                mode=mode,
-                                prompt=prompt)
+    # 优先用索引里的记录，查询参数只用于索引中没有的旧文件
+    record = job_index.find_by_output(filename) or {}
+    mode = record.get('mode') or request.args.get('mode', 'image-edit')
+    original_filename = record.get('original_image') or request.args.get('original')
+    prompt = record.get('prompt') or request.args.get('prompt', '')
+    return render_page(result_template, ('result', filename, original_filename, mode, prompt),
+                       filename=filename,
+                       original_filename=original_filename,
+                       mode=mode,
+                       prompt=prompt)
 
 @app.route('/output/<filename>')
 def output_file(filename):
@@ -1056,4 +2290,6 @@ def upload_file_serve(filename):
     return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
 
 if __name__ == '__main__':
+    # 使用 HTTP/1.1 以便客户端复用连接
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(debug=True, host='0.0.0.0', port=5120)
\ No newline at end of file
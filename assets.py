@@ -0,0 +1,130 @@
+"""
+前端页面的静态资源和渲染缓存：CSS / JS 启动时按内容哈希命名并预先 gzip / brotli 压缩，
+可以设置很长的缓存时间；相同参数渲染出的页面缓存在有界 LRU 中，页面访问不再重复渲染和压缩模板。
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 浏览器同时支持时优先 brotli
+ENCODINGS = ('br', 'gzip')
+
+
+def compress(data, level=9):
+    """返回 {编码: 字节}，None 为未压缩的原文；没有安装 brotli 时只有 gzip"""
+    encoded = {None: data, 'gzip': gzip.compress(data, compresslevel=level, mtime=0)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(data, quality=11 if level >= 9 else 5)
+    # 小文件压缩后可能更大，不值得
+    return {encoding: body for encoding, body in encoded.items() if encoding is None or len(body) < len(data)}
+
+
+def accepted_encoding(accept_encoding, available):
+    """按 Accept-Encoding 选择可用的压缩编码，都不接受时返回 None（原文）"""
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in available and (encoding in accepted or '*' in accepted):
+            return encoding
+    return None
+
+
+class Compressed:
+    """一份内容的各种压缩版本，etag 按原文计算"""
+
+    def __init__(self, data, mimetype, level=9):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.etag = f'"{self.digest[:20]}"'
+        self.encoded = compress(data, level)
+
+    def body(self, accept_encoding):
+        """返回 (字节, Content-Encoding 或 None)"""
+        encoding = accepted_encoding(accept_encoding, self.encoded)
+        return self.encoded[encoding], encoding
+
+    @property
+    def size(self):
+        return sum(len(body) for body in self.encoded.values())
+
+
+class StaticAssets:
+    """按内容指纹命名的静态资源，例如 index.css -> index.3f2a9c1b7d4e.css，内容变化时 URL 随之变化"""
+
+    def __init__(self, prefix='/assets/'):
+        self.prefix = prefix
+        self._by_name = {}
+        self._by_filename = {}
+
+    def add(self, name, content, mimetype):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        asset = Compressed(content, mimetype)
+        stem, ext = os.path.splitext(name)
+        filename = f"{stem}.{asset.digest[:12]}{ext}"
+        self._by_name[name] = filename
+        self._by_filename[filename] = asset
+        return self.url(name)
+
+    def url(self, name):
+        return self.prefix + self._by_name[name]
+
+    def get(self, filename):
+        return self._by_filename.get(filename)
+
+    def stats(self):
+        return {filename: {'mimetype': asset.mimetype,
+                           'bytes': {encoding or 'identity': len(body) for encoding, body in asset.encoded.items()}}
+                for filename, asset in self._by_filename.items()}
+
+
+class PageCache:
+    """渲染好的页面（已压缩）按参数缓存，超过 capacity 时淘汰最久未用的"""
+
+    def __init__(self, capacity=256, level=6):
+        self.capacity = capacity
+        self.level = level
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render, mimetype='text/html; charset=utf-8'):
+        """取出 key 对应的页面，没有时调用 render() 渲染并压缩"""
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                self.hits += 1
+                return page
+            self.misses += 1
+        # 渲染放在锁外，同一页面并发未命中时最多重复渲染几次
+        page = Compressed(render().encode('utf-8'), mimetype, self.level)
+        if self.capacity:
+            with self._lock:
+                self._pages[key] = page
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.capacity:
+                    self._pages.popitem(last=False)
+        return page
+
+    def stats(self):
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'pages': len(self._pages),
+                'bytes': sum(page.size for page in self._pages.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
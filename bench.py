@@ -0,0 +1,215 @@
+"""
+按质量档位对比文生图模型的延迟和内存占用，不启动 HTTP 服务：
+
+    python bench.py --device cuda:0 --runs 5
+    python bench.py --device mps --models flux-dev,flux-schnell --json bench.json
+    python bench.py --device cuda:0 --seq-buckets --prompts prompts.txt
+
+每个模型依次加载、预热一次、跑 --runs 次，再释放后测下一个，峰值显存互不影响。
+步数默认取注册表中各模型的推荐值（dev 50 步，schnell 4 步），--steps 可以统一覆盖。
+
+--seq-buckets 对每个提示词，用同一种子在能放下它的各个 T5 序列长度桶上生成，
+比较延迟，以及输出与最长桶（原来固定的 max_sequence_length）的像素差异。
+"""
+import argparse
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+from loader import StartupReport, load_pipeline
+from loadgen import percentile
+from models import build_registry
+from stages import SEQUENCE_BUCKETS, sequence_bucket
+from workers import release_device_memory
+
+
+def reset_peak_memory(device):
+    if device.startswith('cuda') and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def device_memory_bytes(device):
+    """设备上的峰值（CUDA）或当前（MPS）内存占用，CPU 返回 None"""
+    if device.startswith('cuda') and torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated(device)
+    if device.startswith('mps') and hasattr(torch, 'mps'):
+        return torch.mps.driver_allocated_memory()
+    return None
+
+
+def host_peak_rss_bytes():
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def synchronize(device):
+    if device.startswith('cuda') and torch.cuda.is_available():
+        torch.cuda.synchronize(device)
+    elif device.startswith('mps') and hasattr(torch, 'mps'):
+        torch.mps.synchronize()
+
+
+def guidance_for(spec):
+    return spec.guidance_scale if spec.guidance_scale is not None else 3.5
+
+
+def generate(pipe, spec, device, prompt, seed, steps, size, max_sequence_length=None):
+    """生成一张图并等待设备执行完，返回 (耗时, 图片)"""
+    start = time.perf_counter()
+    image = pipe(prompt, height=size, width=size, guidance_scale=guidance_for(spec), num_inference_steps=steps,
+                 max_sequence_length=max_sequence_length or spec.max_sequence_length,
+                 generator=torch.Generator("cpu").manual_seed(seed)).images[0]
+    synchronize(device)
+    return time.perf_counter() - start, image
+
+
+def image_difference(reference, image):
+    """两张图的平均绝对像素差（0-255）和 PSNR（dB，完全相同时为 None）"""
+    a = np.asarray(reference.convert('RGB'), dtype=np.float64)
+    b = np.asarray(image.convert('RGB'), dtype=np.float64)
+    mse = float(np.mean((a - b) ** 2))
+    return {
+        'mean_abs_diff': round(float(np.mean(np.abs(a - b))), 3),
+        'psnr': round(10 * np.log10(255 ** 2 / mse), 2) if mse else None,
+    }
+
+
+def load(spec, device, dtype):
+    start = time.perf_counter()
+    pipe = load_pipeline(spec.pipeline_cls, spec.model_id, device, dtype, report=StartupReport(), key=spec.name)
+    return pipe, time.perf_counter() - start
+
+
+def bench_model(spec, device, dtype, prompt, runs, steps=None, size=512):
+    steps = steps or spec.default_steps
+    reset_peak_memory(device)
+    pipe, load_seconds = load(spec, device, dtype)
+    weights_bytes = device_memory_bytes(device)
+
+    generate(pipe, spec, device, prompt, 0, steps, size)  # 预热
+    latencies = [generate(pipe, spec, device, prompt, seed, steps, size)[0] for seed in range(1, runs + 1)]
+    result = {
+        'model': spec.name,
+        'tier': spec.tier,
+        'steps': steps,
+        'guidance_scale': guidance_for(spec),
+        'max_sequence_length': spec.max_sequence_length,
+        'load_seconds': round(load_seconds, 3),
+        'mean': round(sum(latencies) / len(latencies), 3),
+        'p50': round(percentile(latencies, 0.5), 3),
+        'p95': round(percentile(latencies, 0.95), 3),
+        'seconds_per_step': round(sum(latencies) / len(latencies) / steps, 4),
+        'weights_bytes': weights_bytes,
+        'peak_device_bytes': device_memory_bytes(device),
+        'peak_host_rss_bytes': host_peak_rss_bytes(),
+    }
+    del pipe
+    release_device_memory(device)
+    return result
+
+
+def bench_sequence_buckets(spec, device, dtype, prompts, runs, steps=None, size=512, buckets=SEQUENCE_BUCKETS):
+    """
+    同一模型、同一种子下比较各序列长度桶：每个提示词从最长桶（参考输出）到能放下它的最小桶依次生成，
+    记录平均延迟和与参考输出的差异。FLUX 的 transformer 不屏蔽补齐的 token，所以桶不同输出会略有差别。
+    """
+    steps = steps or spec.default_steps
+    pipe, _ = load(spec, device, dtype)
+    generate(pipe, spec, device, prompts[0], 0, steps, size)  # 预热
+    results = []
+    for prompt in prompts:
+        needed = sequence_bucket(pipe, prompt, spec.max_sequence_length, buckets)
+        lengths = sorted({b for b in buckets if needed <= b <= spec.max_sequence_length} | {needed}, reverse=True)
+        reference = None
+        for length in lengths:
+            latencies = []
+            for _ in range(runs):
+                seconds, image = generate(pipe, spec, device, prompt, 0, steps, size, max_sequence_length=length)
+                latencies.append(seconds)
+            if reference is None:
+                reference, reference_latency = image, sum(latencies) / len(latencies)
+            mean = sum(latencies) / len(latencies)
+            results.append(dict(
+                model=spec.name, prompt=prompt, max_sequence_length=length, selected=length == needed,
+                mean=round(mean, 3), speedup=round(reference_latency / mean, 3),
+                **image_difference(reference, image),
+            ))
+    del pipe
+    release_device_memory(device)
+    return results
+
+
+def print_bucket_results(results):
+    print(f"{'model':<14}{'seq':>5}{'mean':>9}{'speedup':>9}{'abs diff':>10}{'psnr':>8}  prompt")
+    for r in results:
+        mark = '*' if r['selected'] else ' '
+        psnr = '-' if r['psnr'] is None else f"{r['psnr']:.1f}"
+        print(f"{r['model']:<14}{r['max_sequence_length']:>4}{mark}{r['mean']:>9.3f}{r['speedup']:>9.3f}"
+              f"{r['mean_abs_diff']:>10.3f}{psnr:>8}  {r['prompt'][:40]}")
+    print("* 为按提示词长度选出的桶；差异相对同一提示词最长的桶")
+
+
+def print_results(results):
+    def gb(value):
+        return '-' if value is None else f"{value / 2**30:.2f}"
+
+    print(f"{'model':<14}{'tier':<9}{'steps':>6}{'load':>8}{'mean':>9}{'p50':>9}{'p95':>9}{'s/step':>9}"
+          f"{'weights':>9}{'peak':>8}{'rss':>8}")
+    for r in results:
+        print(f"{r['model']:<14}{r['tier']:<9}{r['steps']:>6}{r['load_seconds']:>8.1f}{r['mean']:>9.3f}{r['p50']:>9.3f}"
+              f"{r['p95']:>9.3f}{r['seconds_per_step']:>9.4f}{gb(r['weights_bytes']):>9}"
+              f"{gb(r['peak_device_bytes']):>8}{gb(r['peak_host_rss_bytes']):>8}")
+    print("内存单位 GB；rss 为进程启动以来的峰值，按测试顺序累计")
+
+
+def main():
+    registry = build_registry()
+    parser = argparse.ArgumentParser(description="按质量档位对比文生图模型的延迟和内存")
+    parser.add_argument('--device', default='mps')
+    parser.add_argument('--dtype', default='bfloat16')
+    parser.add_argument('--models', default=','.join(name for name in registry
+                                                     if registry[name].mode == 'text-to-image'))
+    parser.add_argument('--prompt', default='A cat holding a sign that says hello world')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--steps', type=int, help='统一的推理步数，缺省时用各模型的推荐步数')
+    parser.add_argument('--size', type=int, default=512, help='输出图片边长')
+    parser.add_argument('--json', help='把结果写入该文件')
+    parser.add_argument('--seq-buckets', action='store_true', help='比较各 T5 序列长度桶的延迟和输出差异')
+    parser.add_argument('--prompts', help='--seq-buckets 使用的提示词文件，每行一个，缺省时用 --prompt')
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    if args.seq_buckets:
+        prompts = [args.prompt]
+        if args.prompts:
+            with open(args.prompts) as f:
+                prompts = [line.strip() for line in f if line.strip()]
+        results = []
+        for name in args.models.split(','):
+            spec = registry[name.strip()]
+            print(f"测试 {spec.name} 的序列长度桶...")
+            results += bench_sequence_buckets(spec, args.device, dtype, prompts, args.runs, args.steps, args.size)
+        print_bucket_results(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2, ensure_ascii=False)
+        return
+
+    results = []
+    for name in args.models.split(','):
+        spec = registry[name.strip()]
+        print(f"测试 {spec.name}（{spec.tier}）...")
+        results.append(bench_model(spec, args.device, dtype, args.prompt, args.runs, args.steps, args.size))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
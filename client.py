@@ -0,0 +1,160 @@
+"""
+FLUX 服务的 Python 客户端，调用 /api/v1/generate 直接拿到图片字节。
+
+每个线程保持一条 HTTP keep-alive 连接，批量调用时不用反复建立 TCP 连接：
+
+    client = FluxClient("http://127.0.0.1:5120", api_key="team-a")
+    result = client.generate("a cat wearing a hat", num_inference_steps=28, seed=42)
+    open("cat.png", "wb").write(result.data)
+    print(result.seed, result.metadata)
+"""
+import http.client
+import mimetypes
+import os
+import select
+import threading
+import uuid
+from urllib.parse import unquote, urlsplit
+
+
+class FluxClientError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class GenerateResult:
+    """生成结果：data 为编码后的图片字节，metadata 为服务端返回的 X-* 响应头"""
+
+    def __init__(self, data, content_type, headers):
+        self.data = data
+        self.content_type = content_type
+        self.metadata = {
+            key[2:].lower().replace('-', '_'): value
+            for key, value in headers.items() if key.lower().startswith('x-')
+        }
+        if 'prompt' in self.metadata:
+            self.metadata['prompt'] = unquote(self.metadata['prompt'])
+
+    @property
+    def job_id(self):
+        return self.metadata.get('job_id')
+
+    @property
+    def seed(self):
+        seed = self.metadata.get('seed')
+        return int(seed) if seed is not None else None
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.data)
+
+
+class FluxClient:
+    def __init__(self, base_url="http://127.0.0.1:5120", api_key=None, timeout=600):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme or 'http'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.api_key = api_key
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and connection_dropped(conn):
+            conn.close()
+            conn = None
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _post(self, path, fields, files=None):
+        body, content_type = encode_multipart(fields, files or {})
+        headers = {'Content-Type': content_type, 'Connection': 'keep-alive'}
+        if self.api_key:
+            headers['X-API-Key'] = self.api_key
+        # 复用的连接可能已被服务端关闭：发送请求时就失败说明服务端没有收到完整的请求，重连重试一次；
+        # 请求发出去之后再断开时服务端可能已经在生成，重试会产生重复的任务，直接抛出
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request('POST', path, body=body, headers=headers)
+            except (ConnectionResetError, BrokenPipeError):
+                self.close()
+                if attempt:
+                    raise
+                continue
+            try:
+                response = conn.getresponse()
+                data = response.read()
+            except Exception:
+                self.close()
+                raise
+            break
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        if response.status != 200:
+            raise FluxClientError(response.status, data.decode('utf-8', 'replace'))
+        return GenerateResult(data, response.getheader('Content-Type'), dict(response.getheaders()))
+
+    def generate(self, prompt, guidance_scale=3.5, num_inference_steps=50, seed=None, **options):
+        """文生图，options 可以包含 format、quality、save、stream、lora、priority"""
+        fields = dict(mode='text-to-image', prompt=prompt, guidance_scale=guidance_scale,
+                      num_inference_steps=num_inference_steps, seed=seed, **options)
+        return self._post('/api/v1/generate', fields)
+
+    def edit(self, image, prompt, guidance_scale=2.5, seed=None, filename=None, **options):
+        """编辑图片，image 可以是文件路径或图片字节"""
+        if isinstance(image, (str, os.PathLike)):
+            filename = filename or os.path.basename(image)
+            with open(image, 'rb') as f:
+                image = f.read()
+        fields = dict(mode='image-edit', prompt=prompt, guidance_scale=guidance_scale, seed=seed, **options)
+        return self._post('/api/v1/generate', fields, {'file': (filename or 'image.png', image)})
+
+    def edit_existing(self, original_image, prompt, guidance_scale=2.5, seed=None, **options):
+        """继续编辑服务端 uploads/ 中已有的图片"""
+        fields = dict(mode='image-edit', prompt=prompt, guidance_scale=guidance_scale, seed=seed,
+                      original_image=original_image, **options)
+        return self._post('/api/v1/generate', fields)
+
+    def replay(self, job_id, **options):
+        """按服务端记录的生成元数据重新生成 job_id，metadata['replay_match'] 为 '1' 时与原结果逐像素一致"""
+        return self._post(f'/api/v1/jobs/{job_id}/replay', options)
+
+
+def connection_dropped(conn):
+    """空闲的 keep-alive 连接变得可读，说明服务端已经关闭了它（或发来了不该有的数据），不能再复用"""
+    if conn.sock is None:
+        return False
+    readable, _, _ = select.select([conn.sock], [], [], 0)
+    return bool(readable)
+
+
+def encode_multipart(fields, files):
+    """编码 multipart/form-data 请求体，files 为 {字段名: (文件名, 字节)}"""
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = int(value)
+        lines.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        lines.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    lines.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(lines), f'multipart/form-data; boundary={boundary}'
@@ -0,0 +1,337 @@
+"""
+SQLite 任务和文件索引：记录每个任务的提示词、参数、种子、耗时、输入输出文件、哈希和编辑链（parent_id）。
+写入由后台线程批量完成，worker 只把记录放进队列；读取用每个线程自己的连接（WAL 模式下读写互不阻塞）。
+"""
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    client_id TEXT,
+    mode TEXT,
+    model TEXT,
+    status TEXT,
+    priority TEXT,
+    prompt TEXT,
+    params TEXT,
+    seed INTEGER,
+    original_image TEXT,
+    output_image TEXT,
+    input_hash TEXT,
+    session_id TEXT,
+    parent_id TEXT,
+    submitted_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    wait_seconds REAL,
+    run_seconds REAL,
+    inference_seconds REAL,
+    error TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted_at);
+CREATE INDEX IF NOT EXISTS jobs_client ON jobs (client_id, submitted_at);
+CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, submitted_at);
+CREATE INDEX IF NOT EXISTS jobs_original ON jobs (original_image);
+CREATE INDEX IF NOT EXISTS jobs_output ON jobs (output_image);
+
+CREATE TABLE IF NOT EXISTS assets (
+    filename TEXT PRIMARY KEY,
+    kind TEXT,
+    job_id TEXT,
+    sha256 TEXT,
+    bytes INTEGER,
+    width INTEGER,
+    height INTEGER,
+    created_at REAL,
+    deleted_at REAL
+);
+CREATE INDEX IF NOT EXISTS assets_job ON assets (job_id);
+CREATE INDEX IF NOT EXISTS assets_sha256 ON assets (sha256);
+'''
+
+def _json(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _plain(params):
+    """只保留能序列化的参数（上传时内存中的 PIL 图片等不写入）"""
+    return {k: v for k, v in params.items() if isinstance(v, (str, int, float, bool, type(None)))}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class JobIndex:
+    def __init__(self, path, output_folder='outputs', upload_folder='uploads', batch_size=256):
+        self.path = path
+        self.folders = {'output': output_folder, 'upload': upload_folder}
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self.written = 0
+        self.errors = 0
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # 上次进程退出时还没完成的任务不会再完成
+            interrupted = conn.execute(
+                "UPDATE jobs SET status = 'interrupted' WHERE status IN ('queued', 'running')").rowcount
+        if interrupted:
+            print(f"任务索引: {interrupted} 个未完成的任务标记为 interrupted")
+        threading.Thread(target=self._writer, name='job-index', daemon=True).start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # ---- 写入：只入队，由后台线程批量提交 ----
+
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            ops = [self._queue.get()]
+            while len(ops) < self.batch_size:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # 读文件算哈希等准备工作放在事务外面
+            prepared = []
+            for write, prepare in ops:
+                try:
+                    prepared.append((write, prepare() if prepare else None))
+                except Exception as e:
+                    self.errors += 1
+                    print(f"任务索引准备写入出错: {e}")
+            written = 0
+            try:
+                with conn:
+                    conn.execute('BEGIN')
+                    for write, value in prepared:
+                        # 每条写入一个保存点，出错时只回滚这一条，同一批的其它记录照常提交
+                        conn.execute('SAVEPOINT op')
+                        try:
+                            write(conn, value)
+                        except Exception as e:
+                            conn.execute('ROLLBACK TO op')
+                            self.errors += 1
+                            print(f"任务索引写入出错: {e}")
+                        else:
+                            written += 1
+                        conn.execute('RELEASE op')
+                self.written += written
+            except Exception as e:
+                self.errors += 1
+                print(f"任务索引写入出错: {e}")
+            for _ in ops:
+                self._queue.task_done()
+
+    def _submit(self, write, prepare=None):
+        """在写线程里执行 write(conn, prepare())，prepare 在事务外执行"""
+        self._queue.put((write, prepare))
+
+    def flush(self):
+        """等待已入队的记录全部写入"""
+        self._queue.join()
+
+    def record_submitted(self, job):
+        params = job.params
+        row = {
+            'id': job.id,
+            'client_id': job.client_id,
+            'mode': job.mode,
+            'model': params.get('model'),
+            'status': job.status,
+            'priority': job.priority,
+            'prompt': params.get('prompt'),
+            'params': _json(_plain(params)),
+            'seed': params.get('seed'),
+            'original_image': params.get('original_image'),
+            'input_hash': params.get('input_hash'),
+            'session_id': params.get('session_id'),
+            'submitted_at': job.submitted_at,
+        }
+        upload = params.get('original_image') if params.get('input_hash') else None
+
+        def write(conn, _):
+            row['parent_id'] = self._find_parent(conn, row)
+            conn.execute(f"INSERT OR REPLACE INTO jobs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                         list(row.values()))
+            if upload:
+                self._insert_asset(conn, upload, 'upload', job.id, job.submitted_at, params['input_hash'])
+        self._submit(write)
+
+    def record_started(self, job):
+        started_at = job.started_at
+        self._submit(lambda conn, _: conn.execute(
+            "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (started_at, job.id)))
+
+    def record_finished(self, job):
+        """任务结束（完成或失败）时由 worker 调用"""
+        info = job.to_dict()
+        result = job.result if isinstance(job.result, dict) else {}
+        output = result.get('output_image')
+        image = result.get('image')
+        size = (image.width, image.height) if image is not None else (None, None)
+        values = {
+            'status': job.status,
+            'seed': result.get('seed', job.metadata.get('seed')),
+            'output_image': output,
+            'started_at': job.started_at,
+            'finished_at': job.finished_at,
+            'wait_seconds': info['wait_seconds'],
+            'run_seconds': info['run_seconds'],
+            'inference_seconds': job.metadata.get('inference_seconds'),
+            'error': str(job.error) if job.error is not None else None,
+            'metadata': _json(job.metadata),
+        }
+
+        def prepare():
+            path = os.path.join(self.folders['output'], output or '')
+            if output and os.path.exists(path):
+                return file_sha256(path), os.path.getsize(path)
+            return None, None
+
+        # 放大后 output_image 为放大结果，放大前的原始输出也记一条
+        base_output = result.get('base_output_image')
+
+        def write(conn, digest):
+            conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in values)} WHERE id = ?",
+                         list(values.values()) + [job.id])
+            if output:
+                self._insert_asset(conn, output, 'output', job.id, job.finished_at, *digest, *size)
+            if base_output:
+                self._insert_asset(conn, base_output, 'output', job.id, job.finished_at)
+        self._submit(write, prepare)
+
+    def record_discarded(self, job):
+        """任务没能进入队列（限流、队列已满），不保留记录"""
+        def write(conn, _):
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+            conn.execute("DELETE FROM assets WHERE job_id = ?", (job.id,))
+        self._submit(write)
+
+    def record_deleted(self, filename):
+        """文件被删除（例如合并请求多保存的上传文件）"""
+        deleted_at = time.time()
+        self._submit(lambda conn, _: conn.execute(
+            "UPDATE assets SET deleted_at = ? WHERE filename = ?", (deleted_at, filename)))
+
+    def _insert_asset(self, conn, filename, kind, job_id, created_at, sha256=None, nbytes=None, width=None,
+                      height=None):
+        if nbytes is None:
+            path = os.path.join(self.folders[kind], filename)
+            nbytes = os.path.getsize(path) if os.path.exists(path) else None
+        conn.execute(
+            "INSERT OR IGNORE INTO assets (filename, kind, job_id, sha256, bytes, width, height, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (filename, kind, job_id, sha256, nbytes, width, height, created_at))
+
+    @staticmethod
+    def _find_parent(conn, row):
+        """
+        编辑链：会话中的上一步；编辑的输入是某个任务的输出时指向那个任务；
+        继续编辑同一张上传图片时指向第一次上传它的任务。
+        """
+        if row['session_id']:
+            parent = conn.execute(
+                "SELECT id FROM jobs WHERE session_id = ? AND submitted_at < ? ORDER BY submitted_at DESC LIMIT 1",
+                (row['session_id'], row['submitted_at'])).fetchone()
+            if parent:
+                return parent['id']
+        source = row['original_image']
+        if not source:
+            return None
+        parent = conn.execute("SELECT id FROM jobs WHERE output_image = ? LIMIT 1", (source,)).fetchone()
+        if parent is None:
+            parent = conn.execute(
+                "SELECT id FROM jobs WHERE original_image = ? AND id != ? ORDER BY submitted_at LIMIT 1",
+                (source, row['id'])).fetchone()
+        return parent['id'] if parent else None
+
+    # ---- 读取 ----
+
+    @staticmethod
+    def _row(row):
+        item = dict(row)
+        for key in ('params', 'metadata'):
+            if item.get(key):
+                item[key] = json.loads(item[key])
+        return item
+
+    def get(self, job_id):
+        row = self._reader().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        item = self._row(row)
+        item['children'] = [r['id'] for r in self._reader().execute(
+            "SELECT id FROM jobs WHERE parent_id = ? ORDER BY submitted_at", (job_id,))]
+        item['assets'] = [dict(r) for r in self._reader().execute(
+            "SELECT * FROM assets WHERE job_id = ? ORDER BY created_at", (job_id,))]
+        return item
+
+    def find_by_output(self, filename):
+        row = self._reader().execute("SELECT * FROM jobs WHERE output_image = ?", (filename,)).fetchone()
+        return self._row(row) if row else None
+
+    def history(self, limit=20, before=None, client_id=None, mode=None, status=None, query=None):
+        """
+        按提交时间倒序分页，before 为上一页最后一条的 cursor（submitted_at:id），
+        用索引定位下一页而不是 OFFSET，翻到很后面也不会变慢。
+        """
+        where, args = [], []
+        if before:
+            submitted_at, _, job_id = before.partition(':')
+            where.append("(submitted_at < ? OR (submitted_at = ? AND id < ?))")
+            args += [float(submitted_at), float(submitted_at), job_id]
+        for column, value in (('client_id', client_id), ('mode', mode), ('status', status)):
+            if value:
+                where.append(f"{column} = ?")
+                args.append(value)
+        if query:
+            # 提示词里的 % 和 _ 按字面匹配
+            escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            where.append("prompt LIKE ? ESCAPE '\\'")
+            args.append(f"%{escaped}%")
+        sql = "SELECT * FROM jobs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY submitted_at DESC, id DESC LIMIT ?"
+        rows = [self._row(r) for r in self._reader().execute(sql, args + [limit + 1])]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['submitted_at']!r}:{rows[-1]['id']}"
+        return {'items': rows, 'next_cursor': next_cursor}
+
+    def stats(self):
+        conn = self._reader()
+        return {
+            'path': self.path,
+            'jobs': conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0],
+            'assets': conn.execute("SELECT COUNT(*) FROM assets").fetchone()[0],
+            'pending_writes': self._queue.qsize(),
+            'written': self.written,
+            'errors': self.errors,
+        }
@@ -0,0 +1,163 @@
+"""模型冷启动加载：从本地快照按组件并行加载，记录各组件耗时"""
+import importlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+# 启动报告中使用的组件名称
+COMPONENT_LABELS = {
+    'transformer': 'transformer',
+    'text_encoder_2': 'T5',
+    'text_encoder': 'CLIP',
+    'vae': 'VAE',
+}
+
+
+def resolve_snapshot(model_id, allow_download=False):
+    """
+    把模型 id 解析成本地快照目录。
+    默认只用本地缓存（local_files_only），启动时不访问 Hub；缓存中没有时报错提示先下载。
+    """
+    if os.path.isdir(model_id):
+        return model_id
+    from huggingface_hub import snapshot_download
+    try:
+        return snapshot_download(model_id, local_files_only=True)
+    except Exception:
+        if not allow_download:
+            raise RuntimeError(
+                f"本地没有 {model_id} 的快照，请先运行 `huggingface-cli download {model_id}`，"
+                f"或设置 FLUX_ALLOW_DOWNLOAD=1"
+            )
+    return snapshot_download(model_id)
+
+
+def _component_class(library, class_name):
+    return getattr(importlib.import_module(library), class_name)
+
+
+def _synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize(device)
+    elif device.startswith('mps'):
+        torch.mps.synchronize()
+
+
+class StartupReport:
+    """收集启动过程中每个 (worker, 模式) 各组件的加载和设备迁移耗时"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.entries = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, stage, component, seconds):
+        label = COMPONENT_LABELS.get(component, component)
+        with self._lock:
+            entry = self.entries.setdefault(key, {'load': {}, 'to_device': {}})
+            entry[stage][label] = round(entry[stage].get(label, 0) + seconds, 3)
+
+    def fail(self, key, error):
+        with self._lock:
+            self.errors[key] = str(error)
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            entries = {
+                key: dict(value, total=round(sum(value['load'].values()) + sum(value['to_device'].values()), 3))
+                for key, value in self.entries.items()
+            }
+            end = self.finished_at or time.time()
+            return {
+                'finished': self.finished_at is not None,
+                'wall_seconds': round(end - self.started_at, 3),
+                'pipelines': entries,
+                'errors': dict(self.errors),
+            }
+
+    def print_summary(self):
+        report = self.to_dict()
+        print(f"模型加载耗时 {report['wall_seconds']}s")
+        for key, entry in report['pipelines'].items():
+            load = ', '.join(f"{name} {sec}s" for name, sec in entry['load'].items())
+            to_device = ', '.join(f"{name} {sec}s" for name, sec in entry['to_device'].items())
+            print(f"  {key}: 加载 [{load}] 迁移 [{to_device}] 合计 {entry['total']}s")
+        for key, error in report['errors'].items():
+            print(f"  {key}: 加载失败 {error}")
+
+
+def load_pipeline(pipeline_cls, model_id, device, dtype, report=None, key=None, allow_download=False,
+                  max_workers=4, shared=None):
+    """
+    按组件并行加载流水线。
+    safetensors 权重通过内存映射读取（low_cpu_mem_usage 不再先随机初始化一遍权重），
+    所有 from_pretrained 都带 local_files_only，不做任何网络检查。
+    shared 为 {组件名: 已在 device 上的组件}，这些组件直接复用，不再加载和迁移。
+    """
+    shared = shared or {}
+    key = key or f"{model_id}@{device}"
+    path = resolve_snapshot(model_id, allow_download)
+    with open(os.path.join(path, 'model_index.json')) as f:
+        index = json.load(f)
+    specs = {
+        name: value for name, value in index.items()
+        if not name.startswith('_') and isinstance(value, list) and value[0] is not None and name not in shared
+    }
+
+    def load_component(name):
+        library, class_name = specs[name]
+        cls = _component_class(library, class_name)
+        kwargs = {'subfolder': name, 'local_files_only': True}
+        if issubclass(cls, torch.nn.Module):
+            kwargs.update(torch_dtype=dtype, use_safetensors=True, low_cpu_mem_usage=True)
+        start = time.perf_counter()
+        component = cls.from_pretrained(path, **kwargs)
+        if report is not None:
+            report.record(key, 'load', name, time.perf_counter() - start)
+        return name, component
+
+    # 大组件放在前面，尽早开始读取
+    order = sorted(specs, key=lambda name: name not in COMPONENT_LABELS)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='load') as pool:
+        components = dict(pool.map(load_component, order))
+    optional = {name: None for name in getattr(pipeline_cls, '_optional_components', [])
+                if name not in components and name not in shared}
+    pipe = pipeline_cls(**components, **shared, **optional)
+
+    for name, component in components.items():
+        if isinstance(component, torch.nn.Module):
+            start = time.perf_counter()
+            component.to(device)
+            _synchronize(device)
+            if report is not None:
+                report.record(key, 'to_device', name, time.perf_counter() - start)
+    return pipe
+
+
+def load_all(jobs, max_parallel=2):
+    """
+    并行执行多个加载任务，jobs 为 [(key, fn)]。
+    max_parallel 限制同时加载的流水线数量，避免磁盘和内存带宽被打满。
+    返回 {key: 异常}，全部成功时为空。
+    """
+    errors = {}
+
+    def run(item):
+        key, fn = item
+        try:
+            fn()
+        except Exception as e:
+            errors[key] = e
+
+    with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='startup') as pool:
+        list(pool.map(run, jobs))
+    return errors
@@ -0,0 +1,355 @@
+"""
+FLUX 服务压测工具：按合成或录制的请求轨迹回放 /process、/output、/upload，
+统计延迟分位数、错误率和随时间变化的吞吐。
+
+配合替身流水线可以在没有模型权重的机器上运行：
+
+    FLUX_STUB_PIPELINES=1 FLUX_DEVICES=cpu,cpu FLUX_RATE_PER_MINUTE=0 python app1.py
+    python loadgen.py --url http://127.0.0.1:5120 --rate 2 --duration 60 --mix t2i=6,edit=3,continue=1
+
+轨迹文件为 JSON Lines，每行一个请求：
+    {"t": 0.0, "kind": "t2i", "prompt": "a cat", "steps": 28, "client": "user-1", "seed": 42}
+    {"t": 1.5, "kind": "edit", "prompt": "add a hat", "image": "cat.png"}
+    {"t": 3.0, "kind": "continue", "prompt": "make it red"}
+--record 可以把本次生成的合成轨迹保存下来，之后用 --trace 复现。
+合成轨迹的每个请求都带种子，否则服务端会把同时在途的相同请求合并执行，测出的负载偏低。
+
+延迟按两种口径统计：latency 从请求实际发出时算起；response 从轨迹中计划发出的时间算起，
+包含在客户端排队（--concurrency 用满）耽误的时间，避免协同遗漏（coordinated omission）。
+dispatch_delay 是实际发出比计划晚了多久。
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from client import connection_dropped, encode_multipart
+
+KINDS = ('t2i', 'edit', 'continue')
+PROMPTS = [
+    "a cat wearing a hat", "a watercolor painting of mountains at sunrise", "a futuristic city at night",
+    "a bowl of ramen, studio lighting", "portrait of an old fisherman, film grain", "a red fox in the snow",
+]
+EDIT_PROMPTS = ["Add a hat to the cat", "make it night time", "turn it into a pencil sketch", "add snow"]
+
+
+def synthetic_png(width=256, height=256, seed=0):
+    """不依赖 PIL 生成一张渐变 PNG，作为编辑请求的上传图片"""
+    rng = random.Random(seed)
+    r0, g0, b0 = rng.randrange(256), rng.randrange(256), rng.randrange(256)
+    rows = []
+    for y in range(height):
+        row = bytearray(b'\x00')
+        for x in range(width):
+            row += bytes(((r0 + x) % 256, (g0 + y) % 256, (b0 + x + y) % 256))
+        rows.append(bytes(row))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(b''.join(rows))) + chunk(b'IEND', b''))
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in KINDS:
+            raise ValueError(f"未知的请求类型: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def synthetic_trace(duration, rate, mix, steps, clients, seed):
+    """按泊松到达生成轨迹"""
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    t, trace = 0.0, []
+    while True:
+        t += rng.expovariate(rate)
+        if t > duration:
+            return trace
+        kind = rng.choices(kinds, weights)[0]
+        trace.append({
+            't': round(t, 3),
+            'kind': kind,
+            'prompt': rng.choice(PROMPTS if kind == 't2i' else EDIT_PROMPTS),
+            'steps': steps,
+            'client': f"loadgen-{rng.randrange(clients)}",
+            'seed': rng.randrange(2 ** 31),
+        })
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class Recorder:
+    """收集每个请求的结果"""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, kind, start, latency, status, error=None, dispatch_delay=0.0):
+        with self._lock:
+            self.samples.append({'endpoint': endpoint, 'kind': kind, 'start': start,
+                                 'latency': latency, 'status': status, 'error': error,
+                                 'dispatch_delay': dispatch_delay, 'response': dispatch_delay + latency})
+
+
+class LoadGenerator:
+    def __init__(self, url, recorder, fetch=True, timeout=600, images=None, seed=0):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.recorder = recorder
+        self.fetch = fetch
+        self.timeout = timeout
+        self.images = images or []
+        self.seed = seed
+        # 已上传过的原图，供 continue 类型继续编辑
+        self.originals = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.started = None
+
+    def _request(self, method, path, body=None, headers=None):
+        # 与 FluxClient 相同：只在请求没发出去时重试，避免重复提交生成任务
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is not None and connection_dropped(conn):
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+            except (ConnectionResetError, BrokenPipeError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+                continue
+            try:
+                response = conn.getresponse()
+                return response.status, response.read()
+            except Exception:
+                conn.close()
+                self._local.conn = None
+                raise
+
+    def _timed(self, endpoint, kind, method, path, body=None, headers=None, scheduled=None):
+        """scheduled 为计划发出的时间（perf_counter），用来记录发出晚了多久"""
+        start = time.perf_counter()
+        try:
+            status, data = self._request(method, path, body, headers)
+            error = None if status == 200 else data[:200].decode('utf-8', 'replace')
+        except Exception as e:
+            status, data, error = 0, b'', repr(e)
+        dispatch_delay = max(start - scheduled, 0.0) if scheduled is not None else 0.0
+        self.recorder.add(endpoint, kind, start - self.started, time.perf_counter() - start, status, error,
+                          dispatch_delay)
+        return status, data
+
+    def _rng(self, item):
+        """每个请求自己的随机数生成器，由 --seed 和请求决定，与线程执行顺序无关"""
+        return random.Random(f"{self.seed}:{item.get('t')}:{item.get('seed')}")
+
+    def _upload_image(self, item):
+        if item.get('image'):
+            with open(item['image'], 'rb') as f:
+                return os.path.basename(item['image']), f.read()
+        if self.images:
+            path = self._rng(item).choice(self.images)
+            with open(path, 'rb') as f:
+                return os.path.basename(path), f.read()
+        return 'loadgen.png', synthetic_png(seed=int(item['t'] * 1000))
+
+    def run_item(self, item, scheduled=None):
+        kind = item['kind']
+        fields = {'prompt': item.get('prompt', ''), 'priority': item.get('priority', 'interactive'),
+                  'seed': item.get('seed')}
+        files = {}
+        if kind == 't2i':
+            fields.update(mode='text-to-image', guidance_scale=3.5, num_inference_steps=item.get('steps', 50))
+        else:
+            fields.update(mode='image-edit', guidance_scale=2.5)
+            with self._lock:
+                original = self._rng(item).choice(self.originals) if self.originals and kind == 'continue' else None
+            if original:
+                fields['original_image'] = original
+            else:
+                # 还没有可继续编辑的原图时按新上传处理
+                kind = 'edit'
+                files['file'] = self._upload_image(item)
+        body, content_type = encode_multipart(fields, files)
+        headers = {'Content-Type': content_type, 'X-API-Key': item.get('client', 'loadgen')}
+        status, data = self._timed('/process', kind, 'POST', '/process', body, headers, scheduled)
+        if status != 200:
+            return
+        result = json.loads(data)
+        if result.get('original_image'):
+            with self._lock:
+                if result['original_image'] not in self.originals:
+                    self.originals.append(result['original_image'])
+        if self.fetch:
+            self._timed('/output', kind, 'GET', f"/output/{result['output_image']}")
+            if result.get('original_image'):
+                self._timed('/upload', kind, 'GET', f"/upload/{result['original_image']}")
+
+    def replay(self, trace, concurrency, speed=1.0):
+        """
+        按轨迹中的时间点发请求（开环），concurrency 限制同时在途的请求数。
+        在途请求达到上限时新请求在线程池里等待，等待时间计入 dispatch_delay / response。
+        """
+        self.started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for item in trace:
+                scheduled = self.started + item.get('t', 0) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.run_item, item, scheduled)
+        return time.perf_counter() - self.started
+
+
+def summarize(samples, elapsed, window):
+    def stats(group):
+        latencies = [s['latency'] for s in group if s['status'] == 200]
+        responses = [s.get('response', s['latency']) for s in group if s['status'] == 200]
+        delays = [s.get('dispatch_delay', 0.0) for s in group]
+        errors = [s for s in group if s['status'] != 200]
+        return {
+            'count': len(group),
+            'errors': len(errors),
+            'error_rate': round(len(errors) / len(group), 4) if group else 0,
+            'status': {str(code): sum(1 for s in group if s['status'] == code) for code in sorted({s['status'] for s in group})},
+            'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else None,
+            'response_p50': percentile(responses, 0.50),
+            'response_p95': percentile(responses, 0.95),
+            'response_p99': percentile(responses, 0.99),
+            'dispatch_delay_p95': percentile(delays, 0.95),
+            'dispatch_delay_max': max(delays) if delays else None,
+            'throughput': round(len(latencies) / elapsed, 4) if elapsed else None,
+        }
+
+    by_endpoint, by_kind = {}, {}
+    for s in samples:
+        by_endpoint.setdefault(s['endpoint'], []).append(s)
+        if s['endpoint'] == '/process':
+            by_kind.setdefault(s['kind'], []).append(s)
+
+    # 按完成时间分桶统计吞吐
+    timeline = {}
+    for s in samples:
+        if s['endpoint'] != '/process':
+            continue
+        bucket = int((s['start'] + s['latency']) // window)
+        entry = timeline.setdefault(bucket, {'completed': 0, 'errors': 0, 'latencies': []})
+        if s['status'] == 200:
+            entry['completed'] += 1
+            entry['latencies'].append(s['latency'])
+        else:
+            entry['errors'] += 1
+    timeline = [
+        {'t': bucket * window, 'throughput': round(e['completed'] / window, 4), 'errors': e['errors'],
+         'p50': percentile(e['latencies'], 0.5), 'p95': percentile(e['latencies'], 0.95)}
+        for bucket, e in sorted(timeline.items())
+    ]
+    return {
+        'elapsed': round(elapsed, 3),
+        'overall': stats([s for s in samples if s['endpoint'] == '/process']),
+        'endpoints': {k: stats(v) for k, v in sorted(by_endpoint.items())},
+        'kinds': {k: stats(v) for k, v in sorted(by_kind.items())},
+        'timeline': timeline,
+    }
+
+
+def print_report(report):
+    def fmt(value):
+        return '-' if value is None else f"{value:.3f}"
+
+    print(f"耗时 {report['elapsed']}s")
+    header = f"{'':<12}{'count':>7}{'err%':>8}{'mean':>9}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}{'req/s':>9}"
+    print(header)
+    rows = [('process', report['overall'])]
+    rows += [(k, v) for k, v in report['kinds'].items()]
+    rows += [(k, v) for k, v in report['endpoints'].items() if k != '/process']
+    for name, s in rows:
+        print(f"{name:<12}{s['count']:>7}{s['error_rate'] * 100:>7.1f}%{fmt(s['mean']):>9}{fmt(s['p50']):>9}"
+              f"{fmt(s['p90']):>9}{fmt(s['p95']):>9}{fmt(s['p99']):>9}{fmt(s['max']):>9}{fmt(s['throughput']):>9}")
+    overall = report['overall']
+    print(f"从计划发出时间算起：p50 {fmt(overall['response_p50'])}  p95 {fmt(overall['response_p95'])}  "
+          f"p99 {fmt(overall['response_p99'])}；发出延迟 p95 {fmt(overall['dispatch_delay_p95'])}  "
+          f"max {fmt(overall['dispatch_delay_max'])}")
+    print("吞吐随时间变化（/process 完成数）：")
+    for entry in report['timeline']:
+        print(f"  t={entry['t']:>6}s  {entry['throughput']:>7.3f} req/s  错误 {entry['errors']}  "
+              f"p50 {fmt(entry['p50'])}  p95 {fmt(entry['p95'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FLUX 服务压测 / 轨迹回放")
+    parser.add_argument('--url', default='http://127.0.0.1:5120')
+    parser.add_argument('--trace', help='回放的轨迹文件（JSON Lines）')
+    parser.add_argument('--record', help='把合成轨迹保存到该文件')
+    parser.add_argument('--duration', type=float, default=60, help='合成轨迹的时长（秒）')
+    parser.add_argument('--rate', type=float, default=1.0, help='合成轨迹的平均到达速率（请求/秒）')
+    parser.add_argument('--mix', default='t2i=6,edit=3,continue=1', help='请求类型比例')
+    parser.add_argument('--steps', type=int, default=28, help='文生图推理步数')
+    parser.add_argument('--clients', type=int, default=4, help='模拟的客户端（API key）数量')
+    parser.add_argument('--concurrency', type=int, default=32, help='最多同时在途的请求数')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放速度倍率')
+    parser.add_argument('--images', nargs='*', default=[], help='编辑请求使用的图片，缺省时生成合成图片')
+    parser.add_argument('--no-fetch', action='store_true', help='不请求 /output 和 /upload')
+    parser.add_argument('--window', type=float, default=10, help='吞吐统计的时间窗口（秒）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='把完整报告写入该文件')
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.duration, args.rate, parse_mix(args.mix), args.steps, args.clients, args.seed)
+    if args.record:
+        with open(args.record, 'w') as f:
+            for item in trace:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+    print(f"回放 {len(trace)} 个请求 -> {args.url}")
+
+    recorder = Recorder()
+    generator = LoadGenerator(args.url, recorder, fetch=not args.no_fetch, images=args.images, seed=args.seed)
+    elapsed = generator.replay(trace, args.concurrency, args.speed)
+    report = summarize(recorder.samples, elapsed, args.window)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""LoRA 适配器注册表：按名称选择适配器，热切换不重新加载基础模型，常用适配器缓存融合后的权重"""
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+class UnknownAdapter(ValueError):
+    pass
+
+
+class LoraRegistry:
+    """
+    适配器配置，来自 JSON 文件，格式：
+    {"名称": {"path": "本地目录或 Hub id", "weight_name": "xxx.safetensors", "scale": 1.0,
+              "modes": ["text-to-image", "image-edit"]}}
+    modes 省略时两种模式都可用。
+    """
+
+    def __init__(self, adapters=None, fused_cache_size=2, fuse_after=3, cache_device=None):
+        self.adapters = adapters or {}
+        self.fused_cache_size = fused_cache_size
+        # 同一流水线上使用次数达到 fuse_after 后才缓存融合权重
+        self.fuse_after = fuse_after
+        self.cache_device = cache_device
+        self._switchers = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        adapters = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                adapters = json.load(f)
+        return cls(adapters, **kwargs)
+
+    def validate(self, name, mode):
+        """检查请求里的适配器名称，返回规范化后的名称（空字符串视为不使用）"""
+        if not name:
+            return None
+        spec = self.adapters.get(name)
+        if spec is None:
+            raise UnknownAdapter(f"未知的 LoRA: {name}")
+        if mode not in spec.get('modes', (mode,)):
+            raise UnknownAdapter(f"LoRA {name} 不支持 {mode} 模式")
+        return name
+
+    def switcher(self, pipe):
+        with self._lock:
+            switcher = self._switchers.get(pipe)
+            if switcher is None:
+                switcher = self._switchers[pipe] = LoraSwitcher(self, pipe)
+            return switcher
+
+    def activate(self, pipe, name):
+        self.switcher(pipe).activate(name)
+
+    def active(self, pipe):
+        switcher = self._switchers.get(pipe)
+        return switcher.active if switcher else None
+
+    def stats(self):
+        return {
+            'adapters': self.adapters,
+            'fused_cache_size': self.fused_cache_size,
+            'fuse_after': self.fuse_after,
+            'pipelines': [s.stats() for s in list(self._switchers.values())],
+        }
+
+
+class LoraSwitcher:
+    """
+    管理单条流水线上的适配器状态。
+
+    适配器第一次使用时通过 load_lora_weights 加载到 transformer 上，之后只用 set_adapters 切换；
+    常用的适配器把 base + delta 融合后的权重放进 LRU 缓存，切换时直接拷贝进基础层并关闭 LoRA 分支，
+    推理时没有额外的 LoRA 计算。切回未融合状态时从备份中恢复基础权重。
+    """
+
+    def __init__(self, registry, pipe):
+        self.registry = registry
+        self.pipe_ref = weakref.ref(pipe)
+        self.loaded = set()
+        self.active = None
+        self.fused_active = None
+        self.fused = OrderedDict()
+        self.uses = {}
+        self.swaps = 0
+        self.fused_hits = 0
+        self._base_backup = {}
+
+    def _lora_layers(self, transformer):
+        for module_name, module in transformer.named_modules():
+            if hasattr(module, 'lora_A') and hasattr(module, 'base_layer'):
+                yield module_name, module
+
+    def _cache_device(self, weight):
+        return self.registry.cache_device or weight.device
+
+    @torch.no_grad()
+    def _restore_base(self, transformer):
+        if self.fused_active is None:
+            return
+        layers = dict(self._lora_layers(transformer))
+        for module_name, weight in self._base_backup.items():
+            layers[module_name].base_layer.weight.copy_(weight)
+        self.fused_active = None
+
+    @torch.no_grad()
+    def _build_fused(self, transformer, name):
+        """计算 name 融合后的权重，只包含该适配器作用到的层"""
+        fused = {}
+        for module_name, module in self._lora_layers(transformer):
+            if name not in module.lora_A:
+                continue
+            base = module.base_layer.weight
+            if module_name not in self._base_backup:
+                self._base_backup[module_name] = base.detach().to(self._cache_device(base), copy=True)
+            delta = module.get_delta_weight(name).to(base.dtype)
+            fused[module_name] = (base + delta).to(self._cache_device(base))
+        return fused
+
+    @torch.no_grad()
+    def _apply_fused(self, transformer, name):
+        layers = dict(self._lora_layers(transformer))
+        for module_name, weight in self.fused[name].items():
+            layers[module_name].base_layer.weight.copy_(weight)
+        self.fused_active = name
+
+    def activate(self, name):
+        """切换到适配器 name，None 表示使用基础模型"""
+        pipe = self.pipe_ref()
+        if pipe is None or name == self.active:
+            return
+        transformer = pipe.transformer
+        self.swaps += 1
+        self._restore_base(transformer)
+
+        if name is None:
+            if self.loaded:
+                pipe.disable_lora()
+            self.active = None
+            return
+
+        spec = self.registry.adapters[name]
+        if name not in self.loaded:
+            kwargs = {'adapter_name': name}
+            if spec.get('weight_name'):
+                kwargs['weight_name'] = spec['weight_name']
+            pipe.load_lora_weights(spec['path'], **kwargs)
+            self.loaded.add(name)
+        self.uses[name] = self.uses.get(name, 0) + 1
+
+        if name not in self.fused and self.registry.fused_cache_size and self.uses[name] >= self.registry.fuse_after:
+            pipe.set_adapters([name], [spec.get('scale', 1.0)])
+            self.fused[name] = self._build_fused(transformer, name)
+            while len(self.fused) > self.registry.fused_cache_size:
+                self.fused.popitem(last=False)
+
+        if name in self.fused:
+            self.fused.move_to_end(name)
+            self.fused_hits += 1
+            pipe.disable_lora()
+            self._apply_fused(transformer, name)
+        else:
+            pipe.enable_lora()
+            pipe.set_adapters([name], [spec.get('scale', 1.0)])
+        self.active = name
+
+    def stats(self):
+        pipe = self.pipe_ref()
+        return {
+            'pipeline': type(pipe).__name__ if pipe is not None else None,
+            'active': self.active,
+            'fused_active': self.fused_active,
+            'loaded': sorted(self.loaded),
+            'fused_cached': list(self.fused),
+            'uses': dict(self.uses),
+            'swaps': self.swaps,
+            'fused_hits': self.fused_hits,
+        }
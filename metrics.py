@@ -0,0 +1,82 @@
+"""进程内指标：计数器和耗时汇总，以 Prometheus 文本格式输出"""
+import threading
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """记录一次观测值（如耗时），输出 _count 和 _sum"""
+        key = self._key(name, labels)
+        with self._lock:
+            count, total = self._summaries.get(key, (0, 0.0))
+            self._summaries[key] = (count + 1, total + value)
+
+    def get(self, name, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def to_dict(self):
+        def fmt(key):
+            name, labels = key
+            return name + (('{' + ','.join(f'{k}={v}' for k, v in labels) + '}') if labels else '')
+
+        with self._lock:
+            data = {fmt(k): v for k, v in self._counters.items()}
+            data.update({fmt(k): v for k, v in self._gauges.items()})
+            for key, (count, total) in self._summaries.items():
+                data[fmt(key) + ':count'] = count
+                data[fmt(key) + ':sum'] = round(total, 6)
+            return data
+
+    def render(self):
+        """Prometheus 文本格式"""
+        def labels_text(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels) + '}'
+
+        lines = []
+        with self._lock:
+            groups = {}
+            for kind, store in (('counter', self._counters), ('gauge', self._gauges), ('summary', self._summaries)):
+                for (name, labels), value in store.items():
+                    groups.setdefault((name, kind), []).append((labels, value))
+            for (name, kind), samples in sorted(groups.items()):
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    if kind == 'summary':
+                        count, total = value
+                        lines.append(f'{name}_count{labels_text(labels)} {count}')
+                        lines.append(f'{name}_sum{labels_text(labels)} {total}')
+                    else:
+                        lines.append(f'{name}{labels_text(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# 全局指标实例
+metrics = Metrics()
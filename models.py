@@ -0,0 +1,102 @@
+"""模型注册表：按模式和质量档位选择模型，低步数的文生图请求自动路由到 FLUX.1-schnell"""
+import os
+
+# 质量档位
+TIERS = ('quality', 'fast')
+
+
+class ModelSpec:
+    """
+    一个可加载的模型。default_steps / guidance_scale / max_sequence_length 是该模型推荐的推理参数，
+    guidance_scale 为 None 表示使用请求里的值；schnell 是蒸馏模型，不使用 guidance。
+    family 相同的模型文本编码器和 VAE 相同，同一设备上可以共用一份。
+    """
+
+    def __init__(self, name, mode, tier, pipeline_cls, model_id, default_steps, guidance_scale=None,
+                 max_sequence_length=512, family=None):
+        self.name = name
+        self.mode = mode
+        self.tier = tier
+        self.pipeline_cls = pipeline_cls
+        self.model_id = model_id
+        self.default_steps = default_steps
+        self.guidance_scale = guidance_scale
+        self.max_sequence_length = max_sequence_length
+        self.family = family
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'mode': self.mode,
+            'tier': self.tier,
+            'model_id': self.model_id,
+            'default_steps': self.default_steps,
+            'guidance_scale': self.guidance_scale,
+            'max_sequence_length': self.max_sequence_length,
+            'family': self.family,
+        }
+
+
+class ModelRegistry:
+    def __init__(self, specs, fast_steps_threshold=8):
+        self.specs = {spec.name: spec for spec in specs}
+        # 文生图请求的步数不超过这个值且没有指定档位时，自动走 fast 档
+        self.fast_steps_threshold = fast_steps_threshold
+
+    def __getitem__(self, name):
+        return self.specs[name]
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def __len__(self):
+        return len(self.specs)
+
+    def for_mode(self, mode, tier):
+        for spec in self.specs.values():
+            if spec.mode == mode and spec.tier == tier:
+                return spec
+        return None
+
+    def route(self, mode, tier=None, steps=None):
+        """
+        为请求选择模型，返回 (spec, 推理步数)。
+        没有对应档位的模型时退回 quality 档（例如图片编辑只有 Kontext）。
+        """
+        if tier is not None and tier not in TIERS:
+            raise ValueError(f"无效的质量档位: {tier}")
+        if tier is None:
+            tier = 'fast' if mode == 'text-to-image' and steps is not None and steps <= self.fast_steps_threshold else 'quality'
+        spec = self.for_mode(mode, tier) or self.for_mode(mode, 'quality')
+        if spec is None:
+            raise ValueError(f"没有可用于 {mode} 的模型")
+        if steps is None:
+            steps = spec.default_steps
+        elif spec.tier == 'fast':
+            # 蒸馏模型超过推荐步数没有收益
+            steps = min(steps, spec.default_steps)
+        return spec, steps
+
+    def to_dict(self):
+        return {
+            'fast_steps_threshold': self.fast_steps_threshold,
+            'models': [spec.to_dict() for spec in self.specs.values()],
+        }
+
+
+def build_registry():
+    """按环境变量构建默认注册表，模型 id 可以换成本地目录或小模型"""
+    from diffusers import FluxKontextPipeline, FluxPipeline
+    return ModelRegistry([
+        ModelSpec('flux-kontext', 'image-edit', 'quality', FluxKontextPipeline,
+                  os.environ.get('FLUX_EDIT_MODEL', "black-forest-labs/FLUX.1-Kontext-dev"), default_steps=28),
+        ModelSpec('flux-dev', 'text-to-image', 'quality', FluxPipeline,
+                  os.environ.get('FLUX_T2I_MODEL', "black-forest-labs/FLUX.1-dev"), default_steps=50,
+                  family='flux.1'),
+        ModelSpec('flux-schnell', 'text-to-image', 'fast', FluxPipeline,
+                  os.environ.get('FLUX_FAST_MODEL', "black-forest-labs/FLUX.1-schnell"), default_steps=4,
+                  guidance_scale=0.0, max_sequence_length=256, family='flux.1'),
+    ], fast_steps_threshold=int(os.environ.get('FLUX_FAST_STEPS_THRESHOLD', 8)))
@@ -0,0 +1,325 @@
+"""推理任务调度器：按客户端公平排队、优先级分类、并发与速率限制"""
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+# 优先级从高到低
+PRIORITY_CLASSES = ('interactive', 'batch')
+
+
+class SchedulerError(Exception):
+    """调度器拒绝任务时抛出，status_code 对应返回给客户端的 HTTP 状态码"""
+    status_code = 503
+
+
+class RateLimitExceeded(SchedulerError):
+    status_code = 429
+
+
+class QueueFull(SchedulerError):
+    status_code = 429
+
+
+class Deferred(Exception):
+    """worker 暂时不能执行任务（例如内存不足），任务放回队列 delay 秒后再调度"""
+
+    def __init__(self, delay, reason=''):
+        super().__init__(reason or f"{delay}s 后重试")
+        self.delay = delay
+
+
+class Job:
+    """一次推理任务，mode/params 描述要做什么，具体执行由 worker 完成"""
+
+    def __init__(self, client_id, mode, params=None, priority='interactive', cost=None, trace=None):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"未知的优先级: {priority}")
+        self.id = uuid.uuid4().hex
+        self.client_id = client_id
+        self.mode = mode
+        self.params = params or {}
+        self.priority = priority
+        # 成本用推理步数估算，默认按 50 步
+        self.cost = float(cost if cost is not None else self.params.get('num_inference_steps', 50))
+        self.metadata = {}
+        # 发起请求的时间线（tracing.Trace），worker 在上面记录排队、编码、去噪等 span
+        self.trace = trace
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # 被推迟的任务在这个时间点之前不会出队
+        self.not_before = 0
+        # 排在轮询队首时因为亲和度被别的任务越过的次数
+        self.skipped = 0
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = 'failed' if error is not None else 'done'
+        self.finished_at = time.time()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """等待任务结束，失败时重新抛出 worker 中的异常"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"任务 {self.id} 等待超时")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def to_dict(self):
+        now = time.time()
+        started = self.started_at or now
+        return {
+            'id': self.id,
+            'client_id': self.client_id,
+            'mode': self.mode,
+            'priority': self.priority,
+            'cost': self.cost,
+            'status': self.status,
+            'wait_seconds': round(started - self.submitted_at, 3),
+            'run_seconds': round((self.finished_at or now) - started, 3) if self.started_at else None,
+            'metadata': self.metadata,
+        }
+
+
+class TokenBucket:
+    """令牌桶限速，rate 为每秒补充的令牌数"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class FairScheduler:
+    """
+    按客户端公平排队的调度器。
+
+    每个优先级下每个客户端一条队列，同一优先级内按客户端轮询出队，
+    高优先级先于低优先级；batch 任务等待超过 batch_max_wait 秒后按 interactive 处理，
+    避免被饿死。开启 cheap_first 时，成本不超过 cheap_cost 的任务（例如编辑）
+    可以插到长时间生成任务之前。
+    亲和度（prefer）只在轮询顺序的前 prefer_window 个客户端之间挑选，
+    队首任务被越过 max_skips 次后必须出队，任何客户端都不会因为亲和度一直被跳过。
+    """
+
+    def __init__(self, max_concurrent_per_client=1, max_queued_per_client=20,
+                 rate_per_minute=30, burst=10, cheap_first=False, cheap_cost=30,
+                 batch_max_wait=300, history_size=200, prefer_window=2, max_skips=2):
+        self.max_concurrent_per_client = max_concurrent_per_client
+        self.max_queued_per_client = max_queued_per_client
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.cheap_first = cheap_first
+        self.cheap_cost = cheap_cost
+        self.batch_max_wait = batch_max_wait
+        self.prefer_window = prefer_window
+        self.max_skips = max_skips
+        self._cond = threading.Condition()
+        # {优先级: OrderedDict(client_id -> deque[Job])}，OrderedDict 的顺序即轮询顺序
+        self._queues = {p: OrderedDict() for p in PRIORITY_CLASSES}
+        self._running = {}
+        self._running_per_client = {}
+        self._buckets = {}
+        self._history = deque(maxlen=history_size)
+        self._closed = False
+
+    def submit(self, job):
+        with self._cond:
+            if self._closed:
+                raise SchedulerError("调度器已关闭")
+            # 先检查队列上限，被拒绝的请求不消耗限流令牌
+            if self.queued_count(job.client_id) >= self.max_queued_per_client:
+                raise QueueFull("排队中的任务过多，请等待之前的任务完成")
+            if self.rate_per_minute:
+                bucket = self._buckets.get(job.client_id)
+                if bucket is None:
+                    bucket = self._buckets[job.client_id] = TokenBucket(self.rate_per_minute / 60.0, self.burst)
+                if not bucket.take():
+                    raise RateLimitExceeded("请求过于频繁，请稍后再试")
+            self._queues[job.priority].setdefault(job.client_id, deque()).append(job)
+            self._cond.notify_all()
+        return job
+
+    def queued_count(self, client_id=None):
+        with self._cond:
+            if client_id is None:
+                return sum(len(q) for queues in self._queues.values() for q in queues.values())
+            return sum(len(queues.get(client_id, ())) for queues in self._queues.values())
+
+    def _eligible(self, client_id):
+        return self._running_per_client.get(client_id, 0) < self.max_concurrent_per_client
+
+    def _candidates(self, accept):
+        """按出队顺序返回 (优先级, client_id, 队首任务)"""
+        now = time.time()
+        interactive, batch = [], []
+        for priority in PRIORITY_CLASSES:
+            for client_id, queue in self._queues[priority].items():
+                if not queue or not self._eligible(client_id):
+                    continue
+                job = queue[0]
+                if job.not_before > now:
+                    continue
+                if accept is not None and not accept(job):
+                    continue
+                aged = priority == 'batch' and now - job.submitted_at >= self.batch_max_wait
+                (interactive if priority == 'interactive' or aged else batch).append((priority, client_id, job))
+        return interactive or batch
+
+    def _pick(self, candidates, prefer):
+        if self.cheap_first:
+            cheap = [c for c in candidates if c[2].cost <= self.cheap_cost]
+            if cheap:
+                candidates = cheap
+        head = candidates[0]
+        if prefer is None or head[2].skipped >= self.max_skips:
+            # 默认取轮询顺序中最靠前的
+            return head
+        # prefer 返回分数，只在轮询顺序最靠前的几个任务里选得分最高的，同分时仍按轮询顺序
+        window = candidates[:self.prefer_window]
+        scores = [prefer(c[2]) for c in window]
+        chosen = window[scores.index(max(scores))]
+        if chosen is not head:
+            head[2].skipped += 1
+        return chosen
+
+    def next_job(self, timeout=None, accept=None, prefer=None):
+        """
+        取出下一个要执行的任务，没有可执行任务时阻塞，超时返回 None。
+        accept(job) 过滤当前 worker 不能执行的任务，prefer(job) 返回分数，用于在公平的前提下挑选更合适的任务。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                candidates = self._candidates(accept)
+                if candidates:
+                    priority, client_id, job = self._pick(candidates, prefer)
+                    queues = self._queues[priority]
+                    queues[client_id].popleft()
+                    # 被服务的客户端移到轮询末尾
+                    if queues[client_id]:
+                        queues.move_to_end(client_id)
+                    else:
+                        del queues[client_id]
+                    job.status = 'running'
+                    job.started_at = time.time()
+                    self._running[job.id] = job
+                    self._running_per_client[client_id] = self._running_per_client.get(client_id, 0) + 1
+                    return job
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                # 有被推迟的任务时在最早的推迟时间到达时醒来；已经到期但被 accept 过滤掉的任务
+                # 要等 worker 空闲或有新任务时的 notify，不在这里轮询
+                now = time.time()
+                deferred = [job.not_before for queues in self._queues.values()
+                            for q in queues.values() for job in q if job.not_before > now]
+                if deferred:
+                    until = max(min(deferred) - now, 0.05)
+                    remaining = until if remaining is None else min(remaining, until)
+                self._cond.wait(remaining)
+
+    def requeue(self, job, delay=0):
+        """把已取出的任务放回其客户端队列的队首（例如资源暂时不足），delay 秒内不再出队"""
+        with self._cond:
+            self._release(job)
+            job.status = 'queued'
+            job.started_at = None
+            job.not_before = time.time() + delay if delay else 0
+            queue = self._queues[job.priority].setdefault(job.client_id, deque())
+            queue.appendleft(job)
+            self._queues[job.priority].move_to_end(job.client_id, last=False)
+            self._cond.notify_all()
+
+    def complete(self, job, result=None, error=None):
+        with self._cond:
+            self._release(job)
+            self._history.append(job)
+            self._cond.notify_all()
+        job.finish(result, error)
+
+    def _release(self, job):
+        if self._running.pop(job.id, None) is None:
+            return
+        count = self._running_per_client.get(job.client_id, 1) - 1
+        if count > 0:
+            self._running_per_client[job.client_id] = count
+        else:
+            self._running_per_client.pop(job.client_id, None)
+
+    def cancel(self, job):
+        """从队列中移除尚未开始的任务"""
+        with self._cond:
+            queues = self._queues[job.priority]
+            queue = queues.get(job.client_id)
+            if not queue or job not in queue:
+                return False
+            queue.remove(job)
+            if not queue:
+                del queues[job.client_id]
+        job.finish(error=SchedulerError("任务已取消"))
+        return True
+
+    def fail_queued(self, error):
+        """结束所有排队中的任务（例如已经没有能执行任务的 worker），返回这些任务"""
+        with self._cond:
+            jobs = [job for queues in self._queues.values() for queue in queues.values() for job in queue]
+            for queues in self._queues.values():
+                queues.clear()
+            self._history.extend(jobs)
+        for job in jobs:
+            job.finish(error=error)
+        return jobs
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """队列状态，用于排查延迟问题"""
+        with self._cond:
+            queued = {
+                priority: {client_id: [job.to_dict() for job in queue] for client_id, queue in queues.items()}
+                for priority, queues in self._queues.items()
+            }
+            return {
+                'queued_total': sum(len(q) for queues in self._queues.values() for q in queues.values()),
+                'running_total': len(self._running),
+                'queued': queued,
+                'running': [job.to_dict() for job in self._running.values()],
+                'running_per_client': dict(self._running_per_client),
+                'recent': [job.to_dict() for job in list(self._history)[-20:]],
+                'config': {
+                    'max_concurrent_per_client': self.max_concurrent_per_client,
+                    'max_queued_per_client': self.max_queued_per_client,
+                    'rate_per_minute': self.rate_per_minute,
+                    'burst': self.burst,
+                    'cheap_first': self.cheap_first,
+                    'cheap_cost': self.cheap_cost,
+                    'batch_max_wait': self.batch_max_wait,
+                },
+            }
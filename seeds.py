@@ -0,0 +1,153 @@
+"""
+可复现生成：53 位随机种子、复用的 torch.Generator 池、写进 PNG / WebP / JPEG 的生成元数据，以及确定性模式。
+同一设备、同一 dtype、同一组生成元数据重新生成时结果逐像素一致（确定性模式下）。
+"""
+import contextlib
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+from xml.sax.saxutils import quoteattr, unescape
+
+from PIL import Image
+
+# 种子会以数字出现在 JSON 响应里，取 [0, 2**53) 使 JavaScript 也能精确表示
+SEED_BITS = 53
+MAX_SEED = 2 ** SEED_BITS - 1
+
+# PNG iTXt 块的关键字，WebP 写在 XMP 的同名属性里
+METADATA_KEY = 'flux:generation'
+XMP_NAMESPACE = 'urn:flux-server:generation:1'
+# JPEG 写在 EXIF 的 UserComment（Exif IFD 0x8769 中的 0x9286），前 8 字节为字符集标识
+EXIF_IFD = 0x8769
+EXIF_USER_COMMENT = 0x9286
+USER_COMMENT_ASCII = b'ASCII\0\0\0'
+
+
+def new_seed():
+    return secrets.randbits(SEED_BITS)
+
+
+def parse_seed(value):
+    """表单里的种子，空值返回 None，超出范围时抛出 ValueError"""
+    if value in (None, ''):
+        return None
+    seed = int(value)
+    if not 0 <= seed <= MAX_SEED:
+        raise ValueError(f'种子必须在 0 到 {MAX_SEED} 之间')
+    return seed
+
+
+def enable_determinism():
+    """
+    确定性模式：关闭 TF32 和 cuDNN 自动调优，要求 PyTorch 使用确定性算法（没有确定性实现的算子只警告）。
+    需要在第一次使用 CUDA 之前调用，否则 CUBLAS_WORKSPACE_CONFIG 不生效。
+    """
+    import torch
+    os.environ.setdefault('CUBLAS_WORKSPACE_CONFIG', ':4096:8')
+    torch.use_deterministic_algorithms(True, warn_only=True)
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.allow_tf32 = False
+    torch.backends.cuda.matmul.allow_tf32 = False
+
+
+class GeneratorPool:
+    """
+    复用 torch.Generator：取出时按种子重新设定状态，用完放回，不再每个任务新建一个。
+    生成器固定在 CPU 上，初始噪声和设备无关。
+    """
+
+    def __init__(self, device='cpu', size=8):
+        self.device = device
+        self.size = size
+        self._free = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @contextlib.contextmanager
+    def seeded(self, seed):
+        with self._lock:
+            generator = self._free.pop() if self._free else None
+            if generator is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        if generator is None:
+            import torch
+            generator = torch.Generator(self.device)
+        generator.manual_seed(seed)
+        try:
+            yield generator
+        finally:
+            with self._lock:
+                if len(self._free) < self.size:
+                    self._free.append(generator)
+
+    def stats(self):
+        with self._lock:
+            return {'device': self.device, 'free': len(self._free), 'created': self.created, 'reused': self.reused}
+
+
+def image_digest(image):
+    """像素内容的 sha256（与文件格式和元数据无关），用来判断重放结果是否逐像素一致"""
+    digest = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode('ascii'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def _xmp_packet(text):
+    return ('<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+            '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+            f'<rdf:Description rdf:about="" xmlns:flux="{XMP_NAMESPACE}" {METADATA_KEY}={quoteattr(text)}/>'
+            '</rdf:RDF></x:xmpmeta><?xpacket end="w"?>')
+
+
+def metadata_save_kwargs(pil_format, metadata):
+    """
+    把生成元数据写进图片的 image.save 参数：PNG 用 iTXt 块，WebP 用 XMP，JPEG 用 EXIF UserComment。
+    GIF / BMP 等其它格式不写，重放需要从任务记录读取元数据。
+    """
+    if not metadata:
+        return {}
+    text = json.dumps(metadata, ensure_ascii=False, sort_keys=True, default=str)
+    if pil_format == 'PNG':
+        from PIL.PngImagePlugin import PngInfo
+        info = PngInfo()
+        info.add_itxt(METADATA_KEY, text)
+        return {'pnginfo': info}
+    if pil_format == 'WEBP':
+        return {'xmp': _xmp_packet(text).encode('utf-8')}
+    if pil_format == 'JPEG':
+        exif = Image.Exif()
+        # UserComment 用 ASCII 字符集，非 ASCII 字符由 json 转义
+        exif[EXIF_IFD] = {EXIF_USER_COMMENT: USER_COMMENT_ASCII + json.dumps(
+            metadata, sort_keys=True, default=str).encode('ascii')}
+        return {'exif': exif.tobytes()}
+    return {}
+
+
+def save_image(image, path, metadata=None, **kwargs):
+    """按扩展名选择格式保存，并写入生成元数据"""
+    pil_format = Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+    image.save(path, format=pil_format, **metadata_save_kwargs(pil_format, metadata), **kwargs)
+
+
+def read_metadata(image):
+    """读取 save_image / metadata_save_kwargs 写入的生成元数据，没有时返回 None"""
+    text = image.info.get(METADATA_KEY)
+    xmp = image.info.get('xmp')
+    if text is None and xmp:
+        if isinstance(xmp, bytes):
+            xmp = xmp.decode('utf-8', 'replace')
+        match = re.search(re.escape(METADATA_KEY) + r'=(["\'])(.*?)\1', xmp, re.S)
+        if match:
+            text = unescape(match.group(2), {'&quot;': '"', '&apos;': "'"})
+    if text is None and image.info.get('exif'):
+        comment = image.getexif().get_ifd(EXIF_IFD).get(EXIF_USER_COMMENT)
+        if isinstance(comment, bytes) and comment.startswith(USER_COMMENT_ASCII):
+            text = comment[len(USER_COMMENT_ASCII):].decode('ascii', 'replace')
+    return json.loads(text) if text else None
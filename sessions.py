@@ -0,0 +1,193 @@
+"""Kontext 连续编辑会话：在内存中保留当前图片的 latent，每一步都在最新结果上继续编辑"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class SessionNotFound(KeyError):
+    pass
+
+
+class EditSession:
+    """
+    一个编辑会话。
+    latents 是上一步去噪输出的 latent（已解包成 [1, C, H/8, W/8]，与 VAE 编码结果同一空间），
+    下一步直接作为 Kontext 的参考图输入，不需要解码再编码；只有客户端要看图时才解码，结果缓存到下一次编辑。
+    """
+
+    def __init__(self, client_id, source_image, width, height, max_history=10):
+        self.id = uuid.uuid4().hex
+        self.client_id = client_id
+        self.width = width
+        self.height = height
+        self.max_history = max_history
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        # 第一步编辑前还没有 latent，用原图作为输入
+        self.source_image = source_image
+        self.latents = None
+        self.device = None
+        self.image = source_image
+        self.prompts = []
+        self.history = []
+        self.lock = threading.Lock()
+
+    @property
+    def step(self):
+        return len(self.prompts)
+
+    def push(self, latents, device, prompt, seed):
+        """记录新一步的结果，旧的 latent 进入撤销历史"""
+        if self.max_history:
+            self.history.append((self.latents, self.device, self.image))
+            del self.history[:-self.max_history]
+        self.latents = latents
+        self.device = device
+        self.image = None
+        self.prompts.append({'prompt': prompt, 'seed': seed})
+
+    def undo(self):
+        if not self.history:
+            return False
+        self.latents, self.device, self.image = self.history.pop()
+        if self.latents is None and self.image is None:
+            self.image = self.source_image
+        self.prompts.pop()
+        return True
+
+    def nbytes(self):
+        def image_bytes(image):
+            return image.width * image.height * len(image.getbands()) if image is not None else 0
+
+        def tensor_bytes(tensor):
+            return tensor.numel() * tensor.element_size() if tensor is not None else 0
+
+        total = image_bytes(self.source_image) + tensor_bytes(self.latents) + image_bytes(self.image)
+        for latents, _, image in self.history:
+            if image is not self.source_image:
+                total += tensor_bytes(latents) + image_bytes(image)
+        return total
+
+    def to_dict(self):
+        return {
+            'session_id': self.id,
+            'width': self.width,
+            'height': self.height,
+            'step': self.step,
+            'prompts': list(self.prompts),
+            'undo_available': len(self.history),
+            'device': self.device,
+            'bytes': self.nbytes(),
+            'created_at': self.created_at,
+            'last_access': self.last_access,
+        }
+
+
+class SessionStore:
+    """按 TTL 和总内存上限淘汰会话，超过上限时淘汰最久未访问的"""
+
+    def __init__(self, max_bytes=2 * 2**30, ttl=1800, max_history=10):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_history = max_history
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def create(self, client_id, source_image, width, height):
+        session = EditSession(client_id, source_image, width, height, self.max_history)
+        with self._lock:
+            self._sessions[session.id] = session
+        self.evict()
+        return session
+
+    def get(self, session_id, client_id=None):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or (self.ttl and time.time() - session.last_access > self.ttl):
+                raise SessionNotFound(session_id)
+            if client_id is not None and session.client_id != client_id:
+                raise SessionNotFound(session_id)
+            session.last_access = time.time()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(s.nbytes() for s in self._sessions.values())
+
+    def evict(self, keep=None):
+        """清理过期会话，总内存超限时从最久未访问的开始淘汰（keep 指定的会话除外）"""
+        now = time.time()
+        with self._lock:
+            for session_id, session in list(self._sessions.items()):
+                if self.ttl and now - session.last_access > self.ttl:
+                    del self._sessions[session_id]
+                    self.evicted += 1
+            total = sum(s.nbytes() for s in self._sessions.values())
+            for session_id in list(self._sessions):
+                if total <= self.max_bytes:
+                    break
+                if session_id == keep:
+                    continue
+                total -= self._sessions.pop(session_id).nbytes()
+                self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            sessions = [s.to_dict() for s in self._sessions.values()]
+        return {
+            'count': len(sessions),
+            'total_bytes': sum(s['bytes'] for s in sessions),
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'evicted': self.evicted,
+            'sessions': sessions,
+        }
+
+
+def kontext_size(image):
+    """按 Kontext 的推荐分辨率选出与原图宽高比最接近的尺寸，会话中每一步都使用这个尺寸"""
+    from diffusers.pipelines.flux.pipeline_flux_kontext import PREFERRED_KONTEXT_RESOLUTIONS
+    aspect_ratio = image.width / image.height
+    _, width, height = min((abs(aspect_ratio - w / h), w, h) for w, h in PREFERRED_KONTEXT_RESOLUTIONS)
+    return width, height
+
+
+def edit_step(pipe, session, prompt, guidance_scale, generator, device, **kwargs):
+    """
+    在会话当前结果上执行一步编辑，返回新的 latent（解包后的形状）。
+    第一步输入原图，之后直接把上一步的 latent 作为参考图传给 Kontext，跳过 VAE 解码和编码。
+    """
+    if session.latents is None:
+        image = session.source_image
+    else:
+        image = session.latents.to(device)
+    packed = pipe(
+        image=image,
+        prompt=prompt,
+        guidance_scale=guidance_scale,
+        height=session.height,
+        width=session.width,
+        max_area=session.width * session.height,
+        generator=generator,
+        output_type='latent',
+        **kwargs
+    ).images
+    return pipe._unpack_latents(packed, session.height, session.width, pipe.vae_scale_factor)
+
+
+def decode_latents(pipe, latents, tiled=False):
+    """把去噪输出的 latent 解码成 PIL 图片，tiled 为 True 时分块解码以节省显存"""
+    import torch
+    with torch.inference_mode():
+        latents = latents.to(device=pipe.vae.device, dtype=pipe.vae.dtype)
+        latents = latents / pipe.vae.config.scaling_factor + pipe.vae.config.shift_factor
+        decode = pipe.vae.tiled_decode if tiled else pipe.vae.decode
+        image = decode(latents, return_dict=False)[0]
+        return pipe.image_processor.postprocess(image, output_type='pil')[0]
@@ -0,0 +1,70 @@
+"""相同请求合并：同一时间只跑一次相同的推理，后到的请求直接等待正在运行的任务"""
+import hashlib
+import json
+import threading
+
+from metrics import metrics
+
+# 参与指纹计算的参数；不包含 priority、客户端等不影响结果的字段
+FINGERPRINT_FIELDS = (
+    'model', 'prompt', 'seed', 'guidance_scale', 'num_inference_steps', 'lora', 'max_area',
+    'original_image', 'input_hash', 'save', 'upscale', 'refine',
+)
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def fingerprint(mode, params):
+    """请求指纹：模式 + 影响结果的参数 + 输入图片内容的哈希"""
+    payload = {'mode': mode}
+    payload.update({key: params[key] for key in FINGERPRINT_FIELDS if params.get(key) is not None})
+    # 新上传的图片每次保存的文件名都不同，只按内容哈希比较
+    if 'input_hash' in payload and not params.get('continue_edit'):
+        payload.pop('original_image', None)
+    return hash_bytes(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def submit(self, key, create, submit):
+        """
+        key 对应的任务还没结束时直接返回它 (job, False)；
+        否则用 create() 新建任务并 submit(job)，返回 (job, True)。submit 抛出异常时不登记。
+        """
+        with self._lock:
+            job = self._inflight.get(key)
+            if job is not None and not job.done:
+                job.metadata['coalesced'] = job.metadata.get('coalesced', 0) + 1
+                self.coalesced += 1
+                metrics.inc('singleflight_requests_total', result='coalesced')
+                return job, False
+            job = create()
+            submit(job)
+            job.metadata['fingerprint'] = key
+            self._inflight[key] = job
+            self.leaders += 1
+        metrics.inc('singleflight_requests_total', result='leader')
+        metrics.set('singleflight_inflight', len(self._inflight))
+        return job, True
+
+    def forget(self, key, job):
+        """任务结束后由发起者调用"""
+        with self._lock:
+            if self._inflight.get(key) is job:
+                del self._inflight[key]
+            metrics.set('singleflight_inflight', len(self._inflight))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'inflight': len(self._inflight),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
@@ -0,0 +1,89 @@
+"""
+把一次推理拆成文本编码、去噪、VAE 解码三个阶段，分阶段 worker 可以让相邻任务的各阶段重叠执行：
+去噪任务 N 的同时编码任务 N+1、解码任务 N-1。顺序执行时也使用同样的函数，结果完全一致。
+"""
+import threading
+import weakref
+
+STAGES = ('encode', 'denoise', 'decode')
+
+# T5 的序列长度桶：提示词只补齐到能放下它的最小桶，而不是固定 512
+SEQUENCE_BUCKETS = (64, 128, 256, 512)
+
+# 快速分词器不能被多个线程同时使用（分阶段执行时编码线程和去噪线程可能同时编码），每条流水线一把锁
+_tokenizer_locks = weakref.WeakKeyDictionary()
+_tokenizer_locks_guard = threading.Lock()
+
+
+def tokenizer_lock(pipe):
+    with _tokenizer_locks_guard:
+        lock = _tokenizer_locks.get(pipe)
+        if lock is None:
+            lock = _tokenizer_locks[pipe] = threading.Lock()
+        return lock
+
+
+def supports_stages(pipe):
+    """替身流水线等不支持单独编码 / 输出 latent 的流水线仍然整体调用"""
+    return hasattr(pipe, 'encode_prompt') and hasattr(pipe, '_unpack_latents')
+
+
+def place_text_encoders(pipe, device):
+    """把 CLIP / T5 放到单独的设备上（例如 cpu），给 transformer 腾出显存"""
+    for name in ('text_encoder', 'text_encoder_2'):
+        module = getattr(pipe, name, None)
+        if module is not None:
+            module.to(device)
+
+
+def sequence_bucket(pipe, prompt, max_sequence_length=512, buckets=SEQUENCE_BUCKETS):
+    """
+    提示词的 T5 token 数（含结束符）所在的最小桶，不超过 max_sequence_length。
+    文本 token 参与每一步去噪的联合注意力，短提示词补齐到 512 会白白增加每步的计算量。
+    没有 T5 分词器（替身流水线）或 buckets 为空时返回 max_sequence_length。
+    """
+    tokenizer = getattr(pipe, 'tokenizer_2', None)
+    if tokenizer is None or not buckets:
+        return max_sequence_length
+    with tokenizer_lock(pipe):
+        length = len(tokenizer(prompt or '', truncation=False).input_ids)
+    for bucket in sorted(buckets):
+        if length <= bucket <= max_sequence_length:
+            return bucket
+    return max_sequence_length
+
+
+def encode_prompt(pipe, prompt, max_sequence_length=512):
+    """在文本编码器所在的设备上编码提示词，返回可以直接传给流水线的 prompt_embeds / pooled_prompt_embeds"""
+    import torch
+    with tokenizer_lock(pipe), torch.inference_mode():
+        prompt_embeds, pooled_prompt_embeds, _ = pipe.encode_prompt(
+            prompt=prompt,
+            prompt_2=None,
+            device=pipe.text_encoder_2.device,
+            max_sequence_length=max_sequence_length,
+        )
+    return {'prompt_embeds': prompt_embeds, 'pooled_prompt_embeds': pooled_prompt_embeds}
+
+
+def output_size(pipe, height=None, width=None, max_area=None):
+    """按流水线内部相同的规则算出输出分辨率，解包 latent 时需要"""
+    height = height or pipe.default_sample_size * pipe.vae_scale_factor
+    width = width or pipe.default_sample_size * pipe.vae_scale_factor
+    if max_area:
+        # Kontext 按 max_area 保持宽高比缩放
+        aspect_ratio = width / height
+        width = round((max_area * aspect_ratio) ** 0.5)
+        height = round((max_area / aspect_ratio) ** 0.5)
+    multiple_of = pipe.vae_scale_factor * 2
+    return height // multiple_of * multiple_of, width // multiple_of * multiple_of
+
+
+def denoise(pipe, embeds, device, height=None, width=None, max_area=None, **kwargs):
+    """只跑去噪循环，返回解包后的 latent，embeds 为 encode_prompt 的结果"""
+    embeds = {key: value.to(device) for key, value in embeds.items()}
+    if max_area is not None:
+        kwargs['max_area'] = max_area
+    packed = pipe(height=height, width=width, output_type='latent', **embeds, **kwargs).images
+    height, width = output_size(pipe, height, width, max_area)
+    return pipe._unpack_latents(packed, height, width, pipe.vae_scale_factor)
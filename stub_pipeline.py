@@ -0,0 +1,70 @@
+"""不需要模型权重的替身流水线，用于压测和本地调试（FLUX_STUB_PIPELINES=1）"""
+import hashlib
+import os
+import time
+
+from PIL import Image, ImageDraw
+
+
+class _StubTransformer:
+    def named_modules(self):
+        return iter(())
+
+
+class _StubOutput:
+    def __init__(self, images):
+        self.images = images
+
+
+class StubPipeline:
+    """
+    模拟 FluxPipeline / FluxKontextPipeline 的调用接口：按推理步数 sleep，
+    返回由提示词和种子决定颜色的图片。每步耗时由 FLUX_STUB_STEP_SECONDS 控制。
+    只支持 output_type='pil'，编辑会话等直接操作 latent 的功能不可用。
+    """
+
+    def __init__(self, mode, default_steps):
+        self.mode = mode
+        self.default_steps = default_steps
+        self.step_seconds = float(os.environ.get('FLUX_STUB_STEP_SECONDS', 0.02))
+        self.transformer = _StubTransformer()
+        self.components = {}
+
+    def to(self, device):
+        return self
+
+    def __call__(self, prompt=None, image=None, height=None, width=None, num_inference_steps=None,
+                 guidance_scale=None, generator=None, max_area=1024 * 1024, output_type='pil',
+                 callback_on_step_end=None, **kwargs):
+        if output_type != 'pil':
+            raise NotImplementedError("替身流水线只支持 output_type='pil'")
+        steps = num_inference_steps or self.default_steps
+        for i in range(steps):
+            time.sleep(self.step_seconds)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, i, steps - i, {})
+
+        seed = generator.initial_seed() if generator is not None else 0
+        color = hashlib.sha256(f"{prompt}|{seed}".encode('utf-8')).digest()[:3]
+        if image is not None:
+            # 编辑：按 max_area 缩放输入图并叠加颜色
+            scale = min((max_area / (image.width * image.height)) ** 0.5, 1.0)
+            size = (max(int(image.width * scale) // 16 * 16, 16), max(int(image.height * scale) // 16 * 16, 16))
+            result = Image.blend(image.convert('RGB').resize(size), Image.new('RGB', size, tuple(color)), 0.3)
+        else:
+            result = Image.new('RGB', (width or 1024, height or 1024), tuple(color))
+        ImageDraw.Draw(result).text((8, 8), (prompt or '')[:60], fill=(255, 255, 255))
+        return _StubOutput([result])
+
+    # LoRA 接口在替身中不做任何事
+    def load_lora_weights(self, *args, **kwargs):
+        pass
+
+    def set_adapters(self, *args, **kwargs):
+        pass
+
+    def enable_lora(self):
+        pass
+
+    def disable_lora(self):
+        pass
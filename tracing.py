@@ -0,0 +1,173 @@
+"""按请求记录 span 时间线：上传、排队、文本编码、每一步去噪、VAE 解码、图片编码和写盘，保存在有界的环形缓冲区里"""
+import contextlib
+import json
+import threading
+import time
+import uuid
+from collections import deque
+
+from metrics import metrics
+
+
+class Trace:
+    """一个请求的时间线。span 的时间都是 time.time()，可以和任务的 submitted_at / started_at 混用"""
+
+    def __init__(self, name, **attrs):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.finished_at = None
+        self.status = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, **attrs):
+        """记录一段已经计时的区间"""
+        with self._lock:
+            self.spans.append((name, start, end, threading.current_thread().name, attrs))
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """记录 with 块的耗时，块内可以往 attrs 里补充属性"""
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            self.add(name, start, time.time(), **attrs)
+
+    @property
+    def duration(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def totals(self):
+        """按 span 名称汇总次数和耗时，例如 50 个 denoise_step 合成一行"""
+        totals = {}
+        with self._lock:
+            for name, start, end, _, _ in self.spans:
+                entry = totals.setdefault(name, {'count': 0, 'seconds': 0.0})
+                entry['count'] += 1
+                entry['seconds'] += end - start
+        return {name: dict(entry, seconds=round(entry['seconds'], 4)) for name, entry in totals.items()}
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'attrs': self.attrs,
+            'status': self.status,
+            'started_at': self.started_at,
+            'duration': round(self.duration, 4),
+            'totals': self.totals(),
+        }
+
+    def to_dict(self):
+        with self._lock:
+            spans = [
+                {'name': name, 'start': round(start - self.started_at, 4), 'duration': round(end - start, 4),
+                 'thread': thread, 'attrs': attrs}
+                for name, start, end, thread, attrs in sorted(self.spans, key=lambda s: s[1])
+            ]
+        return dict(self.summary(), spans=spans)
+
+    def chrome_events(self, pid=1):
+        """转换成 Chrome trace event 格式，可以直接拖进 chrome://tracing 或 Perfetto 查看"""
+        with self._lock:
+            spans = list(self.spans)
+        events = [{'name': self.name, 'ph': 'X', 'pid': pid, 'tid': 'request', 'ts': self.started_at * 1e6,
+                   'dur': self.duration * 1e6, 'args': dict(self.attrs, trace_id=self.id, status=self.status)}]
+        events += [{'name': name, 'ph': 'X', 'pid': pid, 'tid': thread, 'ts': start * 1e6,
+                    'dur': (end - start) * 1e6, 'args': attrs}
+                   for name, start, end, thread, attrs in spans]
+        return events
+
+
+def span(trace, name, **attrs):
+    """trace 为 None（例如不是由请求创建的任务）时什么也不记录"""
+    if trace is None:
+        return contextlib.nullcontext(attrs)
+    return trace.span(name, **attrs)
+
+
+def step_callback(trace, name='denoise_step'):
+    """
+    返回流水线的 callback_on_step_end，每步去噪结束时记录一个 span。
+    计时从创建回调时开始，所以第一步包含流水线准备 latent 的时间。
+    """
+    if trace is None:
+        return None
+    last = [time.time()]
+
+    def callback(pipe, step, timestep, callback_kwargs):
+        now = time.time()
+        trace.add(name, last[0], now, step=step)
+        last[0] = now
+        return callback_kwargs
+    return callback
+
+
+class Tracer:
+    """最近 capacity 个请求的时间线；总耗时超过 slow_seconds 的请求打印到日志，并追加到 slow_log 文件（JSON Lines）"""
+
+    def __init__(self, capacity=500, slow_seconds=60, slow_log=None):
+        self.capacity = capacity
+        self.slow_seconds = slow_seconds
+        self.slow_log = slow_log
+        self._traces = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self.finished = 0
+        self.slow = 0
+
+    def start(self, name, **attrs):
+        return Trace(name, **attrs)
+
+    def finish(self, trace, status=None):
+        if trace.finished_at is not None:
+            return
+        trace.finished_at = time.time()
+        trace.status = status
+        with self._lock:
+            self._traces.append(trace)
+            self.finished += 1
+        if self.slow_seconds and trace.duration >= self.slow_seconds:
+            self._log_slow(trace)
+
+    def _log_slow(self, trace):
+        self.slow += 1
+        metrics.inc('slow_requests_total')
+        top = sorted(trace.totals().items(), key=lambda item: -item[1]['seconds'])[:4]
+        breakdown = ', '.join(f"{name} {entry['seconds']:.2f}s" + (f"×{entry['count']}" if entry['count'] > 1 else '')
+                              for name, entry in top)
+        print(f"[慢请求] {trace.name} trace={trace.id} job={trace.attrs.get('job_id')} "
+              f"耗时 {trace.duration:.2f}s（阈值 {self.slow_seconds}s）: {breakdown}")
+        if self.slow_log:
+            with self._log_lock, open(self.slow_log, 'a') as f:
+                f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + '\n')
+
+    def get(self, trace_id):
+        """按 trace id 或任务 id 查找"""
+        with self._lock:
+            for trace in reversed(self._traces):
+                if trace.id == trace_id or trace.attrs.get('job_id') == trace_id:
+                    return trace
+        return None
+
+    def recent(self, limit=50, min_seconds=None):
+        with self._lock:
+            traces = list(self._traces)
+        if min_seconds is not None:
+            traces = [t for t in traces if t.duration >= min_seconds]
+        return traces[::-1][:limit]
+
+    def stats(self):
+        with self._lock:
+            buffered = len(self._traces)
+        return {
+            'capacity': self.capacity,
+            'buffered': buffered,
+            'finished': self.finished,
+            'slow': self.slow,
+            'slow_seconds': self.slow_seconds,
+            'slow_log': self.slow_log,
+        }
@@ -0,0 +1,169 @@
+"""
+输出放大：先用 Lanczos 放大，可选用 FLUX img2img 按 tile 低强度精修细节。
+每个 tile 的显存占用与原生生成一张 tile 大小的图相同，和放大后的总分辨率无关。
+放大在独立的 UpscaleWorker 线程里执行，不占用去噪 worker；精修时每个 tile 只短暂持有设备锁。
+"""
+import contextlib
+import math
+import queue
+import threading
+import time
+import weakref
+
+from PIL import Image, ImageChops
+
+from seeds import GeneratorPool
+
+
+def upscale_image(image, factor):
+    return image.resize((image.width * factor, image.height * factor), Image.LANCZOS)
+
+
+def tile_boxes(width, height, tile=1024, overlap=128, multiple_of=16):
+    """
+    把图片切成互相重叠至少 overlap 像素的 tile，返回 [(left, top, right, bottom)]。
+    tile 边长取 multiple_of 的倍数（FLUX 要求 16 的倍数），各 tile 在图片内均匀分布，首尾贴齐边缘。
+    """
+    def starts(size):
+        length = min(tile, size) // multiple_of * multiple_of
+        if length >= size:
+            return [0], length
+        count = math.ceil((size - overlap) / max(length - overlap, multiple_of))
+        count = max(count, 2)
+        return [round(i * (size - length) / (count - 1)) for i in range(count)], length
+
+    xs, tile_w = starts(width)
+    ys, tile_h = starts(height)
+    return [(x, y, x + tile_w, y + tile_h) for y in ys for x in xs]
+
+
+def feather_mask(width, height, left, top):
+    """粘贴用的遮罩：与已经画好的左边 / 上边 tile 重叠的部分线性过渡，避免接缝"""
+    mask = Image.new('L', (width, height), 255)
+    if top:
+        # linear_gradient 是从上（0）到下（255）的渐变
+        mask.paste(Image.linear_gradient('L').resize((width, top)), (0, 0))
+    if left:
+        ramp = Image.new('L', (width, height), 255)
+        ramp.paste(Image.linear_gradient('L').transpose(Image.ROTATE_90).resize((left, height)), (0, 0))
+        mask = ImageChops.darker(mask, ramp)
+    return mask
+
+
+_img2img_pipes = weakref.WeakKeyDictionary()
+_img2img_lock = threading.Lock()
+
+
+def img2img_for(pipe):
+    """用已加载的 FLUX 组件构造 img2img 流水线，不重复加载权重"""
+    from diffusers import FluxImg2ImgPipeline
+    with _img2img_lock:
+        img2img = _img2img_pipes.get(pipe)
+        if img2img is None:
+            img2img = _img2img_pipes[pipe] = FluxImg2ImgPipeline.from_pipe(pipe)
+        return img2img
+
+
+def refine_tiles(img2img, image, embeds, device, strength=0.3, num_inference_steps=20, guidance_scale=3.5,
+                 seed=0, tile=1024, overlap=128, hold=contextlib.nullcontext, on_tile=None, generators=None):
+    """
+    按 tile 做低强度 img2img，embeds 为 stages.encode_prompt 的结果。
+    hold() 返回每个 tile 推理期间持有的上下文（例如设备 worker 的锁），tile 之间去噪 worker 可以插入新任务。
+    generators 为 seeds.GeneratorPool，第 i 个 tile 使用种子 seed + i。
+    """
+    if generators is None:
+        generators = GeneratorPool(size=1)
+    embeds = {key: value.to(device) for key, value in embeds.items()}
+    boxes = tile_boxes(image.width, image.height, tile, overlap)
+    result = image.copy()
+    for i, (left, top, right, bottom) in enumerate(boxes):
+        start = time.time()
+        crop = image.crop((left, top, right, bottom))
+        with hold(), generators.seeded(seed + i) as generator:
+            refined = img2img(
+                image=crop,
+                height=crop.height,
+                width=crop.width,
+                strength=strength,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                generator=generator,
+                **embeds
+            ).images[0]
+        # 和左边、上边已经画好的 tile 的重叠宽度
+        overlap_left = max((r for l, t, r, b in boxes[:i] if t == top and l < left), default=left) - left
+        overlap_top = max((b for l, t, r, b in boxes[:i] if l == left and t < top), default=top) - top
+        result.paste(refined, (left, top), feather_mask(crop.width, crop.height, overlap_left, overlap_top))
+        if on_tile is not None:
+            on_tile(i, len(boxes), start, time.time())
+    return result
+
+
+class UpscaleWorker:
+    """
+    放大后处理队列。去噪 worker 完成任务后，需要放大的任务交给这里，
+    process(job, result, worker) 返回新的结果，完成后调用 done(job, result, error)。
+    """
+
+    def __init__(self, process, threads=1):
+        self.process = process
+        self.queue = queue.Queue()
+        self.threads = threads
+        self.busy_seconds = 0.0
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.current = 0
+        # 各设备上正在处理的任务数，精修占用设备内存
+        self.devices = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def wants(job):
+        return (job.params.get('upscale') or 1) > 1
+
+    def start(self):
+        for i in range(self.threads):
+            threading.Thread(target=self._run, name=f'upscale-{i}', daemon=True).start()
+
+    def submit(self, job, result, worker, done):
+        self.queue.put((job, result, worker, done))
+
+    def _run(self):
+        while True:
+            job, result, worker, done = self.queue.get()
+            start = time.perf_counter()
+            with self._lock:
+                self.current += 1
+                self.devices[worker.device] = self.devices.get(worker.device, 0) + 1
+            error = None
+            try:
+                result = self.process(job, result, worker)
+            except Exception as e:
+                error = e
+            with self._lock:
+                self.current -= 1
+                self.devices[worker.device] -= 1
+                self.busy_seconds += time.perf_counter() - start
+                if error is None:
+                    self.jobs_done += 1
+                else:
+                    self.jobs_failed += 1
+            done(job, result if error is None else None, error)
+
+    def inflight(self, device):
+        with self._lock:
+            return self.devices.get(device, 0)
+
+    def stats(self):
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        with self._lock:
+            return {
+                'threads': self.threads,
+                'queued': self.queue.qsize(),
+                'running': self.current,
+                'jobs_done': self.jobs_done,
+                'jobs_failed': self.jobs_failed,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'utilization': round(self.busy_seconds / elapsed / self.threads, 4),
+            }
@@ -0,0 +1,535 @@
+"""多设备推理 worker 池：每个 worker 绑定一个设备（或一组 CPU），由路由器按模式、模型驻留和负载分派任务"""
+import contextlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from loader import load_all
+from metrics import metrics
+from scheduler import Deferred, SchedulerError
+from stages import STAGES
+
+
+def job_model(job):
+    """任务要用的模型名称，没有指定时按模式区分"""
+    return job.params.get('model', job.mode)
+
+
+class Continuation:
+    """
+    execute 返回它表示去噪已经完成，剩下的解码、保存由 fn() 完成并返回最终结果。
+    普通 worker 在持有锁时直接调用，分阶段 worker 交给解码线程，不持有锁，
+    所以 fn 用到的流水线要在创建时 pin 住、fn 结束时 unpin。
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+
+def parse_devices(spec):
+    """
+    解析设备配置，例如 "mps"、"cuda:0,cuda:1"、"cpu@0-7,cpu@8-15"。
+    "@" 后面是绑定的 CPU 编号，多个区间用 "+" 连接，如 "cpu@0-7+16-23"。
+    返回 [(device, cpu_set 或 None)]
+    """
+    devices = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        device, _, cpus = item.partition('@')
+        cpu_set = None
+        if cpus:
+            cpu_set = set()
+            for part in cpus.split('+'):
+                start, _, end = part.partition('-')
+                cpu_set.update(range(int(start), int(end or start) + 1))
+        devices.append((device, cpu_set))
+    if not devices:
+        raise ValueError(f"无效的设备配置: {spec!r}")
+    return devices
+
+
+class PipelineWorker:
+    """
+    持有一个设备上的流水线，在自己的线程里串行执行被分派的任务。
+    pipes 按 LRU 顺序保存已驻留的模型，超过 max_resident 时释放最久未用的。
+    pin_group(model) 返回 pin / exclusive 的分组，共用组件（文本编码器、VAE）的模型属于同一组，
+    借用其中一个时另一个也不会被修改。
+    """
+
+    def __init__(self, name, device, loader, cpu_set=None, max_resident=2, pin_group=None):
+        self.name = name
+        self.device = device
+        self.cpu_set = cpu_set
+        self.loader = loader
+        self.max_resident = max_resident
+        self.pipes = OrderedDict()
+        # 同一设备上的流水线同一时间只允许一个调用方使用
+        self.lock = threading.RLock()
+        # 不持有 lock 借用流水线（编码线程、解码线程）的计数，以及正在被修改、不能借用的分组
+        self.pin_group = pin_group or (lambda model: model)
+        self.pins = {}
+        self.exclusive_groups = {}
+        self._pin_cond = threading.Condition()
+        self.inbox = queue.Queue()
+        self.current_job = None
+        self.started_at = time.time()
+        self.busy_seconds = 0.0
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.loads = 0
+        # 模型预加载完成前不接任务；预加载失败时 failed 记录原因，worker 不再接任务
+        self.ready = threading.Event()
+        self.failed = None
+
+    def is_warm(self, model):
+        return model in self.pipes
+
+    def can_run(self, job):
+        return self.ready.is_set()
+
+    @property
+    def idle(self):
+        return self.current_job is None and self.inbox.empty()
+
+    def inflight(self):
+        """占着设备内存的任务数（准入控制用）"""
+        return int(self.current_job is not None)
+
+    def assign(self, job):
+        """路由器把任务交给这个 worker"""
+        self.current_job = job
+        self.inbox.put(job)
+
+    def get_pipe(self, model):
+        """取出 model 对应的流水线，未驻留时加载"""
+        with self.lock:
+            with self._pin_cond:
+                pipe = self.pipes.get(model)
+                if pipe is not None:
+                    self.pipes.move_to_end(model)
+            if pipe is not None:
+                return pipe
+            print(f"[{self.name}] 加载模型: {model} -> {self.device}")
+            return self._insert(model, self._load(model))
+
+    def _load(self, model):
+        """调用 loader(model, device, resident)，resident 为已驻留流水线的快照，供加载时复用共享组件"""
+        with self.lock:
+            resident = dict(self.pipes)
+        return self.loader(model, self.device, resident)
+
+    def _insert(self, model, pipe):
+        with self.lock:
+            while len(self.pipes) >= self.max_resident:
+                with self._pin_cond:
+                    # 跳过正在被借用的模型，全部被借用时等编码、解码线程用完
+                    self._pin_cond.wait_for(lambda: any(self.pin_group(name) not in self.pins for name in self.pipes))
+                    evicted = next(name for name in self.pipes if self.pin_group(name) not in self.pins)
+                    del self.pipes[evicted]
+                print(f"[{self.name}] 释放模型: {evicted}")
+                release_device_memory(self.device)
+            with self._pin_cond:
+                self.pipes[model] = pipe
+            self.loads += 1
+            return pipe
+
+    def pin(self, model):
+        """
+        不持有 lock 借用已驻留的流水线，借用期间它不会被释放，exclusive(model) 也会等它还回来，
+        用完调用 unpin(model)。模型没有驻留或正在被修改时返回 None，不需要 unpin。
+        """
+        group = self.pin_group(model)
+        with self._pin_cond:
+            pipe = None if self.exclusive_groups.get(group) else self.pipes.get(model)
+            if pipe is not None:
+                self.pins[group] = self.pins.get(group, 0) + 1
+            return pipe
+
+    def unpin(self, model):
+        group = self.pin_group(model)
+        with self._pin_cond:
+            self.pins[group] -= 1
+            if not self.pins[group]:
+                del self.pins[group]
+            self._pin_cond.notify_all()
+
+    @contextlib.contextmanager
+    def pinned(self, model):
+        """pin / unpin 的上下文管理器版本"""
+        pipe = self.pin(model)
+        try:
+            yield pipe
+        finally:
+            if pipe is not None:
+                self.unpin(model)
+
+    @contextlib.contextmanager
+    def exclusive(self, model):
+        """修改流水线（切换 LoRA、CPU offload）期间持有：等同组的借用者还回来，并且不再借出"""
+        group = self.pin_group(model)
+        with self._pin_cond:
+            self.exclusive_groups[group] = self.exclusive_groups.get(group, 0) + 1
+            self._pin_cond.wait_for(lambda: not self.pins.get(group))
+        try:
+            yield
+        finally:
+            with self._pin_cond:
+                self.exclusive_groups[group] -= 1
+                if not self.exclusive_groups[group]:
+                    del self.exclusive_groups[group]
+
+    def preload(self, models, max_parallel=2):
+        """并行加载多个模型，全部成功后 worker 才开始接任务"""
+        errors = load_all([(model, lambda model=model: self._insert(model, self._load(model)))
+                           for model in models], max_parallel=max_parallel)
+        for model, error in errors.items():
+            print(f"[{self.name}] 模型 {model} 加载失败: {error}")
+        if errors:
+            self.failed = '; '.join(f"{model}: {error}" for model, error in errors.items())
+        else:
+            self.ready.set()
+        return errors
+
+    def _pin_cpus(self):
+        if self.cpu_set and hasattr(os, 'sched_setaffinity'):
+            # Linux 上 pid 0 表示当前线程，之后由该线程创建的计算线程继承这个 CPU 集合
+            os.sched_setaffinity(0, self.cpu_set)
+        if self.cpu_set:
+            # 算子内并行的线程数默认按整机核数，限制到绑定的 CPU 数，否则在小 CPU 集合里严重超订；
+            # OpenMP 的线程数按调用线程设置，每个计算线程在第一次计算前各自调用
+            import torch
+            torch.set_num_threads(len(self.cpu_set))
+
+    def run(self, execute, on_done, on_deferred, on_idle=None):
+        """worker 线程主循环；普通 worker 只在任务结束时空闲，不需要 on_idle"""
+        self._pin_cpus()
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                return
+            self.current_job = job
+            job.metadata['worker'] = self.name
+            job.metadata['device'] = self.device
+            start = time.perf_counter()
+            result, error = None, None
+            try:
+                with self.lock:
+                    result = execute(job, self)
+                    if isinstance(result, Continuation):
+                        result = result.fn()
+            except Deferred as e:
+                self.busy_seconds += time.perf_counter() - start
+                self.current_job = None
+                on_deferred(self, job, e.delay)
+                continue
+            except Exception as e:
+                error = e
+            self.busy_seconds += time.perf_counter() - start
+            self.current_job = None
+            self._finish(job, result, error, on_done)
+
+    def _finish(self, job, result, error, on_done):
+        if error is None:
+            self.jobs_done += 1
+        else:
+            self.jobs_failed += 1
+        on_done(self, job, result, error)
+
+    def stats(self):
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        finished = self.jobs_done + self.jobs_failed
+        return {
+            'name': self.name,
+            'device': self.device,
+            'cpu_set': sorted(self.cpu_set) if self.cpu_set else None,
+            'ready': self.ready.is_set(),
+            'failed': self.failed,
+            'resident': list(self.pipes),
+            'current_job': self.current_job.id if self.current_job else None,
+            'assigned': self.inbox.qsize(),
+            'jobs_done': self.jobs_done,
+            'jobs_failed': self.jobs_failed,
+            'model_loads': self.loads,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'utilization': round(self.busy_seconds / elapsed, 4),
+            'avg_job_seconds': round(self.busy_seconds / finished, 3) if finished else None,
+        }
+
+
+class StagedWorker(PipelineWorker):
+    """
+    分阶段执行的 worker：文本编码、去噪、解码各用一个线程，阶段之间是长度为 queue_size 的有界队列。
+    去噪任务 N 的同时编码任务 N+1、解码并保存任务 N-1，transformer 不用等其它阶段。
+
+    encode(job, worker) 在编码线程里执行，不持有 worker.lock，需要通过 worker.pinned 借用流水线；
+    返回值作为 execute 的第三个参数，返回 None 表示留给去噪阶段自己编码（例如模型还没加载）。execute 在持有锁时执行，
+    返回 Continuation 时剩下的工作交给解码线程。
+    路由器最多给它预先分派 queue_size 个还没开始去噪的任务。
+    """
+
+    def __init__(self, name, device, loader, encode, cpu_set=None, max_resident=2, queue_size=1, pin_group=None):
+        super().__init__(name, device, loader, cpu_set=cpu_set, max_resident=max_resident, pin_group=pin_group)
+        self.encode = encode
+        self.queue_size = queue_size
+        self.denoise_queue = queue.Queue(maxsize=queue_size)
+        self.decode_queue = queue.Queue(maxsize=queue_size)
+        # 已分派但还没开始去噪的任务数
+        self.ahead = 0
+        self.encoding = None
+        self.decoding = None
+        self.stage_busy = {stage: 0.0 for stage in STAGES}
+        self.stage_jobs = {stage: 0 for stage in STAGES}
+        # 至少有一个阶段在工作的总时长，与各阶段耗时之和的差就是重叠掉的时间
+        self.active_seconds = 0.0
+        self._active = 0
+        self._active_since = 0.0
+        self._stage_lock = threading.Lock()
+
+    @property
+    def idle(self):
+        return self.ahead < self.queue_size
+
+    def assign(self, job):
+        with self._stage_lock:
+            self.ahead += 1
+        self.inbox.put(job)
+
+    def inflight(self):
+        """去噪中的任务，加上等待解码和正在解码的任务（latent 和 VAE 激活都在设备上）"""
+        return super().inflight() + int(self.decoding is not None) + self.decode_queue.qsize()
+
+    def _timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        with self._stage_lock:
+            if not self._active:
+                self._active_since = start
+            self._active += 1
+        try:
+            return fn(*args)
+        finally:
+            end = time.perf_counter()
+            with self._stage_lock:
+                self.stage_busy[stage] += end - start
+                self.stage_jobs[stage] += 1
+                self._active -= 1
+                if not self._active:
+                    self.active_seconds += end - self._active_since
+            metrics.observe('stage_seconds', end - start, stage=stage, worker=self.name)
+
+    def run(self, execute, on_done, on_deferred, on_idle=None):
+        """去噪线程主循环，同时启动编码和解码线程；任务开始去噪、可以接下一个任务时调用 on_idle"""
+        self._pin_cpus()
+        threading.Thread(target=self._encode_loop, name=f'encode-{self.name}', daemon=True).start()
+        threading.Thread(target=self._decode_loop, args=(on_done,), name=f'decode-{self.name}',
+                         daemon=True).start()
+        while True:
+            item = self.denoise_queue.get()
+            if item is None:
+                self.decode_queue.put(None)
+                return
+            job, encoded = item
+            with self._stage_lock:
+                self.ahead -= 1
+            if on_idle is not None:
+                on_idle()
+            self.current_job = job
+            job.metadata['worker'] = self.name
+            job.metadata['device'] = self.device
+            start = time.perf_counter()
+            result, error = None, None
+            try:
+                with self.lock:
+                    result = self._timed('denoise', execute, job, self, encoded)
+            except Deferred as e:
+                self.busy_seconds += time.perf_counter() - start
+                self.current_job = None
+                on_deferred(self, job, e.delay)
+                continue
+            except Exception as e:
+                error = e
+            self.busy_seconds += time.perf_counter() - start
+            self.current_job = None
+            if isinstance(result, Continuation):
+                # 解码线程跟不上时在这里阻塞，避免 latent 无限堆积
+                self.decode_queue.put((job, result))
+            else:
+                self._finish(job, result, error, on_done)
+
+    def _encode_loop(self):
+        self._pin_cpus()
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                self.denoise_queue.put(None)
+                return
+            self.encoding = job
+            try:
+                encoded = self._timed('encode', self.encode, job, self)
+            except Exception as e:
+                # 编码失败时交给去噪阶段重新编码，由它统一报告错误
+                print(f"[{self.name}] 任务 {job.id} 文本编码出错: {e}")
+                encoded = None
+            self.encoding = None
+            self.denoise_queue.put((job, encoded))
+
+    def _decode_loop(self, on_done):
+        self._pin_cpus()
+        while True:
+            item = self.decode_queue.get()
+            if item is None:
+                return
+            job, continuation = item
+            self.decoding = job
+            result, error = None, None
+            try:
+                result = self._timed('decode', continuation.fn)
+            except Exception as e:
+                error = e
+            self.decoding = None
+            self._finish(job, result, error, on_done)
+
+    def _finish(self, job, result, error, on_done):
+        # 去噪线程和解码线程都会结束任务
+        with self._stage_lock:
+            if error is None:
+                self.jobs_done += 1
+            else:
+                self.jobs_failed += 1
+        on_done(self, job, result, error)
+
+    def stats(self):
+        stats = super().stats()
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        with self._stage_lock:
+            stage_total = sum(self.stage_busy.values())
+            stats['stages'] = {
+                stage: {
+                    'busy_seconds': round(self.stage_busy[stage], 3),
+                    'jobs': self.stage_jobs[stage],
+                    'utilization': round(self.stage_busy[stage] / elapsed, 4),
+                }
+                for stage in STAGES
+            }
+            stats['stage_queues'] = {
+                'encode': self.inbox.qsize(),
+                'denoise': self.denoise_queue.qsize(),
+                'decode': self.decode_queue.qsize(),
+            }
+            stats['ahead'] = self.ahead
+            stats['encoding'] = self.encoding.id if self.encoding else None
+            stats['decoding'] = self.decoding.id if self.decoding else None
+            # 顺序执行需要 stage_seconds 的时间，实际只用了 active_seconds
+            stats['stage_seconds'] = round(stage_total, 3)
+            stats['active_seconds'] = round(self.active_seconds, 3)
+            stats['overlap_seconds'] = round(stage_total - self.active_seconds, 3)
+        return stats
+
+
+def release_device_memory(device):
+    import gc
+    import torch
+    gc.collect()
+    if device.startswith('cuda') and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    elif device.startswith('mps') and hasattr(torch, 'mps'):
+        torch.mps.empty_cache()
+
+
+class JobRouter:
+    """
+    从调度器取任务并分派给空闲 worker。
+    只在有空闲 worker 时出队，因此公平调度的顺序不会被 worker 本地队列打乱；
+    选择 worker 时优先亲和度高的（例如已驻留该模式的模型），其次是累计负载最低的。
+    """
+
+    def __init__(self, scheduler, workers, execute, affinity=None, on_complete=None, postprocess=None):
+        self.scheduler = scheduler
+        self.workers = workers
+        self.execute = execute
+        # on_complete(job) 在任务完成或失败后于 worker 线程中调用，例如写入任务索引
+        self.on_complete = on_complete
+        # postprocess.wants(job) 为真的任务推理完成后交给 postprocess.submit 继续处理（例如放大），
+        # worker 立即空出来接新任务，后处理结束时任务才算完成
+        self.postprocess = postprocess
+        # affinity(job, worker) 返回亲和度分数，默认只看模型是否已驻留
+        self.affinity = affinity or (lambda job, worker: int(worker.is_warm(job_model(job))))
+        self._idle = threading.Condition()
+
+    def start(self):
+        for worker in self.workers:
+            threading.Thread(target=worker.run,
+                             args=(self.execute, self._on_done, self._on_deferred, self._wake),
+                             name=f'worker-{worker.name}', daemon=True).start()
+        threading.Thread(target=self._dispatch_loop, name='job-router', daemon=True).start()
+
+    def _wake(self):
+        with self._idle:
+            self._idle.notify_all()
+
+    def _on_done(self, worker, job, result, error):
+        if error is None and self.postprocess is not None and self.postprocess.wants(job):
+            self.postprocess.submit(job, result, worker, self._complete)
+            self._wake()
+            return
+        self._complete(job, result, error)
+
+    def _complete(self, job, result, error):
+        self.scheduler.complete(job, result=result, error=error)
+        if self.on_complete is not None:
+            self.on_complete(job)
+        self._wake()
+
+    def _on_deferred(self, worker, job, delay):
+        self.scheduler.requeue(job, delay)
+        self._wake()
+
+    def idle_workers(self):
+        return [w for w in self.workers if w.idle and not w.failed]
+
+    @property
+    def available(self):
+        """还有没有预加载失败的 worker"""
+        return any(not w.failed for w in self.workers)
+
+    def _fail_queued(self):
+        """所有 worker 都加载失败时，排队中的任务直接以 503 结束，不再无限等待"""
+        jobs = self.scheduler.fail_queued(SchedulerError("模型加载失败，没有可用的 worker"))
+        for job in jobs:
+            if self.on_complete is not None:
+                self.on_complete(job)
+
+    def select(self, job, candidates):
+        """给任务挑一个 worker：亲和度高的优先，其次负载最低"""
+        candidates = [w for w in candidates if w.can_run(job)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: (-self.affinity(job, w), w.busy_seconds, w.jobs_done))
+
+    def _dispatch_loop(self):
+        while True:
+            with self._idle:
+                while not self.idle_workers() and self.available:
+                    self._idle.wait(1.0)
+            if not self.available:
+                self._fail_queued()
+                with self._idle:
+                    self._idle.wait(1.0)
+                continue
+            idle = self.idle_workers()
+            job = self.scheduler.next_job(
+                timeout=1.0,
+                accept=lambda j: any(w.can_run(j) for w in idle),
+                prefer=lambda j: max(self.affinity(j, w) for w in idle),
+            )
+            if job is None:
+                continue
+            worker = self.select(job, self.idle_workers()) or self.select(job, self.workers)
+            job.metadata['routed_warm'] = worker.is_warm(job_model(job))
+            worker.assign(job)
+
+    def stats(self):
+        return [w.stats() for w in self.workers]